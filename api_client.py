@@ -3,11 +3,17 @@ from __future__ import annotations
 
 import os
 import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
 import pandas as pd
-import requests
+
+# requests is imported on the first call (_request_json): pages that only ask
+# api_is_configured() / breaker state don't pay for it on a cold start
 
 
 # -----------------------------
@@ -17,7 +23,10 @@ import requests
 class ApiConfig:
     base_url: str
     token: str
-    timeout_seconds: int = 20
+    timeout_seconds: int = 20  # read timeout ceiling; the adaptive read timeout never exceeds it
+    # fixed, not adaptive: requests doesn't report connect time apart from the response time,
+    # and just over 3s lets one lost SYN be retransmitted before giving up
+    connect_timeout_seconds: float = 3.05
     client_id: str = "kim-varmap-ui"
 
 
@@ -42,7 +51,153 @@ def load_api_config() -> Optional[ApiConfig]:
 # Low-level HTTP
 # -----------------------------
 class KimApiError(RuntimeError):
-    pass
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code  # HTTP status when the API answered with an error
+
+    @property
+    def permanent(self) -> bool:
+        """The API rejected the request itself (4xx other than 408/429): sending it again won't help."""
+        return self.status_code is not None and 400 <= self.status_code < 500 and self.status_code not in (408, 429)
+
+
+class CircuitOpenError(KimApiError):
+    """Raised without touching the network while an endpoint group's breaker is open."""
+
+
+# -----------------------------
+# Circuit breakers + adaptive timeouts (per endpoint group)
+# -----------------------------
+FAILURE_THRESHOLD = 5  # consecutive failures that open the breaker
+OPEN_SECONDS = 30.0  # how long to fail fast before a half-open trial
+LATENCY_WINDOW = 200  # recent request durations kept per group (successes + read timeouts)
+MIN_LATENCY_SAMPLES = 20
+READ_TIMEOUT_FLOOR_SECONDS = 2.0
+READ_TIMEOUT_P99_FACTOR = 3.0
+
+
+def _endpoint_group(method: str, path: str) -> str:
+    if path == "/health":
+        return "health"
+    return "read" if method.upper() == "GET" else "write"
+
+
+class CircuitBreaker:
+    """
+    closed    -> requests go through; FAILURE_THRESHOLD consecutive failures open it
+    open      -> fail fast for OPEN_SECONDS
+    half_open -> one trial request at a time; success closes, failure re-opens
+
+    The adaptive read timeout learns from successful requests and from read
+    timeouts (counted as taking the timeout). Opening the breaker forgets the
+    window and trials run with the full ceiling, so a step up in API latency
+    can't lock the breaker open on a stale timeout.
+    """
+
+    def __init__(self, group: str):
+        self.group = group
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = ""
+        self._trial_running = False
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def before_request(self) -> None:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < OPEN_SECONDS:
+                    raise CircuitOpenError(
+                        f"KIM API {self.group} endpoints unavailable (circuit open, retry in "
+                        f"{self.retry_in():.0f}s): {self.last_error}"
+                    )
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_running:
+                    raise CircuitOpenError(f"KIM API {self.group} endpoints unavailable (trial request running)")
+                self._trial_running = True
+
+    def record_success(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self, error: str, timed_out_after: Optional[float] = None) -> None:
+        """timed_out_after: the read timeout a timed-out request ran with (it took at least that long)."""
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            if timed_out_after is not None:
+                self._latencies.append(timed_out_after)
+            if self.state == "half_open" or self.failures >= FAILURE_THRESHOLD:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._latencies.clear()  # learned latencies may be what made it fail
+            self._trial_running = False
+
+    def release(self) -> None:
+        """Request ended without a verdict on availability (e.g. a 4xx)."""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "closed"
+                self.failures = 0
+            self._trial_running = False
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, OPEN_SECONDS - (time.monotonic() - self.opened_at))
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def read_timeout(self, ceiling: float) -> float:
+        """
+        READ_TIMEOUT_P99_FACTOR x observed p99, clamped to [floor, ceiling]; the
+        ceiling until enough samples and for half-open trials.
+        """
+        if self.state != "closed":
+            return float(ceiling)
+        p99 = self.latency_percentile(0.99)
+        if p99 is None:
+            return float(ceiling)
+        return min(float(ceiling), max(READ_TIMEOUT_FLOOR_SECONDS, p99 * READ_TIMEOUT_P99_FACTOR))
+
+    def snapshot(self, ceiling: float) -> Dict[str, Any]:
+        p50 = self.latency_percentile(0.50)
+        p99 = self.latency_percentile(0.99)
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": round(self.retry_in(), 1),
+            "last_error": self.last_error,
+            "p50_ms": None if p50 is None else round(p50 * 1000, 1),
+            "p99_ms": None if p99 is None else round(p99 * 1000, 1),
+            "read_timeout": round(self.read_timeout(ceiling), 2),
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {group: CircuitBreaker(group) for group in ("health", "read", "write")}
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    """Per endpoint group: state, failures, retry_in, latency p50/p99 and current read timeout."""
+    cfg = load_api_config()
+    ceiling = cfg.timeout_seconds if cfg else ApiConfig("", "").timeout_seconds
+    return {group: breaker.snapshot(ceiling) for group, breaker in _breakers.items()}
+
+
+def api_available(group: Optional[str] = None) -> bool:
+    """False while a breaker is open, so the UI can switch to local-only mode without a request."""
+    groups = [group] if group else list(_breakers)
+    return all(_breakers[g].state != "open" or _breakers[g].retry_in() == 0 for g in groups)
 
 
 def _headers(cfg: ApiConfig) -> Dict[str, str]:
@@ -61,26 +216,52 @@ def _request_json(
     params: Optional[Dict[str, Any]] = None,
     payload: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
+    import requests
+
     url = f"{cfg.base_url}{path}"
+    # serialized before the breaker is asked: an unserializable payload is our bug, not an API failure
+    body = json.dumps(payload) if payload is not None else None
+    breaker = _breakers[_endpoint_group(method, path)]
+    breaker.before_request()
+
+    read_timeout = breaker.read_timeout(cfg.timeout_seconds)
+    started = time.monotonic()
+    settled = False  # the breaker heard how the request went (success / failure / release)
     try:
-        response = requests.request(
-            method=method.upper(),
-            url=url,
-            headers=_headers(cfg),
-            params=params,
-            data=json.dumps(payload) if payload is not None else None,
-            timeout=cfg.timeout_seconds,
-        )
-    except requests.RequestException as exc:
-        raise KimApiError(f"API request failed: {exc}") from exc
-
-    if response.status_code >= 400:
-        # try to show useful message
         try:
-            details = response.json()
-        except Exception:
-            details = response.text
-        raise KimApiError(f"API error {response.status_code} on {method} {path}: {details}")
+            response = requests.request(
+                method=method.upper(),
+                url=url,
+                headers=_headers(cfg),
+                params=params,
+                data=body,
+                timeout=(cfg.connect_timeout_seconds, read_timeout),
+            )
+        except requests.RequestException as exc:
+            timed_out = isinstance(exc, requests.ReadTimeout)
+            breaker.record_failure(str(exc), timed_out_after=read_timeout if timed_out else None)
+            settled = True
+            raise KimApiError(f"API request failed: {exc}") from exc
+
+        if response.status_code >= 400:
+            # try to show useful message
+            try:
+                details = response.json()
+            except Exception:
+                details = response.text
+            if response.status_code >= 500 or response.status_code == 429:
+                breaker.record_failure(f"HTTP {response.status_code}")
+            else:
+                breaker.release()  # the API answered; a bad request says nothing about availability
+            settled = True
+            raise KimApiError(f"API error {response.status_code} on {method} {path}: {details}", response.status_code)
+
+        breaker.record_success(time.monotonic() - started)
+        settled = True
+    finally:
+        # anything else (a bug, KeyboardInterrupt, ...) must not leave a half-open trial running forever
+        if not settled:
+            breaker.release()
 
     # response might be empty (rare) — handle safely
     if not response.text.strip():
@@ -88,6 +269,87 @@ def _request_json(
     return response.json()
 
 
+# -----------------------------
+# Read cache (process-wide, shared by all sessions)
+# -----------------------------
+HEALTH_TTL_SECONDS = 15.0
+HEALTH_FAILURE_TTL_SECONDS = 5.0
+MAPPINGS_TTL_SECONDS = 60.0
+
+
+class _Flight:
+    """One in-flight call; concurrent callers for the same key wait on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _TtlCache:
+    """
+    TTL memoization with single-flight: at most one request per key is on the
+    wire, everyone else waiting for the same key gets its result (or error).
+    Errors are not cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._inflight: Dict[Hashable, _Flight] = {}
+
+    def get(self, key: Hashable, fn: Callable[[], Any], ttl: Callable[[Any], float] | float) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fn()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if flight.error is None:
+                    seconds = ttl(flight.value) if callable(ttl) else ttl
+                    if seconds > 0:
+                        self._entries[key] = (time.monotonic() + seconds, flight.value)
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, match: Callable[[Hashable], bool] | None = None) -> None:
+        """Drop cached entries (all, or those whose key matches). In-flight calls are left alone."""
+        with self._lock:
+            if match is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if match(k)]:
+                    del self._entries[key]
+
+
+_cache = _TtlCache()
+
+
+def invalidate_api_cache(project_id: Optional[str] = None) -> None:
+    """Forget cached API reads: everything, or the mappings of one project."""
+    if project_id is None:
+        _cache.invalidate()
+    else:
+        _cache.invalidate(lambda key: key[0] == "mappings" and key[2] == project_id)
+
+
 # -----------------------------
 # Public functions (what Streamlit uses)
 # -----------------------------
@@ -95,10 +357,13 @@ def api_is_configured() -> bool:
     return load_api_config() is not None
 
 
-def healthcheck() -> Tuple[bool, str]:
+def healthcheck(force: bool = False) -> Tuple[bool, str]:
     """
     If Jan exposes a real health endpoint, use it.
     If not, we treat "configured" as the first check.
+
+    Results are cached process-wide (HEALTH_TTL_SECONDS, shorter for failures)
+    and concurrent probes share one request; force=True skips the cache.
     """
     cfg = load_api_config()
     if cfg is None:
@@ -106,25 +371,41 @@ def healthcheck() -> Tuple[bool, str]:
 
     # Try a common health path. If Jan uses something else, we’ll adjust later.
     # If it fails, we still return a helpful message.
-    try:
-        _request_json(cfg, "GET", "/health")
-        return True, "OK"
-    except KimApiError as exc:
-        return False, str(exc)
+    def probe() -> Tuple[bool, str]:
+        try:
+            _request_json(cfg, "GET", "/health")
+            return True, "OK"
+        except KimApiError as exc:
+            return False, str(exc)
+
+    key = ("health", cfg.base_url)
+    if force:
+        _cache.invalidate(lambda k: k == key)
+    return _cache.get(key, probe, ttl=lambda result: HEALTH_TTL_SECONDS if result[0] else HEALTH_FAILURE_TTL_SECONDS)
 
 
-def pull_mappings(project_id: str) -> pd.DataFrame:
+def pull_mappings(project_id: str, force: bool = False) -> pd.DataFrame:
     """
     Pull current mappings for a project.
     Expects API to return either:
       - {"rows": [...]}  OR
       - [...] (list of rows)
     Each row should include: row_key + fields.
+
+    The response is cached for MAPPINGS_TTL_SECONDS (dropped after upsert/delete);
+    each caller gets its own copy of the frame.
     """
     cfg = load_api_config()
     if cfg is None:
         raise KimApiError("API not configured (missing env vars).")
 
+    key = ("mappings", cfg.base_url, project_id)
+    if force:
+        _cache.invalidate(lambda k: k == key)
+    return _cache.get(key, lambda: _fetch_mappings(cfg, project_id), ttl=MAPPINGS_TTL_SECONDS).copy()
+
+
+def _fetch_mappings(cfg: ApiConfig, project_id: str) -> pd.DataFrame:
     data = _request_json(cfg, "GET", "/v1/mappings", params={"project_id": project_id})
 
     rows: List[Dict[str, Any]]
@@ -150,12 +431,15 @@ def upsert_mappings(project_id: str, df_rows: pd.DataFrame, dry_run: bool = Fals
     Upsert rows to backend.
     We send rows as JSON dicts.
     """
+    return upsert_rows(project_id, df_rows.to_dict(orient="records"), dry_run=dry_run)
+
+
+def upsert_rows(project_id: str, rows: List[Dict[str, Any]], dry_run: bool = False) -> Dict[str, Any]:
+    """upsert_mappings() for rows that are already JSON dicts (row_key + fields)."""
     cfg = load_api_config()
     if cfg is None:
         raise KimApiError("API not configured (missing env vars).")
 
-    rows = df_rows.to_dict(orient="records")
-
     payload = {
         "project_id": project_id,
         "client_id": cfg.client_id,
@@ -163,21 +447,81 @@ def upsert_mappings(project_id: str, df_rows: pd.DataFrame, dry_run: bool = Fals
         "rows": rows,
     }
 
-    return _request_json(cfg, "POST", "/v1/mappings:upsert", payload=payload)
+    try:
+        return _request_json(cfg, "POST", "/v1/mappings:upsert", payload=payload)
+    finally:
+        # also on failure: the write may have landed before the error
+        if not dry_run:
+            invalidate_api_cache(project_id)
+
+
+DELETE_CHUNK_SIZE = 1000
+DELETE_MAX_WORKERS = 4
 
 
-def delete_mappings(project_id: str, row_keys: List[str]) -> Dict[str, Any]:
+def delete_mappings(
+    project_id: str,
+    row_keys: List[str],
+    chunk_size: int = DELETE_CHUNK_SIZE,
+    max_workers: int = DELETE_MAX_WORKERS,
+    on_chunk: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
     """
     Delete rows by row_key.
+
+    Keys go out in chunks of `chunk_size` (at most `max_workers` requests in
+    flight). Every chunk is acknowledged separately; a failed chunk does not stop
+    the others. `on_chunk(ack)` is called as chunks finish (e.g. for progress);
+    if it raises, chunks that have not been sent yet are dropped.
+
+    Returns {"deleted", "chunks": [ack, ...], "failed_keys": [...], "rejected": {key: error}}
+    where an ack is {"index", "keys", "ok", "response" | "error" + "permanent"};
+    `rejected` holds the failed keys whose chunk the API rejected for good
+    (see KimApiError.permanent).
     """
     cfg = load_api_config()
     if cfg is None:
         raise KimApiError("API not configured (missing env vars).")
 
-    payload = {
-        "project_id": project_id,
-        "client_id": cfg.client_id,
-        "row_keys": row_keys,
-    }
+    row_keys = [str(k) for k in row_keys]
+    chunks = [row_keys[i : i + chunk_size] for i in range(0, len(row_keys), max(1, chunk_size))]
 
-    return _request_json(cfg, "POST", "/v1/mappings:delete", payload=payload)
+    def send(index: int, keys: List[str]) -> Dict[str, Any]:
+        payload = {
+            "project_id": project_id,
+            "client_id": cfg.client_id,
+            "row_keys": keys,
+        }
+        try:
+            response = _request_json(cfg, "POST", "/v1/mappings:delete", payload=payload)
+            return {"index": index, "keys": len(keys), "ok": True, "response": response}
+        except KimApiError as exc:
+            return {"index": index, "keys": len(keys), "ok": False, "error": str(exc), "permanent": exc.permanent}
+
+    acks: List[Dict[str, Any]] = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks) or 1))) as pool:
+            futures = [pool.submit(send, i, keys) for i, keys in enumerate(chunks)]
+            try:
+                for future in as_completed(futures):
+                    ack = future.result()
+                    acks.append(ack)
+                    if on_chunk is not None:
+                        on_chunk(ack)
+            except BaseException:
+                # e.g. a cancelled job: chunks not yet sent are dropped, in-flight ones finish
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        invalidate_api_cache(project_id)
+
+    acks.sort(key=lambda a: a["index"])
+    failed_keys = [k for a in acks if not a["ok"] for k in chunks[a["index"]]]
+    rejected = {k: a["error"] for a in acks if not a["ok"] and a["permanent"] for k in chunks[a["index"]]}
+    deleted = sum(
+        int((a["response"] or {}).get("deleted", a["keys"])) if isinstance(a["response"], dict) else a["keys"]
+        for a in acks
+        if a["ok"]
+    )
+    return {"deleted": deleted, "chunks": acks, "failed_keys": failed_keys, "rejected": rejected}
@@ -0,0 +1,199 @@
+# api_loadtest.py
+"""
+Load test for api_client against the local mock (or any KIM API URL).
+
+    python api_loadtest.py --rows 20000 --batch-size 1000 --concurrency 8
+    python api_loadtest.py --latency-ms 30 --jitter-ms 20 --error-rate 0.02 --json report.json
+    python api_loadtest.py --url http://127.0.0.1:8765 --token dev   # external server
+
+Every operation goes through the public api_client functions (so breakers,
+timeouts and caching are part of what is measured; reads use force=True so the
+cache does not hide the server). Per operation it reports calls, errors,
+requests/s, rows/s and latency p50/p95/p99.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import api_client
+from mock_kim_api import start_mock_server
+
+OPERATIONS = ["health", "upsert", "pull", "delete"]
+
+
+def synthetic_rows(n: int, offset: int = 0) -> pd.DataFrame:
+    ids = [f"E-LT{offset + i:07d}" for i in range(n)]
+    return pd.DataFrame(
+        {
+            "row_key": ["EPIC:" + e for e in ids],
+            "Variable": [f"Load test variable {offset + i}" for i in range(n)],
+            "Organ System": "Load test",
+            "Group": [f"Group {(offset + i) % 50}" for i in range(n)],
+            "EPIC ID": ids,
+            "PDMS ID": "",
+            "Unit": "mmol/L",
+            "Source": "EPIC",
+        }
+    )
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _check_health() -> int:
+    ok, msg = api_client.healthcheck(force=True)
+    if not ok:
+        raise api_client.KimApiError(msg)
+    return 0
+
+
+class _PartialFailure(api_client.KimApiError):
+    """Call went through but part of its rows failed; `moved` rows still count."""
+
+    def __init__(self, message: str, moved: int):
+        super().__init__(message)
+        self.moved = moved
+
+
+def _delete_batch(project_id: str, keys: list[str]) -> int:
+    result = api_client.delete_mappings(project_id, keys)
+    failed = len(result["failed_keys"])
+    if failed:
+        raise _PartialFailure(f"{failed} of {len(keys)} deletes failed", len(keys) - failed)
+    return len(keys)
+
+
+def _run(name: str, calls: list, concurrency: int) -> dict:
+    """calls: list of (fn, rows) — fn() does one request, rows is what it moves (fn may return the actual count)."""
+    latencies, errors, fast_fails, rows_ok = [], 0, 0, 0
+
+    def one(call):
+        fn, rows = call
+        started = time.perf_counter()
+        try:
+            moved = fn()
+            return time.perf_counter() - started, moved if isinstance(moved, int) else rows, None
+        except api_client.KimApiError as exc:
+            return time.perf_counter() - started, getattr(exc, "moved", 0), exc
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seconds, rows, exc in pool.map(one, calls):
+            latencies.append(seconds)
+            rows_ok += rows
+            if isinstance(exc, api_client.CircuitOpenError):
+                fast_fails += 1
+            elif exc is not None:
+                errors += 1
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "operation": name,
+        "calls": len(calls),
+        "errors": errors,
+        "circuit_open": fast_fails,
+        "req_per_s": round(len(calls) / wall, 1) if wall else 0.0,
+        "rows_per_s": round(rows_ok / wall, 1) if wall else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "wall_s": round(wall, 3),
+    }
+
+
+def run_load_test(
+    rows: int = 10_000,
+    batch_size: int = 500,
+    concurrency: int = 8,
+    health_calls: int = 200,
+    pull_calls: int = 20,
+    project_id: str = "LOADTEST",
+    operations: list[str] | None = None,
+) -> list[dict]:
+    """Needs KIM_API_BASE_URL / KIM_API_TOKEN set (main() does that for the embedded mock)."""
+    operations = operations or OPERATIONS
+    batches = [synthetic_rows(min(batch_size, rows - start), offset=start) for start in range(0, rows, batch_size)]
+    results = []
+
+    for op in operations:
+        if op == "health":
+            calls = [(_check_health, 0)] * health_calls
+        elif op == "upsert":
+            calls = [(lambda b=b: api_client.upsert_mappings(project_id, b), len(b)) for b in batches]
+        elif op == "pull":
+            calls = [(lambda: len(api_client.pull_mappings(project_id, force=True)), 0)] * pull_calls
+        elif op == "delete":
+            calls = [
+                (lambda keys=b["row_key"].tolist(): _delete_batch(project_id, keys), len(b))
+                for b in batches
+            ]
+        else:
+            raise ValueError(f"unknown operation {op!r}")
+        results.append(_run(op, calls, concurrency))
+    return results
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Load test api_client against a (mock) KIM API")
+    parser.add_argument("--url", help="API base URL (default: start the local mock in-process)")
+    parser.add_argument("--token", default="loadtest")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--health-calls", type=int, default=200)
+    parser.add_argument("--pull-calls", type=int, default=20)
+    parser.add_argument("--ops", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mock only")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="mock only")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="mock only")
+    parser.add_argument("--max-rows", type=int, default=5000, help="mock only: rows per write request")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.url:
+        base_url = args.url
+    else:
+        server = start_mock_server(
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate,
+            max_rows=args.max_rows,
+            token=args.token,
+        )
+        base_url = server.url
+    os.environ["KIM_API_BASE_URL"] = base_url
+    os.environ["KIM_API_TOKEN"] = args.token
+
+    try:
+        results = run_load_test(
+            rows=args.rows,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            health_calls=args.health_calls,
+            pull_calls=args.pull_calls,
+            operations=args.ops,
+        )
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report = pd.DataFrame(results).set_index("operation")
+    print(f"KIM API load test against {base_url}")
+    print(report.to_string())
+    print("breakers:", json.dumps({g: s["state"] for g, s in api_client.breaker_states().items()}))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"url": base_url, "results": results, "breakers": api_client.breaker_states()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# base_reload.py
+"""
+Hot reload of the base mapping.
+
+A daemon thread polls BASE_CSV_PATH. When the file changed (and has stopped
+changing for one poll, so a half-copied file is not picked up) it is read,
+normalized and diffed against the current release on that thread, then
+published as the next version (data_store.publish_base_release). Request
+handling never waits for any of it: sessions keep reading the release they
+are pinned to.
+
+At the top of a rerun, sync_session_base() moves a session to the newest
+version: the selection is remapped through the release diffs
+(release_diff.remap_leaves), derived lookups are dropped, and a notice is
+left for render_base_notice(). Overlay rows are keyed by EPIC/PDMS IDs or
+NEW:uuid, so they carry over as they are.
+
+    KIM_BASE_WATCH=0              switch the watcher off
+    KIM_BASE_WATCH_SECONDS=5      poll interval
+"""
+import os
+import threading
+import time
+from pathlib import Path
+
+import streamlit as st
+
+import data_store
+from data_store import base_release, current_base_release, file_signature, publish_base_release, read_base_df
+from release_diff import UNCHANGED, ReleaseDiff, diff_releases, remap_leaves
+from tree_utils import reset_tree_widget
+
+WATCH_SECONDS = float(os.getenv("KIM_BASE_WATCH_SECONDS", "5"))
+NOTICE_POLL_SECONDS = 15
+SELECTION_KEYS = ["checked_all_list", "checked"]
+
+_diffs: dict[int, ReleaseDiff] = {}  # version -> diff from version - 1
+_status = {"checks": 0, "reloads": 0, "last_error": "", "last_reload_s": 0.0}
+_watch_lock = threading.Lock()
+_watcher: threading.Thread | None = None
+
+
+# -----------------------------
+# reload (watcher thread)
+# -----------------------------
+def reload_base(path: Path | str | None = None, signature: str | None = None) -> data_store.BaseRelease:
+    """Read, normalize and diff a new base file, then publish it. Runs off the script thread."""
+    path = Path(path or data_store.BASE_CSV_PATH)
+    signature = signature or file_signature(path)
+    started = time.perf_counter()
+
+    previous = current_base_release()
+    new_df = read_base_df(path)
+    diff = diff_releases(previous.df, new_df)
+    release = publish_base_release(new_df, path, signature)
+
+    # only a direct successor can be remapped with this diff
+    if release.version == previous.version + 1:
+        _diffs[release.version] = diff
+    for version in [v for v in _diffs if base_release(v) is None]:
+        del _diffs[version]
+
+    _status["reloads"] += 1
+    _status["last_reload_s"] = round(time.perf_counter() - started, 3)
+    _status["last_error"] = ""
+    return release
+
+
+def _watch(interval: float) -> None:
+    pending = None  # signature seen once; reloaded when it is still the same on the next poll
+    failed = None  # signature that failed to load; retried only after the file changes again
+    while True:
+        time.sleep(interval)
+        _status["checks"] += 1
+        try:
+            current = current_base_release()
+            signature = file_signature(data_store.BASE_CSV_PATH)
+        except OSError:
+            continue  # file is being replaced
+        if signature in (current.file_signature, failed):
+            pending = None
+            continue
+        if signature != pending:
+            pending = signature
+            continue
+        try:
+            reload_base(signature=signature)
+        except Exception as exc:
+            failed = signature
+            _status["last_error"] = f"{type(exc).__name__}: {exc}"
+        pending = None
+
+
+def start_base_watcher(interval: float = WATCH_SECONDS) -> bool:
+    """Start the watcher thread, once per process. Returns True if this call started it."""
+    global _watcher
+    if os.getenv("KIM_BASE_WATCH", "1") == "0":
+        return False
+    with _watch_lock:
+        if _watcher is not None:
+            return False
+        _watcher = threading.Thread(target=_watch, args=(interval,), name="kim-base-watch", daemon=True)
+        _watcher.start()
+    return True
+
+
+def watcher_status() -> dict:
+    release = current_base_release()
+    return {**_status, "version": release.version, "file": release.file_signature}
+
+
+# -----------------------------
+# sessions (script thread)
+# -----------------------------
+def sync_session_base(state=None) -> dict | None:
+    """
+    Move the session to the newest base release. Returns the notice (also
+    stored under "base_notice") if it moved, else None.
+    """
+    state = st.session_state if state is None else state
+    start_base_watcher()
+
+    current = current_base_release()
+    pinned = state.get("base_version")
+    if pinned is None or pinned == current.version:
+        state["base_version"] = current.version
+        return None
+
+    diffs = [_diffs.get(v) for v in range(pinned + 1, current.version + 1)]
+    remapped = all(d is not None for d in diffs)
+
+    overlay_df = data_store.get_overlay_df(state)
+    overlay_leaves = set()
+    if overlay_df is not None and "__row_key__" in overlay_df.columns:
+        overlay_leaves = set("ROW:" + overlay_df["__row_key__"].astype(str))
+
+    dropped = set()
+    cleared = False
+    if remapped:
+        try:
+            selections = {}
+            for key in SELECTION_KEYS:
+                leaves = list(state.get(key) or [])
+                for diff in diffs:
+                    leaves, gone = remap_leaves(leaves, diff)
+                    # an overlay row with the same key is still in the master
+                    kept = [leaf for leaf in gone if leaf in overlay_leaves]
+                    leaves += kept
+                    dropped.update(set(gone) - set(kept))
+                selections[key] = leaves
+            state.update(selections)
+        except Exception as exc:
+            # a failed remap must not break every page of the session: start from an empty selection
+            _status["last_error"] = f"remap: {type(exc).__name__}: {exc}"
+            remapped, cleared, dropped = False, True, set()
+            for key in SELECTION_KEYS:
+                dropped.update(state.get(key) or [])
+                state[key] = []
+
+    state["base_version"] = current.version
+    # master changed -> derived lookups are rebuilt lazily, the tree widget re-reads the selection
+    for key in ("key_index", "leaf_lookup_master"):
+        state.pop(key, None)
+    reset_tree_widget(state)
+
+    summary = {}
+    for diff in diffs if remapped else []:
+        for change, n in diff.summary().items():
+            summary[change] = summary.get(change, 0) + n
+    notice = {
+        "old_version": pinned,
+        "new_version": current.version,
+        "remapped": remapped,
+        "cleared": cleared,
+        "summary": summary,
+        "dropped": sorted(dropped),
+    }
+    state["base_notice"] = notice
+    return notice
+
+
+def render_base_notice() -> None:
+    """
+    Sync the session (see sync_session_base) and show what changed, once.
+    While the page sits idle, a small poll offers to switch to a newer release.
+    """
+    sync_session_base()
+    notice = st.session_state.pop("base_notice", None)
+    if notice:
+        counts = ", ".join(f"{n:,} {change.lower()}" for change, n in notice["summary"].items() if n and change != UNCHANGED)
+        text = f"The base mapping was updated (version {notice['old_version']} → {notice['new_version']})."
+        if counts:
+            text += f" Rows: {counts}."
+        if notice.get("cleared"):
+            text += f" Your selection could not be carried over and was cleared ({len(notice['dropped']):,} variable(s))."
+        elif not notice["remapped"]:
+            text += " Your selection could not be carried over automatically; please review it."
+        elif notice["dropped"]:
+            text += f" {len(notice['dropped']):,} selected variable(s) no longer exist and were deselected."
+        st.info(text)
+
+    @st.fragment(run_every=NOTICE_POLL_SECONDS)
+    def _poll():
+        if current_base_release().version != st.session_state.get("base_version"):
+            st.info("A new base mapping release is available.")
+            if st.button("Switch to the new release", key="base_reload_switch"):
+                st.rerun()
+
+    _poll()
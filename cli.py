@@ -0,0 +1,250 @@
+# cli.py
+"""
+Headless batch mode: base load -> overlay merge -> selection -> export, without Streamlit.
+
+Single project:
+    python cli.py --project "TEST STUDY" --upload a.csv b.xlsx --organ-system Renal --out exports/
+
+Many projects in parallel worker processes:
+    python cli.py --batch projects.json --workers 4 --out exports/
+
+projects.json is a list of objects with the same fields as the flags:
+    [{"project": "A", "uploads": ["a.csv"], "organ_systems": ["Renal"], "select_uploaded": true}, ...]
+
+Selection rules (see selection_rules.SelectionRule) can be given inline as
+"rules": [{...}, ...] in a batch spec, or with --rule FILE (one rule object or a list).
+A shared selection token (see selection_token.py) goes in "selection_token" / --select-token.
+
+A JSON summary is printed to stdout. Exit codes: 0 = all projects exported,
+1 = at least one project failed, 2 = invalid arguments.
+"""
+import argparse
+import json
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+import data_store
+from conflicts import analyze_conflicts
+from export_utils import build_export_view, export_file_name
+from selection_rules import SelectionRule, evaluate_rules
+from selection_token import decode_selection, key_order_of
+from upload_ingest import merge_parsed_uploads, parse_uploads, validate_chunks
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+# -----------------------------
+# selection
+# -----------------------------
+def _read_keys_file(path: str) -> list[str]:
+    keys = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line:
+            keys.append(line[len("ROW:"):] if line.startswith("ROW:") else line)
+    return keys
+
+
+def _read_rules_file(path: str) -> list[dict]:
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    return data if isinstance(data, list) else [data]
+
+
+def select_row_keys(master_df: pd.DataFrame, spec: dict, uploaded_keys: pd.Index, state=None) -> pd.Index:
+    """Union of all selection sources in `spec`, as __row_key__ values present in master."""
+    master_keys = master_df["__row_key__"].astype(str)
+    selected = pd.Index([], dtype=object)
+
+    if spec.get("select_all"):
+        selected = selected.append(pd.Index(master_keys))
+
+    organ_systems = spec.get("organ_systems") or []
+    groups = spec.get("groups") or []
+    if organ_systems or groups:
+        mask = pd.Series(True, index=master_df.index)
+        if organ_systems:
+            mask &= master_df["Organ System"].isin(organ_systems)
+        if groups:
+            mask &= master_df["Group"].isin(groups)
+        selected = selected.append(pd.Index(master_keys[mask]))
+
+    listed = list(spec.get("keys") or [])
+    if spec.get("select_keys_file"):
+        listed += _read_keys_file(spec["select_keys_file"])
+    listed = [k[len("ROW:"):] if k.startswith("ROW:") else k for k in listed]
+
+    token = spec.get("selection_token")
+    if token:
+        # a token string, or a .kimsel file holding one
+        if not token.startswith("ks1.") and Path(token).is_file():
+            token = Path(token).read_text(encoding="utf-8").strip()
+        key_order = key_order_of(data_store.load_base_df(state=state))
+        listed += [leaf[len("ROW:"):] for leaf in decode_selection(token, key_order=key_order)]
+    if listed:
+        selected = selected.append(pd.Index(listed))
+
+    rule_dicts = list(spec.get("rules") or [])
+    if spec.get("rules_file"):
+        rule_dicts += _read_rules_file(spec["rules_file"])
+    if rule_dicts:
+        leaves = evaluate_rules(master_df, [SelectionRule.from_dict(r) for r in rule_dicts])
+        selected = selected.append(pd.Index(leaves.str[len("ROW:"):]))
+
+    # like the UI: uploaded rows are selected unless another selection was asked for
+    has_explicit = spec.get("select_all") or organ_systems or groups or listed or rule_dicts
+    if spec.get("select_uploaded", not has_explicit):
+        selected = selected.append(uploaded_keys)
+
+    selected = selected.astype(str).unique()
+    return selected[data_store.get_key_index(state).contains(selected)]
+
+
+# -----------------------------
+# one project (runs in a worker process)
+# -----------------------------
+def run_project(spec: dict, out_dir: str, base_path: str | None = None, parse_workers: int | None = None) -> dict:
+    project = str(spec.get("project") or "").strip()
+    summary = {"project": project, "status": "failed"}
+    default_base_path = data_store.BASE_CSV_PATH
+    try:
+        if not project:
+            raise ValueError("project name is required")
+        if base_path:
+            # only for this run; restored below so other code in the process keeps the default base
+            data_store.BASE_CSV_PATH = Path(base_path)
+
+        state = {}  # stands in for st.session_state
+
+        files = [(Path(p).name, Path(p).read_bytes()) for p in spec.get("uploads") or []]
+        chunks = parse_uploads(files, max_workers=parse_workers)
+        validations = validate_chunks(chunks)
+
+        valid_parts = [chunk_df.loc[r.valid_mask] for (_, chunk_df), r in zip(chunks, validations)]
+        if valid_parts:
+            conflict_report = analyze_conflicts(
+                data_store.get_master_df(state), pd.concat(valid_parts, ignore_index=True)
+            )
+        else:
+            conflict_report = pd.DataFrame()
+        summary["conflicts"] = int(len(conflict_report))
+        if len(conflict_report) and spec.get("strict"):
+            raise ValueError(f"{len(conflict_report)} ID conflict(s) in uploads (strict mode)")
+
+        file_summaries, processed_df = merge_parsed_uploads(chunks, validations, state=state)
+        summary["uploads"] = file_summaries
+        summary["validation_issues"] = sum(r.total_errors for r in validations)
+
+        master_df = data_store.get_master_df(state)
+        uploaded_keys = (
+            pd.Index(processed_df["__row_key__"].astype(str)) if "__row_key__" in processed_df.columns else pd.Index([])
+        )
+        selected_keys = select_row_keys(master_df, spec, uploaded_keys, state=state)
+
+        selected_df = data_store.gather_master_rows(selected_keys, state)
+        export_view = build_export_view(selected_df)
+
+        out_path = Path(out_dir) / export_file_name(project)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        export_view.to_csv(out_path, index=False)
+
+        summary.update(
+            {
+                "status": "ok",
+                "master_rows": int(len(master_df)),
+                "selected_rows": int(len(export_view)),
+                "output": str(out_path),
+            }
+        )
+    except Exception as exc:
+        summary["error"] = f"{type(exc).__name__}: {exc}"
+        summary["traceback"] = traceback.format_exc(limit=5)
+    finally:
+        data_store.BASE_CSV_PATH = default_base_path
+    return summary
+
+
+# -----------------------------
+# entry point
+# -----------------------------
+def _spec_from_args(args: argparse.Namespace) -> dict:
+    spec = {
+        "project": args.project,
+        "uploads": args.upload or [],
+        "select_all": args.select_all,
+        "select_keys_file": args.select_keys,
+        "organ_systems": args.organ_system or [],
+        "groups": args.group or [],
+        "rules_file": args.rule,
+        "selection_token": args.select_token,
+        "strict": args.strict,
+    }
+    if args.select_uploaded:
+        spec["select_uploaded"] = True
+    return spec
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="KIM VarMap headless merge/select/export")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--project", help="project name (single project mode)")
+    target.add_argument("--batch", help="JSON file with a list of project specs")
+
+    parser.add_argument("--upload", nargs="+", help="mapping files to merge (CSV, XLSX, ZIP)")
+    parser.add_argument("--select-all", action="store_true", help="select every row of the master")
+    parser.add_argument("--select-uploaded", action="store_true", help="select the uploaded rows (default if nothing else is selected)")
+    parser.add_argument("--select-keys", help="file with one __row_key__ (or ROW:<key>) per line")
+    parser.add_argument("--organ-system", action="append", help="select rows in this organ system (repeatable)")
+    parser.add_argument("--group", action="append", help="select rows in this group (repeatable)")
+    parser.add_argument("--select-token", help="selection token (ks1.…) or a .kimsel file")
+    parser.add_argument("--rule", help="JSON file with a selection rule (or a list of rules)")
+    parser.add_argument("--strict", action="store_true", help="fail a project if its uploads have ID conflicts")
+
+    parser.add_argument("--base", help=f"base mapping CSV (default: {data_store.BASE_CSV_PATH})")
+    parser.add_argument("--out", default="exports", help="output directory (default: exports)")
+    parser.add_argument("--workers", type=int, default=1, help="parallel worker processes for --batch")
+    parser.add_argument("--summary", help="also write the JSON summary to this file")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        try:
+            specs = json.loads(Path(args.batch).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as exc:
+            print(json.dumps({"ok": False, "error": f"cannot read batch file: {exc}"}))
+            return EXIT_USAGE
+        if not isinstance(specs, list):
+            print(json.dumps({"ok": False, "error": "batch file must contain a JSON list"}))
+            return EXIT_USAGE
+    else:
+        specs = [_spec_from_args(args)]
+
+    if args.workers > 1 and len(specs) > 1:
+        # projects in parallel; each worker parses its own files inline
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(
+                pool.map(run_project, specs, [args.out] * len(specs), [args.base] * len(specs), [1] * len(specs))
+            )
+    else:
+        results = [run_project(spec, args.out, args.base) for spec in specs]
+
+    ok = all(r["status"] == "ok" for r in results)
+    summary = {"ok": ok, "projects": results}
+    text = json.dumps(summary, indent=2, default=str)
+    print(text)
+    if args.summary:
+        Path(args.summary).write_text(text, encoding="utf-8")
+    return EXIT_OK if ok else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# conflicts.py
+"""
+ID conflict and duplicate detection across base + overlay + a pending upload.
+
+Everything is hash-grouped (pandas groupby / duplicated), so one pass is O(n)
+over the combined rows. Only the conflicting groups are formatted for display.
+"""
+import numpy as np
+import pandas as pd
+
+from data_store import ensure_required_cols, normalize_grouping, normalize_ids
+
+REPORT_COLS = ["Conflict", "Key", "Values", "Rows", "Sources"]
+
+EPIC_MULTI_PDMS = "EPIC ID paired with different PDMS IDs"
+PDMS_MULTI_VARIABLE = "PDMS ID used for different variables"
+VARIABLE_MULTI_EPIC = "Same Variable / Organ System / Group with different EPIC IDs"
+VARIABLE_MULTI_PDMS = "Same Variable / Organ System / Group with different PDMS IDs"
+UPLOAD_DUPLICATE_KEY = "Duplicate EPIC/PDMS ID within upload"
+UPLOAD_DUPLICATE_VARIABLE = "Duplicate Variable / Organ System / Group within upload (row without IDs)"
+VARIABLE_COLS = ["Variable", "Organ System", "Group"]
+
+
+def _joined_distinct(df: pd.DataFrame, key_col: str, value_col: str) -> pd.Series:
+    """key -> "v1, v2" of distinct values (dedup + sort first, so the join is the only per-group step)."""
+    distinct = df[[key_col, value_col]].drop_duplicates().sort_values([key_col, value_col])
+    return distinct.groupby(key_col, sort=False)[value_col].agg(", ".join)
+
+
+def _isin(values: pd.Series, lookup: pd.Series) -> np.ndarray:
+    """Vectorized membership via one hash index on `lookup` (Series.isin is slow for large arrow-backed lookups)."""
+    return pd.Index(lookup.unique()).get_indexer(values) != -1
+
+
+def _prepare_upload(upload_df: pd.DataFrame) -> pd.DataFrame:
+    """Same normalization as upsert_overlay_from_upload, plus the key it would get."""
+    df = upload_df.copy()
+    df.columns = [str(c).strip() for c in df.columns]
+    df = ensure_required_cols(df)
+    df = normalize_grouping(df)
+    df = normalize_ids(df)
+    df = df.loc[df["Variable"] != ""].copy()
+
+    epic = df["EPIC ID"]
+    pdms = df["PDMS ID"]
+    df["__row_key__"] = np.where(epic != "", "EPIC:" + epic, np.where(pdms != "", "PDMS:" + pdms, ""))
+    df["__origin__"] = "upload"
+    return df
+
+
+def _multi_valued(df: pd.DataFrame, key_col: str, value_col: str, conflict: str) -> pd.DataFrame:
+    """Groups where one non-empty key maps to more than one non-empty value."""
+    sub = df.loc[(df[key_col] != "") & (df[value_col] != ""), [key_col, value_col, "__origin__"]]
+    is_conflict = sub.groupby(key_col, sort=False)[value_col].transform("nunique") > 1
+    if not is_conflict.any():
+        return pd.DataFrame(columns=REPORT_COLS)
+
+    hit = sub.loc[is_conflict]
+    out = pd.DataFrame(
+        {
+            "Values": _joined_distinct(hit, key_col, value_col),
+            "Rows": hit.groupby(key_col, sort=False).size(),
+            "Sources": _joined_distinct(hit, key_col, "__origin__"),
+        }
+    )
+    out = out.rename_axis("Key").reset_index()
+    out.insert(0, "Conflict", conflict)
+    return out[REPORT_COLS]
+
+
+def _duplicates(df: pd.DataFrame, key_cols: list[str], conflict: str) -> pd.DataFrame:
+    """Keys that occur more than once (all rows in `df` already count)."""
+    mask = df.duplicated(subset=key_cols, keep=False)
+    if not mask.any():
+        return pd.DataFrame(columns=REPORT_COLS)
+
+    hit = df.loc[mask, key_cols].astype(str)
+    key = hit[key_cols[0]]
+    for col in key_cols[1:]:
+        key = key + " / " + hit[col]
+    out = key.value_counts(sort=False).rename("Rows").rename_axis("Key").reset_index()
+    out.insert(0, "Conflict", conflict)
+    out["Values"] = ""
+    out["Sources"] = "upload"
+    return out[REPORT_COLS]
+
+
+def analyze_conflicts(master_df: pd.DataFrame, upload_df: pd.DataFrame, upload_only: bool = True) -> pd.DataFrame:
+    """
+    Conflict report for applying `upload_df` on top of `master_df`.
+
+    Rows the upload will replace (same EPIC:/PDMS: key) are evaluated with their
+    uploaded values, so a deliberate ID change is not reported as a conflict.
+    One variable listed once with an EPIC ID and once with a PDMS ID is fine
+    (two sources); only IDs that contradict each other are conflicts.
+    With upload_only=True, conflicts that exist without the upload (e.g. inside
+    the base) are left out.
+    Returns one row per conflicting key with columns REPORT_COLS (empty => clean).
+    """
+    upload = _prepare_upload(upload_df)
+
+    reports = [
+        _duplicates(upload.loc[upload["__row_key__"] != ""], ["__row_key__"], UPLOAD_DUPLICATE_KEY),
+    ]
+    # a row without IDs always becomes a new variable, so it duplicates any same-named row;
+    # same-named rows that all carry IDs are judged by the ID checks below
+    idless = pd.Series(upload["__row_key__"] == "", index=upload.index)
+    has_idless = idless.groupby([upload[c] for c in VARIABLE_COLS], sort=False).transform("any")
+    reports.append(_duplicates(upload.loc[has_idless], VARIABLE_COLS, UPLOAD_DUPLICATE_VARIABLE))
+
+    # prospective master: existing rows not replaced by the upload + upload rows (last wins)
+    master = master_df[["Variable", "Organ System", "Group", "EPIC ID", "PDMS ID", "__row_key__", "__origin__"]]
+    replaced = _isin(master["__row_key__"], upload.loc[upload["__row_key__"] != "", "__row_key__"])
+    upload_last = pd.concat(
+        [
+            upload.loc[upload["__row_key__"] != ""].drop_duplicates(subset=["__row_key__"], keep="last"),
+            upload.loc[upload["__row_key__"] == ""],
+        ]
+    )
+    combined = pd.concat([master.loc[~replaced], upload_last[master.columns]], ignore_index=True)
+
+    combined["__variable_key__"] = (
+        combined["Variable"] + " / " + combined["Organ System"] + " / " + combined["Group"]
+    )
+
+    reports += [
+        _multi_valued(combined, "EPIC ID", "PDMS ID", EPIC_MULTI_PDMS),
+        _multi_valued(combined, "PDMS ID", "Variable", PDMS_MULTI_VARIABLE),
+        _multi_valued(combined, "__variable_key__", "EPIC ID", VARIABLE_MULTI_EPIC),
+        _multi_valued(combined, "__variable_key__", "PDMS ID", VARIABLE_MULTI_PDMS),
+    ]
+
+    reports = [r for r in reports if len(r) > 0]
+    if not reports:
+        return pd.DataFrame(columns=REPORT_COLS)
+    report = pd.concat(reports, ignore_index=True)
+    if upload_only:
+        report = report.loc[report["Sources"].str.contains("upload", regex=False)].reset_index(drop=True)
+    return report
@@ -1,15 +1,32 @@
+import threading
+import time
 import uuid
+from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
+from key_index import BASE, USER, KeyIndex
+from overlay_journal import OverlayJournal
+from sync_queue import get_sync_queue, sync_project
+
 BASE_CSV_PATH = Path("data/clinical_variable_mapping_50_entries.csv")
+BASE_RELEASES_KEPT = 3  # sessions pinned to an older version can still be served + remapped
 
 CORE_COLS = ["Organ System", "Group", "Variable"]
 ID_COLS = ["EPIC ID", "PDMS ID"]
 
 
+def _session(state=None):
+    """
+    Where session data lives: st.session_state inside the app, or any dict-like
+    passed as `state` (headless CLI / workers, see cli.py).
+    """
+    return st.session_state if state is None else state
+
+
 def ensure_required_cols(df: pd.DataFrame) -> pd.DataFrame:
     df = df.copy()
     for col in CORE_COLS:
@@ -55,64 +72,383 @@ def stable_id_key_from_row(row: pd.Series) -> str:
     return ""
 
 
-def load_base_df() -> pd.DataFrame:
+def stable_id_keys(df: pd.DataFrame) -> pd.Series:
+    """Vectorized stable_id_key_from_row for a normalized frame ("" where there is no ID)."""
+    epic = df["EPIC ID"].astype(str).str.strip()
+    pdms = df["PDMS ID"].astype(str).str.strip()
+    keys = np.where(epic != "", "EPIC:" + epic, np.where(pdms != "", "PDMS:" + pdms, ""))
+    return pd.Series(keys, index=df.index, dtype=object)
+
+
+def read_base_df(path: Path | str) -> pd.DataFrame:
     """
-    Base rows:
+    Base rows of a release file, read and normalized:
     - if EPIC/PDMS exists => stable key (EPIC:... / PDMS:...)
     - else => stable-ish base-only key so base rows remain unique (but NOT updateable via upload)
     """
-    base_df = pd.read_csv(BASE_CSV_PATH)
+    base_df = pd.read_csv(path)
     base_df = ensure_required_cols(base_df)
     base_df = normalize_grouping(base_df)
     base_df = normalize_ids(base_df)
 
-    # Build keys
-    base_keys = []
-    for i, row in base_df.iterrows():
-        stable_key = stable_id_key_from_row(row)
-        if stable_key:
-            base_keys.append(stable_key)
-        else:
-            # base-only fallback (does NOT enable "updates" without IDs)
-            # this is just to keep base rows uniquely addressable
-            var = row.get("Variable", "")
-            os_name = row.get("Organ System", "")
-            group = row.get("Group", "")
-            src = row.get("Source", "")
-            base_keys.append(f"BASE:{var}|OS:{os_name}|GR:{group}|SRC:{src}|IDX:{i}")
-
-    base_df["__row_key__"] = base_keys
+    # Build keys (column-wise; same keys as stable_id_key_from_row per row)
+    stable = stable_id_keys(base_df)
+    # base-only fallback (does NOT enable "updates" without IDs)
+    # this is just to keep base rows uniquely addressable
+    fallback = (
+        "BASE:" + base_df["Variable"].astype(str)
+        + "|OS:" + base_df["Organ System"].astype(str)
+        + "|GR:" + base_df["Group"].astype(str)
+        + "|SRC:" + base_df["Source"].astype(str)
+        + "|IDX:" + pd.Series(base_df.index, index=base_df.index).astype(str)
+    )
+
+    base_df["__row_key__"] = np.where(stable != "", stable, fallback).astype(object)
     base_df["__origin__"] = "base"
     return base_df
 
 
-def get_master_df() -> pd.DataFrame:
+# -----------------------------
+# versioned base releases (process-wide)
+# -----------------------------
+@dataclass(frozen=True)
+class BaseRelease:
+    version: int
+    path: Path
+    file_signature: str  # path:mtime:size of the file it was read from
+    df: pd.DataFrame
+    loaded_at: float
+
+    @property
+    def signature(self) -> str:
+        return f"v{self.version}:{self.file_signature}"
+
+
+_base_lock = threading.Lock()
+_base_releases: dict[int, BaseRelease] = {}
+_base_indexes: dict[int, KeyIndex] = {}  # version -> key index of that release, built on first use
+_current_base: BaseRelease | None = None
+
+
+def file_signature(path: Path | str) -> str:
+    """Identifies a file on disk (path + mtime + size)."""
+    stat = Path(path).stat()
+    return f"{path}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def publish_base_release(df: pd.DataFrame, path: Path | str, signature: str) -> BaseRelease:
     """
-    master = base + overlay
-    overlay wins if same __row_key__ (i.e., same EPIC/PDMS ID)
+    Make an already normalized base frame the current release under the next
+    version number. The swap is a single reference assignment: readers see
+    either the old or the new release, never a mix.
+    """
+    global _current_base
+    with _base_lock:
+        version = (_current_base.version if _current_base else 0) + 1
+        release = BaseRelease(version, Path(path), signature, df, time.time())
+        _base_releases[version] = release
+        for old in sorted(_base_releases)[:-BASE_RELEASES_KEPT]:
+            del _base_releases[old]
+            _base_indexes.pop(old, None)
+        _current_base = release
+    return release
+
+
+def current_base_release() -> BaseRelease:
+    """
+    Newest base release. Only the very first call (or a changed BASE_CSV_PATH,
+    see cli.py --base) reads the file here; later file changes are picked up in
+    the background by base_reload.py.
     """
-    base_df = load_base_df()
+    release = _current_base
+    if release is not None and release.path == Path(BASE_CSV_PATH):
+        return release
+    path = Path(BASE_CSV_PATH)
+    signature = file_signature(path)
+    with _base_lock:
+        release = _current_base
+        if release is not None and release.path == path:
+            return release
+    return publish_base_release(read_base_df(path), path, signature)
 
-    overlay_df = st.session_state.get("overlay_df")
-    if overlay_df is None or len(overlay_df) == 0:
-        return base_df
 
+def base_release(version: int) -> BaseRelease | None:
+    """A retained release by version (None once it aged out)."""
+    return _base_releases.get(version)
+
+
+def get_base_release(state=None) -> BaseRelease:
+    """
+    The base release this session is pinned to. A session keeps seeing one
+    version across reruns until base_reload.sync_session_base() moves it (and
+    remaps its selection); a session without a version is pinned to the newest.
+    """
+    state = _session(state)
+    release = base_release(state.get("base_version"))
+    if release is None:
+        release = current_base_release()
+        state["base_version"] = release.version
+    return release
+
+
+def base_key_index(release: BaseRelease) -> KeyIndex:
+    """Key index of a base release (see key_index.py), built once per version and shared by all sessions."""
+    index = _base_indexes.get(release.version)
+    if index is None or index.base_signature != release.signature:
+        index = KeyIndex.for_base(release.df, release.signature)
+        with _base_lock:
+            if release.version in _base_releases:
+                _base_indexes[release.version] = index
+    return index
+
+
+def load_base_df(path: Path | str | None = None, state=None) -> pd.DataFrame:
+    """
+    Base rows: the session's pinned release (read once per process and
+    version), or a specific release file via `path`.
+    """
+    if path is not None:
+        return read_base_df(path)
+    return get_base_release(state).df.copy(deep=False)
+
+
+# -----------------------------
+# overlay + master (per session)
+# -----------------------------
+def get_overlay_df(state=None) -> pd.DataFrame | None:
+    """
+    Session overlay. A resumed workspace (workspace_store.open_workspace) is
+    loaded from disk here, on first access.
+    """
+    state = _session(state)
+    pending_project = state.pop("workspace_pending_overlay", None)
+    if pending_project:
+        from workspace_store import load_overlay
+
+        state["overlay_df"] = load_overlay(pending_project)
+        state.pop("key_index", None)
+    return state.get("overlay_df")
+
+
+def _normalized_overlay(overlay_df: pd.DataFrame) -> pd.DataFrame:
     overlay_df = overlay_df.copy()
     overlay_df = ensure_required_cols(overlay_df)
     overlay_df = normalize_grouping(overlay_df)
     overlay_df = normalize_ids(overlay_df)
+    overlay_df["__origin__"] = "user"
+    return overlay_df
+
+
+def master_overlay_rows(overlay_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The overlay rows that make it into the master: normalized, last row per key,
+    in overlay order. Pure (no session access), so it can run off the script thread.
+    """
+    overlay_df = _normalized_overlay(overlay_df)
+    if "__row_key__" not in overlay_df.columns:
+        overlay_df["__row_key__"] = [f"NEW:{uuid.uuid4()}" for _ in range(len(overlay_df))]
+    return overlay_df.drop_duplicates(subset=["__row_key__"], keep="last").reset_index(drop=True)
+
+
+def get_key_index(state=None) -> KeyIndex:
+    """
+    Key index of the session's master (key_index.py): the base release's index
+    plus the overlay. Built once per base version / overlay, then kept current
+    by upsert_overlay_from_upload; deletes, undo/redo and resets drop it.
+    """
+    state = _session(state)
+    release = get_base_release(state)
+    overlay_df = get_overlay_df(state)
+    has_overlay = overlay_df is not None and len(overlay_df) > 0 and "__row_key__" in overlay_df.columns
+    n_overlay = len(overlay_df) if has_overlay else 0
+
+    index = state.get("key_index")
+    if index is None or index.base_signature != release.signature or index.overlay_rows != n_overlay:
+        index = base_key_index(release)
+        if has_overlay:
+            index = index.with_overlay(_normalized_overlay(overlay_df))
+        state["key_index"] = index
+    return index
+
+
+def get_master_df(state=None) -> pd.DataFrame:
+    """
+    master = base + overlay
+    overlay wins if same __row_key__ (i.e., same EPIC/PDMS ID)
+    """
+    base_df = load_base_df(state=state)
+
+    overlay_df = get_overlay_df(state)
+    if overlay_df is None or len(overlay_df) == 0:
+        return base_df
+
+    overlay_df = _normalized_overlay(overlay_df)
 
     # overlay must already have __row_key__; if not, we keep it safe
     if "__row_key__" not in overlay_df.columns:
         overlay_df["__row_key__"] = [f"NEW:{uuid.uuid4()}" for _ in range(len(overlay_df))]
+        combined = pd.concat([base_df, overlay_df], ignore_index=True)
+        return combined.drop_duplicates(subset=["__row_key__"], keep="last")
+
+    # the key index already knows which row wins for every key
+    index = get_key_index(state)
+    return pd.concat(
+        [base_df.iloc[index.master_rows(BASE)], overlay_df.iloc[index.master_rows(USER)]],
+        ignore_index=True,
+    )
+
+
+def base_signature(state=None) -> str:
+    """Identifies the session's base release (version + the file it came from)."""
+    return get_base_release(state).signature
+
+
+def master_version(state=None) -> str:
+    """
+    Cheap version token for the current master, without building it:
+    base file signature + (journal id, journal version) of the overlay.
+    Base-only masters share one version across sessions.
+    """
+    overlay_df = get_overlay_df(state)
+    if overlay_df is None or len(overlay_df) == 0:
+        return base_signature(state)
+    journal = get_overlay_journal(state)
+    return f"{base_signature(state)}|{journal.journal_id}:{journal.version}"
+
+
+def master_index_fingerprint(state=None) -> str:
+    """
+    Content fingerprint of the current master, order-sensitive, from the key
+    index's row hashes (no master build or rehash per rerun). Identical masters
+    => identical fingerprints, across sessions.
+    """
+    return get_key_index(state).fingerprint
+
+
+def gather_master_rows(row_keys, state=None) -> pd.DataFrame:
+    """Master rows for `row_keys`, in that order, taken by position via the key index (no master build)."""
+    index = get_key_index(state)
+    overlay_df = get_overlay_df(state)
+    if index.overlay_rows:
+        overlay_df = _normalized_overlay(overlay_df)
+    return index.gather(row_keys, load_base_df(state=state), overlay_df if index.overlay_rows else None)
+
+
+def _update_key_index(overlay_keys: pd.Index, upserts: pd.DataFrame, state=None) -> None:
+    """Apply an overlay upsert to the session's key index (before = overlay keys before the upsert)."""
+    state = _session(state)
+    index = state.get("key_index")
+    if index is None:
+        # not built yet -> get_key_index() will build it lazily
+        return
+    index = index.with_upserts(overlay_keys, upserts)
+    if index is None:
+        state.pop("key_index", None)
+    else:
+        state["key_index"] = index
 
-    overlay_df["__origin__"] = "user"
 
-    combined = pd.concat([base_df, overlay_df], ignore_index=True)
-    combined = combined.drop_duplicates(subset=["__row_key__"], keep="last")
-    return combined
+def get_overlay_journal(state=None) -> OverlayJournal:
+    """
+    Per-session journal of overlay changes (see overlay_journal.py).
+    An overlay that predates the journal becomes its initial snapshot.
+    """
+    state = _session(state)
+    journal = state.get("overlay_journal")
+    if journal is None:
+        journal = OverlayJournal()
+        overlay_df = get_overlay_df(state)
+        if overlay_df is not None and len(overlay_df) > 0:
+            journal.snapshot = overlay_df
+        state["overlay_journal"] = journal
+    return journal
+
+
+def _set_overlay(overlay_df: pd.DataFrame, keys_removed: bool, state=None) -> None:
+    state = _session(state)
+    state["overlay_df"] = overlay_df
+    # master changed -> derived lookups are rebuilt lazily
+    state.pop("leaf_lookup_master", None)
+    if keys_removed:
+        state.pop("key_index", None)
+
+
+def undo_overlay_change(state=None) -> bool:
+    journal = get_overlay_journal(state)
+    if not journal.can_undo():
+        return False
+    version = journal.version
+    _set_overlay(journal.undo(get_overlay_df(state)), keys_removed=True, state=state)
+    _queue_journal_sync(journal, version, state)
+    return True
+
+
+def redo_overlay_change(state=None) -> bool:
+    journal = get_overlay_journal(state)
+    if not journal.can_redo():
+        return False
+    version = journal.version
+    _set_overlay(journal.redo(get_overlay_df(state)), keys_removed=True, state=state)
+    _queue_journal_sync(journal, version, state)
+    return True
+
+
+def clear_overlay(state=None) -> None:
+    """Drop the whole overlay (recorded in the journal, so it can be undone)."""
+    overlay_df = get_overlay_df(state)
+    journal = get_overlay_journal(state)
+    version = journal.version
+    if overlay_df is not None and len(overlay_df) > 0 and "__row_key__" in overlay_df.columns:
+        overlay_df = journal.record("reset", overlay_df, deletes=overlay_df["__row_key__"])
+    _set_overlay(pd.DataFrame() if overlay_df is None else overlay_df, keys_removed=True, state=state)
+    _queue_journal_sync(journal, version, state)
+
+
+def delete_overlay_rows(row_keys, state=None) -> tuple[int, pd.Index]:
+    """
+    Remove overlay rows by __row_key__ (one "delete" entry in the journal, so it
+    can be undone). Base rows are never removed; deleting an overlay row that
+    updated a base row brings the base version back.
 
-def upsert_overlay_from_upload(upload_df: pd.DataFrame) -> tuple[int, int, int, pd.DataFrame]:
+    Returns (overlay rows removed, keys that are no longer in the master at all),
+    the latter being what a selection has to drop.
+    """
+    overlay_df = get_overlay_df(state)
+    if overlay_df is None or len(overlay_df) == 0 or "__row_key__" not in overlay_df.columns:
+        return 0, pd.Index([], dtype=object)
+
+    keys = pd.Index(pd.Series(list(row_keys), dtype=object).astype(str)).unique()
+    overlay_keys = pd.Index(overlay_df["__row_key__"].astype(str))
+    hit = keys[overlay_keys.unique().get_indexer(keys) != -1]
+    if len(hit) == 0:
+        return 0, hit
+
+    journal = get_overlay_journal(state)
+    _set_overlay(journal.record("delete", overlay_df, deletes=hit), keys_removed=True, state=state)
+    _queue_remote_sync(None, state, deletes=hit)
+
+    gone = hit[~base_key_index(get_base_release(state)).contains(hit)]
+    return int(len(hit)), gone
+
+
+def _queue_remote_sync(upserts: pd.DataFrame | None, state, deletes=None) -> None:
+    """Hand an overlay change to the write-behind API sync, if the session turned it on (sync_queue.py)."""
+    project_id = sync_project(_session(state))
+    if project_id:
+        get_sync_queue().enqueue(project_id, upserts=upserts, deletes=deletes)
+
+
+def _queue_journal_sync(journal: OverlayJournal, version: int, state) -> None:
+    """Queue what undo/redo/reset changed since journal `version`: touched keys still in the overlay are upserted, the rest deleted."""
+    if sync_project(_session(state)):
+        changes = journal.changes_since(version, get_overlay_df(state))
+        if changes is not None:
+            _queue_remote_sync(changes[0], state, deletes=changes[1])
+
+
+def upsert_overlay_from_upload(
+    upload_df: pd.DataFrame, op: str = "upload", state=None
+) -> tuple[int, int, int, pd.DataFrame]:
     """
     Import policy:
     - Stable identity ONLY if EPIC ID or PDMS ID exists.
@@ -120,11 +456,13 @@ def upsert_overlay_from_upload(upload_df: pd.DataFrame) -> tuple[int, int, int,
     - If EPIC/PDMS exists AND not present yet => NEW (user_created=True, user_uploaded_at set)
     - If no EPIC/PDMS => ALWAYS NEW (unique key) (user_created=True, user_uploaded_at set)
 
+    Every call is recorded as one delta in the overlay journal (`op` names it)
+    and, with write-behind sync on, queued for the KIM API.
+    `state` defaults to st.session_state (see _session()).
+
     Returns: (added, updated, skipped, processed_df_for_auto_checking)
     """
-    import uuid
-    import pandas as pd
-    import streamlit as st
+    state = _session(state)
 
     upload_df = upload_df.copy()
     upload_df.columns = [str(c).strip() for c in upload_df.columns]
@@ -139,75 +477,52 @@ def upsert_overlay_from_upload(upload_df: pd.DataFrame) -> tuple[int, int, int,
     skipped = int((~valid_mask).sum())
     upload_df = upload_df.loc[valid_mask].copy()
 
-    # -------- build set of existing stable keys (EPIC:/PDMS:) from base + overlay --------
-    base_df = load_base_df()
-    existing_overlay = st.session_state.get("overlay_df")
-
-    existing_stable_keys = set()
-    for k in base_df["__row_key__"].astype(str).tolist():
-        if k.startswith("EPIC:") or k.startswith("PDMS:"):
-            existing_stable_keys.add(k)
-
-    if existing_overlay is not None and len(existing_overlay) > 0 and "__row_key__" in existing_overlay.columns:
-        for k in existing_overlay["__row_key__"].astype(str).tolist():
-            if k.startswith("EPIC:") or k.startswith("PDMS:"):
-                existing_stable_keys.add(k)
-
-    # -------- assign keys + mark new vs update --------
+    # -------- assign keys + mark new vs update (against the key index) --------
+    index = get_key_index(state)
+    existing_overlay = get_overlay_df(state)
     now_iso = pd.Timestamp.now().isoformat(timespec="seconds")
 
-    row_keys = []
-    is_new_flags = []
-
-    for _, row in upload_df.iterrows():
-        stable_key = stable_id_key_from_row(row)
-
-        if stable_key:
-            # If stable key already exists => UPDATE (not user_created)
-            if stable_key in existing_stable_keys:
-                row_keys.append(stable_key)
-                is_new_flags.append(False)
-            else:
-                # NEW stable identity
-                row_keys.append(stable_key)
-                is_new_flags.append(True)
-                existing_stable_keys.add(stable_key)  # avoid counting duplicates within same upload as new twice
-        else:
-            # No IDs => ALWAYS NEW
-            row_keys.append(f"NEW:{uuid.uuid4()}")
-            is_new_flags.append(True)
+    stable = stable_id_keys(upload_df)
+    has_id = (stable != "").to_numpy()
+    # a stable key already in base/overlay => UPDATE; a new one is NEW once
+    # (repeats within the same upload update the row it just added)
+    is_new_flags = ~has_id | (~index.contains(stable) & ~stable.duplicated().to_numpy())
+    # No IDs => ALWAYS NEW
+    row_keys = stable.to_numpy(copy=True)
+    row_keys[~has_id] = [f"NEW:{uuid.uuid4()}" for _ in range(int((~has_id).sum()))]
 
     upload_df["__row_key__"] = row_keys
     upload_df["__origin__"] = "user"
 
     # Only truly new rows are user_created + get uploaded_at
     upload_df["user_created"] = is_new_flags
-    upload_df["user_uploaded_at"] = [now_iso if flag else "" for flag in is_new_flags]
+    upload_df["user_uploaded_at"] = np.where(is_new_flags, now_iso, "").astype(object)
 
     # -------- merge into overlay --------
+    journal = get_overlay_journal(state)
+
     if existing_overlay is None or len(existing_overlay) == 0:
-        st.session_state["overlay_df"] = upload_df
-        added = int(sum(is_new_flags))
+        state["overlay_df"] = journal.record(op, pd.DataFrame(), upserts=upload_df)
+        _update_key_index(pd.Index([], dtype=object), upload_df, state)
+        _queue_remote_sync(upload_df, state)
+        added = int(is_new_flags.sum())
         updated = int(len(upload_df) - added)
         return added, updated, skipped, upload_df
 
-    existing_overlay = existing_overlay.copy()
     if "__row_key__" not in existing_overlay.columns:
+        existing_overlay = existing_overlay.copy()
         existing_overlay["__row_key__"] = [f"NEW:{uuid.uuid4()}" for _ in range(len(existing_overlay))]
-
-    before_keys = set(existing_overlay["__row_key__"].astype(str).tolist())
-    incoming_keys = set(upload_df["__row_key__"].astype(str).tolist())
-
-    updated = 0
-    for k in incoming_keys:
-        if (k.startswith("EPIC:") or k.startswith("PDMS:")) and (k in before_keys):
-            updated += 1
-
-    added = len(incoming_keys - before_keys)
-
-    combined = pd.concat([existing_overlay, upload_df], ignore_index=True)
-    combined = combined.drop_duplicates(subset=["__row_key__"], keep="last")
-
-    st.session_state["overlay_df"] = combined
+        state.pop("key_index", None)  # keys changed under the index
+
+    # counted per key against the overlay: updated = already an overlay row
+    incoming_keys = pd.Index(upload_df["__row_key__"]).unique()
+    in_overlay = index.in_overlay(incoming_keys)
+    updated = int(in_overlay.sum())
+    added = int(len(incoming_keys) - updated)
+
+    overlay_keys = pd.Index(existing_overlay["__row_key__"].astype(str))
+    state["overlay_df"] = journal.record(op, existing_overlay, upserts=upload_df)
+    _update_key_index(overlay_keys, upload_df, state)
+    _queue_remote_sync(upload_df, state)
     return added, updated, skipped, upload_df
 
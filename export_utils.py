@@ -0,0 +1,102 @@
+# export_utils.py
+import gzip
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import Callable, Iterator
+
+import pandas as pd
+
+EXPORT_CHUNK_ROWS = 20_000  # rows fetched + formatted at a time
+SPOOL_MAX_MEMORY = 16 * 1024 * 1024  # bigger exports spill to a temp file
+
+# compression -> (file extension, mime type)
+EXPORT_FORMATS = {
+    None: ("csv", "text/csv"),
+    "gzip": ("csv.gz", "application/gzip"),
+    "zip": ("zip", "application/zip"),
+}
+
+
+def build_export_view(df_selected: pd.DataFrame) -> pd.DataFrame:
+    df_out = df_selected.copy()
+
+    # Hide internal columns
+    df_out = df_out.drop(columns=[c for c in df_out.columns if str(c).startswith("__")], errors="ignore")
+
+    # Ensure provenance columns exist
+    if "user_created" not in df_out.columns:
+        df_out["user_created"] = False
+    if "user_uploaded_at" not in df_out.columns:
+        df_out["user_uploaded_at"] = pd.NA
+
+    # Friendly origin column
+    df_out["Origin"] = "Base"
+    df_out.loc[df_out["user_uploaded_at"].notna(), "Origin"] = "User upload"
+    df_out.loc[df_out["user_created"] == True, "Origin"] = "User created"
+
+    # Visible columns
+    preferred = ["Variable", "Organ System", "Group", "Source", "EPIC ID", "PDMS ID", "Unit", "Origin"]
+    cols = [c for c in preferred if c in df_out.columns]
+
+    # Append other non-provenance columns (optional)
+    hide_these = {"user_created", "user_uploaded_at"}
+    extras = [c for c in df_out.columns if c not in cols and c not in hide_these]
+
+    return df_out[cols + extras]
+
+
+def export_file_name(project_name: str, extension: str = "csv") -> str:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_project = (project_name or "kim_varmap").replace(" ", "_").replace("/", "_").lower()
+    return f"variablemapping_{safe_project}_{timestamp}.{extension}"
+
+
+def iter_export_csv(row_keys: list[str], fetch_rows: Callable[[list[str]], pd.DataFrame], chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    """CSV bytes of the export view, `chunk_rows` rows at a time (header once)."""
+    header = True
+    for start in range(0, len(row_keys), chunk_rows):
+        rows = fetch_rows(row_keys[start : start + chunk_rows])
+        if rows.empty:
+            continue
+        yield build_export_view(rows).to_csv(index=False, header=header).encode("utf-8")
+        header = False
+
+
+def spool_export(
+    row_keys: list[str],
+    fetch_rows: Callable[[list[str]], pd.DataFrame],
+    compression: str | None = None,
+    inner_name: str = "export.csv",
+    chunk_rows: int = EXPORT_CHUNK_ROWS,
+) -> tempfile.SpooledTemporaryFile:
+    """
+    Write the export chunk by chunk into a spooled temp file (in memory up to
+    SPOOL_MAX_MEMORY, on disk beyond), optionally gzip/zip-compressed on the fly.
+    Only one chunk of rows is ever materialized. Returns the file rewound to 0.
+    """
+    if compression not in EXPORT_FORMATS:
+        raise ValueError(f"unknown compression {compression!r}")
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    chunks = iter_export_csv(row_keys, fetch_rows, chunk_rows)
+
+    if compression == "gzip":
+        with gzip.GzipFile(fileobj=spool, mode="wb", compresslevel=6) as out:
+            for chunk in chunks:
+                out.write(chunk)
+    elif compression == "zip":
+        with zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED) as zf, zf.open(inner_name, "w") as out:
+            for chunk in chunks:
+                out.write(chunk)
+    else:
+        for chunk in chunks:
+            spool.write(chunk)
+
+    spool.seek(0)
+    return spool
+
+
+def export_bytes(row_keys: list[str], fetch_rows: Callable[[list[str]], pd.DataFrame], compression: str | None = None, inner_name: str = "export.csv") -> bytes:
+    """spool_export() read back as bytes (what st.download_button needs), temp file removed."""
+    with spool_export(row_keys, fetch_rows, compression=compression, inner_name=inner_name) as spool:
+        return spool.read()
@@ -0,0 +1,186 @@
+# jobs.py
+"""
+Background jobs for heavy operations (upload parsing, tree builds, API calls).
+
+Jobs run on a process-wide thread pool, off the Streamlit script thread.
+Pages submit a job under a key, then poll it on later reruns:
+- identical keys are deduplicated (a rerun re-attaches to the in-flight job)
+- finished jobs keep their result until forgotten or too old
+- workers report progress and can be cancelled cooperatively
+
+Workers must NOT touch st.session_state (there is no script context in a
+worker thread). Read state on the script thread, pass plain data in, and
+apply the result on the script thread once the job is done.
+"""
+import hashlib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import streamlit as st
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    key: str
+    label: str = ""
+    progress: float = 0.0
+    message: str = ""
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+    _future: Future | None = field(default=None, repr=False)
+    _cancel: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    # -----------------------------
+    # called from the worker
+    # -----------------------------
+    def report(self, progress: float, message: str = "") -> None:
+        """Update progress (0..1). Raises JobCancelled if a cancel was requested."""
+        self.progress = max(0.0, min(1.0, float(progress)))
+        if message:
+            self.message = message
+        if self._cancel.is_set():
+            raise JobCancelled(self.key)
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+    # -----------------------------
+    # polled from pages
+    # -----------------------------
+    @property
+    def status(self) -> str:
+        """One of: running, done, failed, cancelled."""
+        if self._future is None or not self._future.done():
+            return "running"
+        if self._future.cancelled() or isinstance(self._future.exception(), JobCancelled):
+            return "cancelled"
+        if self._future.exception() is not None:
+            return "failed"
+        return "done"
+
+    @property
+    def error(self) -> BaseException | None:
+        if self.status in ("failed", "cancelled") and not self._future.cancelled():
+            return self._future.exception()
+        return None
+
+    def result(self, timeout: float | None = None) -> Any:
+        return self._future.result(timeout=timeout)
+
+    def cancel(self) -> None:
+        self._cancel.set()
+        if self._future is not None:
+            self._future.cancel()  # only succeeds if not started yet
+
+
+class JobRunner:
+    def __init__(self, max_workers: int = 4, max_finished: int = 32):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kim-job")
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._max_finished = max_finished
+
+    def submit(
+        self,
+        key: str,
+        fn: Callable[..., Any],
+        *args,
+        label: str = "",
+        max_age: float | None = None,
+        **kwargs,
+    ) -> Job:
+        """
+        Run fn(job, *args, **kwargs) in the background under `key`.
+
+        - same key still running => the running job is returned (no new work)
+        - same key already done => its result is reused, unless older than max_age seconds
+        - failed / cancelled jobs are resubmitted
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                status = job.status
+                if status == "running":
+                    return job
+                is_fresh = max_age is None or (time.time() - (job.finished_at or 0)) <= max_age
+                if status == "done" and is_fresh:
+                    return job
+
+            job = Job(key=key, label=label)
+            job._future = self._executor.submit(self._run, job, fn, args, kwargs)
+            self._jobs[key] = job
+            self._evict_finished()
+            return job
+
+    def get(self, key: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(key)
+
+    def cancel(self, key: str) -> None:
+        job = self.get(key)
+        if job is not None:
+            job.cancel()
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            self._jobs.pop(key, None)
+
+    @staticmethod
+    def _run(job: Job, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        try:
+            result = fn(job, *args, **kwargs)
+            job.progress = 1.0
+            return result
+        finally:
+            job.finished_at = time.time()
+
+    def _evict_finished(self) -> None:
+        finished = [j for j in self._jobs.values() if j.status != "running"]
+        if len(finished) <= self._max_finished:
+            return
+        finished.sort(key=lambda j: j.finished_at or 0)
+        for j in finished[: len(finished) - self._max_finished]:
+            self._jobs.pop(j.key, None)
+
+
+@st.cache_resource
+def get_job_runner() -> JobRunner:
+    """One runner per server process, shared by all sessions."""
+    return JobRunner()
+
+
+def job_key(*parts: Any) -> str:
+    """Deterministic key for a job from its identifying inputs (bytes or reprs)."""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else repr(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def render_job_progress(job: Job, poll_seconds: float = 0.5) -> bool:
+    """
+    Show progress for a running job and rerun the page once it finishes.
+    Returns True if the job is already finished (caller can use the result).
+    """
+    if job.status != "running":
+        return True
+
+    @st.fragment(run_every=poll_seconds)
+    def _poll():
+        if job.status != "running":
+            st.rerun()
+        st.progress(job.progress, text=job.message or job.label or "Working…")
+        if st.button("Cancel", key=f"cancel_job_{job.key}"):
+            job.cancel()
+
+    _poll()
+    return False
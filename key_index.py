@@ -0,0 +1,206 @@
+# key_index.py
+"""
+Key index of a master (base release + session overlay):
+
+    __row_key__ -> (origin, row position in its origin frame, content hash)
+
+The base part is built once per base release and shared by every session on
+it; a session adds its overlay on top, and upserts update the index in place
+of a rebuild (O(upload) hashing + one vectorized position shift over the
+overlay). Everything that needs "is this key in the master / in the overlay",
+"where is its row" or "did the master change" reads it instead of rescanning
+keys:
+- upsert_overlay_from_upload: added/updated classification
+- get_master_df: base rows that survive the overlay, without a drop_duplicates
+- membership checks (selections, tokens, exports) and row gathers (cli.py)
+- master_index_fingerprint: tree cache key without rehashing the master
+
+Rows with the same key keep the last one (like the master merge).
+"""
+import hashlib
+from dataclasses import dataclass, replace
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+KEY_COL = "__row_key__"
+ORIGIN_COL = "__origin__"
+BASE = 0
+USER = 1
+
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _column_multiplier(col: str) -> np.uint64:
+    h = pd.util.hash_array(np.array([col], dtype=object), categorize=False)[0]
+    return np.uint64(h) | np.uint64(1)
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """
+    uint64 content hash per row, over every non-empty column (the key included).
+    Columns are combined by a sum, so the hash doesn't depend on column order or
+    on columns a frame doesn't have: a row hashes the same in its upload and in
+    the overlay it was merged into.
+    """
+    out = np.zeros(len(df), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for col in df.columns:
+            if col == ORIGIN_COL:
+                continue
+            values = df[col].fillna("").astype(str).to_numpy(dtype=object)
+            h = pd.util.hash_array(values, categorize=False) * _column_multiplier(str(col))
+            out += np.where(values != "", h ^ _MIX, np.uint64(0))
+    return out
+
+
+def _last_rows(df: pd.DataFrame) -> tuple[pd.Index, np.ndarray]:
+    """Unique keys of a frame and the position of the last row for each."""
+    keys = df[KEY_COL].astype(str).to_numpy(dtype=object)
+    rows = np.flatnonzero(~pd.Series(keys).duplicated(keep="last").to_numpy())
+    return pd.Index(keys[rows]), rows
+
+
+@dataclass(frozen=True)
+class KeyIndex:
+    keys: pd.Index  # unique __row_key__ values
+    origin: np.ndarray  # BASE / USER per key
+    position: np.ndarray  # row of the key in the base release frame / the overlay frame
+    content: np.ndarray  # row_hashes() of that row
+    columns: tuple[str, ...]  # master columns (base first, then overlay-only ones)
+    base_signature: str  # BaseRelease.signature the base positions refer to
+    overlay_rows: int = 0  # len(overlay frame) the overlay positions refer to
+
+    @classmethod
+    def for_base(cls, base_df: pd.DataFrame, signature: str) -> "KeyIndex":
+        keys, rows = _last_rows(base_df)
+        return cls(
+            keys=keys,
+            origin=np.full(len(keys), BASE, dtype=np.int8),
+            position=rows.astype(np.int64),
+            content=row_hashes(base_df)[rows],
+            columns=tuple(str(c) for c in base_df.columns),
+            base_signature=signature,
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    # -----------------------------
+    # lookups
+    # -----------------------------
+    def locate(self, keys) -> np.ndarray:
+        """Index slot per key (-1 if the key is not in the master)."""
+        return self.keys.get_indexer(pd.Index(pd.Series(list(keys), dtype=object).astype(str)))
+
+    def contains(self, keys) -> np.ndarray:
+        return self.locate(keys) != -1
+
+    def in_overlay(self, keys) -> np.ndarray:
+        """True where the master row for the key comes from the overlay."""
+        slots = self.locate(keys)
+        return (slots != -1) & (self.origin[slots] == USER)
+
+    def gather(self, keys, base_df: pd.DataFrame, overlay_df: pd.DataFrame | None) -> pd.DataFrame:
+        """
+        Master rows for `keys`, in that order (keys not in the master are skipped).
+        base_df / overlay_df are the frames the index was built on.
+        """
+        slots = self.locate(keys)
+        slots = slots[slots != -1]
+        from_base = self.origin[slots] == BASE
+        parts = [base_df.iloc[self.position[slots[from_base]]]]
+        if overlay_df is not None and (~from_base).any():
+            parts.append(overlay_df.iloc[self.position[slots[~from_base]]])
+        rows = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+        # parts are base-then-overlay; put the rows back in key order
+        order = np.concatenate([np.flatnonzero(from_base), np.flatnonzero(~from_base)])
+        return rows.iloc[np.argsort(order, kind="stable")].reset_index(drop=True)
+
+    # -----------------------------
+    # master order
+    # -----------------------------
+    @cached_property
+    def master_order(self) -> np.ndarray:
+        """Index slots in master order: surviving base rows, then overlay rows (each in frame order)."""
+        parts = []
+        for origin in (BASE, USER):
+            slots = np.flatnonzero(self.origin == origin)
+            parts.append(slots[np.argsort(self.position[slots], kind="stable")])
+        return np.concatenate(parts)
+
+    def master_rows(self, origin: int) -> np.ndarray:
+        """Sorted row positions in the base (BASE) / overlay (USER) frame that make up the master."""
+        slots = self.master_order
+        return self.position[slots[self.origin[slots] == origin]]
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """Content fingerprint of the master (row order included), from the stored hashes."""
+        slots = self.master_order
+        h = hashlib.sha1(self.content[slots].tobytes())
+        h.update(self.origin[slots].tobytes())
+        h.update("|".join(sorted(self.columns)).encode("utf-8"))
+        return h.hexdigest()
+
+    # -----------------------------
+    # updates (return a new index)
+    # -----------------------------
+    def _with_rows(self, keys: pd.Index, origin: int, positions: np.ndarray, content: np.ndarray) -> "KeyIndex":
+        """Point `keys` (unique) at rows of the given origin; new keys are appended."""
+        slots = self.keys.get_indexer(keys)
+        known = slots != -1
+        origin_arr, position_arr, content_arr = self.origin.copy(), self.position.copy(), self.content.copy()
+        origin_arr[slots[known]] = origin
+        position_arr[slots[known]] = positions[known]
+        content_arr[slots[known]] = content[known]
+        fresh = ~known
+        return KeyIndex(
+            keys=self.keys.append(keys[fresh]) if fresh.any() else self.keys,
+            origin=np.concatenate([origin_arr, np.full(int(fresh.sum()), origin, dtype=np.int8)]),
+            position=np.concatenate([position_arr, positions[fresh].astype(np.int64)]),
+            content=np.concatenate([content_arr, content[fresh]]),
+            columns=self.columns,
+            base_signature=self.base_signature,
+            overlay_rows=self.overlay_rows,
+        )
+
+    def with_overlay(self, overlay_df: pd.DataFrame) -> "KeyIndex":
+        """This (base) index plus a whole overlay frame."""
+        keys, rows = _last_rows(overlay_df)
+        index = self._with_rows(keys, USER, rows, row_hashes(overlay_df)[rows])
+        columns = tuple(dict.fromkeys(self.columns + tuple(str(c) for c in overlay_df.columns)))
+        return replace(index, columns=columns, overlay_rows=len(overlay_df))
+
+    def with_upserts(self, overlay_keys: pd.Index, upserts: pd.DataFrame) -> "KeyIndex | None":
+        """
+        Index after a keyed upsert into the overlay (OverlayJournal.record: the
+        last upsert row per key replaces the key's overlay row in place, new keys
+        are appended). overlay_keys are the overlay's keys before the upsert.
+        Returns None if this index doesn't describe that overlay (caller rebuilds).
+        """
+        if len(overlay_keys) != self.overlay_rows:
+            return None
+        touched = pd.Index(upserts[KEY_COL].astype(str))
+        # earlier duplicates of a touched key (legacy overlays) are dropped; the key keeps its last row's place
+        removed = overlay_keys.isin(touched) & overlay_keys.duplicated(keep="last")
+        kept_rows = len(overlay_keys) - int(removed.sum())
+
+        # kept overlay rows move up by the number of removed rows before them
+        index = self
+        if removed.any():
+            position = self.position.copy()
+            user = np.flatnonzero(self.origin == USER)
+            position[user] -= np.cumsum(removed)[position[user]]
+            index = replace(self, position=position)
+
+        keys, rows = _last_rows(upserts)
+        in_overlay = keys.isin(overlay_keys)
+        positions = np.empty(len(keys), dtype=np.int64)
+        positions[in_overlay] = index.position[index.keys.get_indexer(keys[in_overlay])]
+        n_new = int((~in_overlay).sum())
+        positions[~in_overlay] = kept_rows + np.arange(n_new, dtype=np.int64)
+        index = index._with_rows(keys, USER, positions, row_hashes(upserts)[rows])
+        columns = tuple(dict.fromkeys(self.columns + tuple(str(c) for c in upserts.columns)))
+        return replace(index, columns=columns, overlay_rows=kept_rows + n_new)
@@ -0,0 +1,312 @@
+# master_query.py
+"""
+Indexed query layer over the master mapping (base + overlay).
+
+The base release is loaded once per process and version into an in-memory
+SQLite table with indexes on the columns we filter by (MasterEngine, shared by
+all sessions). A session's overlay is small: it is layered on top as its own
+table, loaded once per overlay version, and queries resolve "overlay wins on
+the same __row_key__" in SQL. Consumers ask for the rows they need ("rows in
+Organ System X", "rows with EPIC ID in S", one sorted/filtered page, counts
+per group) through MasterQuery instead of pulling the full pandas frame on
+every rerun.
+"""
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+import pandas as pd
+import streamlit as st
+
+from data_store import BASE_RELEASES_KEPT, get_base_release, get_overlay_df, master_overlay_rows, master_version
+
+TABLE = "master"
+INDEXED_COLS = ["__row_key__", "Organ System", "Group", "EPIC ID", "PDMS ID"]
+KEY = "__row_key__"
+KEYSETS_KEPT = 4  # key lists (selections) kept as indexed temp tables for paging
+OVERLAYS_KEPT = 16  # session overlays (per overlay version) kept loaded
+
+
+def _q(col: str) -> str:
+    """Quote a column name for SQL ("Organ System" etc.)."""
+    return '"' + str(col).replace('"', '""') + '"'
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class MasterEngine:
+    """One base release in SQLite, plus the overlay/key-set tables sessions layer on it."""
+
+    def __init__(self, base_df: pd.DataFrame):
+        self.columns = [str(c) for c in base_df.columns]
+        self.base_rows = len(base_df)
+        self.lock = threading.Lock()
+        self._keysets: OrderedDict[str, None] = OrderedDict()
+        self._overlays: OrderedDict[str, list[str]] = OrderedDict()  # table -> its columns
+        # shared across sessions/threads; every access goes through the lock
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+
+        df = base_df.copy(deep=False)
+        df.columns = self.columns
+        df.insert(0, "__pos__", range(len(df)))
+        df.to_sql(TABLE, self.conn, index=False)
+        for col in INDEXED_COLS:
+            if col in self.columns:
+                self.conn.execute(f"CREATE INDEX {_q('idx_' + col)} ON {TABLE} ({_q(col)})")
+        self.conn.commit()
+
+    # the helpers below expect the caller to hold self.lock
+    def overlay_table(self, version: str, load: Callable[[], pd.DataFrame]) -> tuple[str, list[str]]:
+        """Table holding a session overlay version (loaded on first use), and its columns."""
+        name = f"_ov_{_digest(version)}"
+        if name in self._overlays:
+            self._overlays.move_to_end(name)
+            return name, self._overlays[name]
+
+        df = load().copy(deep=False)
+        df.columns = [str(c) for c in df.columns]
+        # overlay rows sort after the base rows, in overlay order
+        df.insert(0, "__pos__", range(self.base_rows, self.base_rows + len(df)))
+        df.to_sql(name, self.conn, index=False)
+        self.conn.execute(f"CREATE INDEX {name}_key ON {name} ({_q(KEY)})")
+        self._overlays[name] = [c for c in df.columns if c != "__pos__"]
+        while len(self._overlays) > OVERLAYS_KEPT:
+            old, _ = self._overlays.popitem(last=False)
+            self.conn.execute(f"DROP TABLE {old}")
+        return name, self._overlays[name]
+
+    def keyset_table(self, values: list[str]) -> str:
+        """
+        Temp table (ord, val) holding `values`, named by their content, so paging
+        through the same selection doesn't reload its keys.
+        """
+        name = f"_keys_{_digest(chr(0).join(values))}"
+        if name in self._keysets:
+            self._keysets.move_to_end(name)
+            return name
+
+        self.conn.execute(f"CREATE TEMP TABLE {name} (ord INTEGER PRIMARY KEY, val TEXT)")
+        self.conn.executemany(f"INSERT INTO {name} VALUES (?, ?)", enumerate(values))
+        self._keysets[name] = None
+        while len(self._keysets) > KEYSETS_KEPT:
+            old, _ = self._keysets.popitem(last=False)
+            self.conn.execute(f"DROP TABLE {old}")
+        return name
+
+
+class MasterQuery:
+    """
+    A session's view of the master: the shared base engine, plus (if the
+    session has one) its overlay version. Cheap to create on every rerun.
+    """
+
+    def __init__(self, engine: MasterEngine, overlay_version: str | None = None, overlay_df: pd.DataFrame | None = None):
+        self._engine = engine
+        self._overlay_version = overlay_version if overlay_df is not None and len(overlay_df) > 0 else None
+        self._overlay_df = overlay_df
+        self._overlay_cols: list[str] | None = None
+
+    @property
+    def columns(self) -> list[str]:
+        if self._overlay_version is None:
+            return list(self._engine.columns)
+        if self._overlay_cols is None:
+            with self._engine.lock:
+                _, self._overlay_cols = self._overlay()
+        return list(dict.fromkeys(self._engine.columns + self._overlay_cols))
+
+    # -----------------------------
+    # helpers (caller holds the engine lock)
+    # -----------------------------
+    def _overlay(self) -> tuple[str, list[str]]:
+        return self._engine.overlay_table(self._overlay_version, lambda: master_overlay_rows(self._overlay_df))
+
+    def _source(self, keys: str | None = None) -> tuple[str, list[str], dict[str, str], str]:
+        """
+        (FROM clause, WHERE conditions, column -> SQL expression, default order)
+        for the session's master, or for the rows of key table `keys` in key order.
+        """
+        base_cols = self._engine.columns
+        if self._overlay_version is None:
+            exprs = {c: f"m.{_q(c)}" for c in base_cols}
+            if keys is None:
+                return f"{TABLE} m", [], exprs, "m.__pos__"
+            # CROSS JOIN keeps the key set as the outer loop (index lookups into master), not a master scan
+            return f"{keys} v CROSS JOIN {TABLE} m ON m.{_q(KEY)} = v.val", [], exprs, "v.ord"
+
+        ov, ov_cols = self._overlay()
+        self._overlay_cols = ov_cols
+        cols = list(dict.fromkeys(base_cols + ov_cols))
+
+        if keys is None:
+            # base rows the overlay doesn't replace, then the overlay rows
+            def select(available):
+                return ", ".join(_q(c) if c in available else f"NULL AS {_q(c)}" for c in cols)
+
+            source = (
+                f"(SELECT {select(base_cols)}, __pos__ FROM {TABLE} WHERE {_q(KEY)} NOT IN (SELECT {_q(KEY)} FROM {ov}) "
+                f"UNION ALL SELECT {select(ov_cols)}, __pos__ FROM {ov}) m"
+            )
+            return source, [], {c: f"m.{_q(c)}" for c in cols}, "m.__pos__"
+
+        # per key: the overlay row if there is one, else the base row
+        source = (
+            f"{keys} v LEFT JOIN {ov} o ON o.{_q(KEY)} = v.val "
+            f"LEFT JOIN {TABLE} b ON o.{_q(KEY)} IS NULL AND b.{_q(KEY)} = v.val"
+        )
+        exprs = {}
+        for c in cols:
+            if c in ov_cols and c in base_cols:
+                exprs[c] = f"(CASE WHEN o.{_q(KEY)} IS NULL THEN b.{_q(c)} ELSE o.{_q(c)} END)"
+            elif c in ov_cols:
+                exprs[c] = f"o.{_q(c)}"
+            else:
+                exprs[c] = f"(CASE WHEN o.{_q(KEY)} IS NULL THEN b.{_q(c)} END)"
+        where = [f"(o.{_q(KEY)} IS NOT NULL OR b.{_q(KEY)} IS NOT NULL)"]
+        return source, where, exprs, "v.ord"
+
+    @staticmethod
+    def _select(exprs: dict[str, str], columns: list[str] | None) -> str:
+        cols = [c for c in (columns or list(exprs)) if c in exprs]
+        return ", ".join(f"{exprs[c]} AS {_q(c)}" for c in cols)
+
+    @staticmethod
+    def _where(conditions: list[str]) -> str:
+        return f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    def _query(self, build: Callable[[str, list[str], dict[str, str], str], tuple[str, tuple]]) -> pd.DataFrame:
+        with self._engine.lock:
+            sql, params = build(*self._source())
+            return pd.read_sql_query(sql, self._engine.conn, params=params)
+
+    def _rows_where_in(self, col: str, values: Iterable, columns: list[str] | None, keep_order: bool) -> pd.DataFrame:
+        """Rows whose `col` is in `values`, via a temp table of values (no SQLite parameter limit)."""
+        values = [str(v) for v in values]
+        if not values or col not in self.columns:
+            return pd.DataFrame(columns=columns or self.columns)
+
+        conn = self._engine.conn
+        with self._engine.lock:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS _vals (ord INTEGER, val TEXT)")
+            conn.execute("DELETE FROM _vals")
+            conn.executemany("INSERT INTO _vals VALUES (?, ?)", enumerate(values))
+            if keep_order:
+                # col is the key: one row per value, in value order
+                source, where, exprs, order = self._source("_vals")
+            else:
+                source, where, exprs, order = self._source()
+                where = where + [f"{exprs[col]} IN (SELECT val FROM _vals)"]
+            df = pd.read_sql_query(f"SELECT {self._select(exprs, columns)} FROM {source}{self._where(where)} ORDER BY {order}", conn)
+            conn.execute("DELETE FROM _vals")
+        return df
+
+    # -----------------------------
+    # public queries
+    # -----------------------------
+    def count(self) -> int:
+        with self._engine.lock:
+            source, where, _, _ = self._source()
+            return int(self._engine.conn.execute(f"SELECT COUNT(*) FROM {source}{self._where(where)}").fetchone()[0])
+
+    def rows_in_organ_system(self, organ_system: str, columns: list[str] | None = None) -> pd.DataFrame:
+        return self._query(
+            lambda source, where, exprs, order: (
+                f"SELECT {self._select(exprs, columns)} FROM {source}"
+                f"{self._where(where + [exprs['Organ System'] + ' = ?'])} ORDER BY {order}",
+                (organ_system,),
+            )
+        )
+
+    def rows_with_epic_ids(self, epic_ids: Iterable[str], columns: list[str] | None = None) -> pd.DataFrame:
+        return self._rows_where_in("EPIC ID", epic_ids, columns, keep_order=False)
+
+    def rows_with_pdms_ids(self, pdms_ids: Iterable[str], columns: list[str] | None = None) -> pd.DataFrame:
+        return self._rows_where_in("PDMS ID", pdms_ids, columns, keep_order=False)
+
+    def rows_with_row_keys(self, row_keys: Iterable[str], columns: list[str] | None = None) -> pd.DataFrame:
+        """Gather rows by __row_key__, in the order the keys were given."""
+        return self._rows_where_in(KEY, row_keys, columns, keep_order=True)
+
+    def page(
+        self,
+        row_keys: Iterable[str] | None = None,
+        filters: dict[str, str] | None = None,
+        sort_by: str | None = None,
+        descending: bool = False,
+        offset: int = 0,
+        limit: int = 50,
+        columns: list[str] | None = None,
+    ) -> tuple[pd.DataFrame, int]:
+        """
+        One page of rows, filtered and sorted in SQLite.
+
+        - row_keys: restrict to these __row_key__ values (kept in their order);
+          None => the whole master in master order
+        - filters: {column: text}, case-insensitive "contains"
+        - sort_by: column to sort by (then by the default order)
+
+        Returns (rows of the page, number of rows matching the filters).
+        """
+        values = None if row_keys is None else [str(v) for v in row_keys]
+        if values is not None and not values:
+            return pd.DataFrame(columns=columns or self.columns), 0
+
+        conn = self._engine.conn
+        with self._engine.lock:
+            if values is None:
+                source, where, exprs, default_order = self._source()
+            else:
+                source, where, exprs, default_order = self._source(self._engine.keyset_table(values))
+
+            params = []
+            for col, text in (filters or {}).items():
+                text = str(text or "").strip()
+                if col in exprs and text:
+                    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                    where = where + [f"CAST({exprs[col]} AS TEXT) LIKE ? ESCAPE '\\'"]
+                    params.append(f"%{escaped}%")
+
+            order = default_order
+            if sort_by in exprs:
+                order = f"{exprs[sort_by]} COLLATE NOCASE {'DESC' if descending else 'ASC'}, {default_order}"
+
+            where_sql = self._where(where)
+            total = int(conn.execute(f"SELECT COUNT(*) FROM {source}{where_sql}", params).fetchone()[0])
+            df = pd.read_sql_query(
+                f"SELECT {self._select(exprs, columns)} FROM {source}{where_sql} ORDER BY {order} LIMIT ? OFFSET ?",
+                conn,
+                params=(*params, int(limit), max(0, int(offset))),
+            )
+        return df, total
+
+    def count_by(self, *group_cols: str) -> pd.DataFrame:
+        """Row counts per group, e.g. count_by("Organ System", "Group") -> [..., "count"]."""
+
+        def build(source, where, exprs, order):
+            select = ", ".join(f"{exprs[c]} AS {_q(c)}" for c in group_cols)
+            groups = ", ".join(_q(c) for c in group_cols)
+            return f"SELECT {select}, COUNT(*) AS count FROM {source}{self._where(where)} GROUP BY {groups} ORDER BY {groups}", ()
+
+        return self._query(build)
+
+
+@st.cache_resource(max_entries=BASE_RELEASES_KEPT + 1)
+def _engine_for(base_signature: str, _base_df: pd.DataFrame) -> MasterEngine:
+    return MasterEngine(_base_df)
+
+
+def get_master_query() -> MasterQuery:
+    """
+    Query view of the session's master: one shared engine per base release,
+    with the session overlay (if any) layered on per overlay version.
+    """
+    release = get_base_release()
+    engine = _engine_for(release.signature, release.df)
+    overlay_df = get_overlay_df()
+    if overlay_df is None or len(overlay_df) == 0:
+        return MasterQuery(engine)
+    return MasterQuery(engine, master_version(), overlay_df)
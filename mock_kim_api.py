@@ -0,0 +1,250 @@
+# mock_kim_api.py
+"""
+Local stand-in for the KIM mapping API (stdlib only, no network needed).
+
+Implements what api_client talks to:
+    GET  /health
+    GET  /v1/mappings?project_id=...
+    POST /v1/mappings:upsert   {"project_id", "client_id", "dry_run", "rows": [...]}
+    POST /v1/mappings:delete   {"project_id", "client_id", "row_keys": [...]}
+
+plus two endpoints for tests and load runs:
+    GET  /_mock/stats          request counters + stored rows per project
+    POST /_mock/config         change latency / error injection / limits at runtime
+
+Run standalone:
+    python mock_kim_api.py --port 8765 --latency-ms 20 --error-rate 0.05
+    KIM_API_BASE_URL=http://127.0.0.1:8765 KIM_API_TOKEN=dev streamlit run streamlit_app.py
+
+or in-process: server = start_mock_server(latency_ms=5); ...; server.shutdown()
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 0.0  # added to every request
+    jitter_ms: float = 0.0  # uniform extra latency in [0, jitter_ms]
+    error_rate: float = 0.0  # share of requests answered with error_status
+    error_status: int = 503
+    max_rows: int = 5000  # rows / row_keys per write request, larger => 413
+    max_body_bytes: int = 20 * 1024 * 1024  # larger => 413
+    token: str = ""  # if set, require "Authorization: Bearer <token>"
+
+
+class MockStore:
+    """project_id -> {row_key: row}; thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._projects: dict[str, dict[str, dict]] = {}
+
+    def rows(self, project_id: str) -> list[dict]:
+        with self._lock:
+            return list(self._projects.get(project_id, {}).values())
+
+    def upsert(self, project_id: str, rows: list[dict]) -> tuple[int, int]:
+        inserted = updated = 0
+        with self._lock:
+            table = self._projects.setdefault(project_id, {})
+            for row in rows:
+                key = str(row.get("row_key") or row.get("__row_key__") or "")
+                if not key:
+                    continue
+                if key in table:
+                    updated += 1
+                else:
+                    inserted += 1
+                table[key] = {**row, "row_key": key}
+        return inserted, updated
+
+    def delete(self, project_id: str, row_keys: list[str]) -> int:
+        with self._lock:
+            table = self._projects.get(project_id, {})
+            return sum(table.pop(str(k), None) is not None for k in row_keys)
+
+    def sizes(self) -> dict[str, int]:
+        with self._lock:
+            return {p: len(t) for p, t in self._projects.items()}
+
+
+class MockKimServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default (5) drops connects under concurrent load => 1s SYN retries
+
+    def __init__(self, address, config: MockConfig):
+        super().__init__(address, _Handler)
+        self.config = config
+        self.store = MockStore()
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "injected_errors": 0, "rejected": 0, "rows_written": 0, "rows_deleted": 0}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, **deltas: int) -> None:
+        with self.stats_lock:
+            for name, delta in deltas.items():
+                self.stats[name] = self.stats.get(name, 0) + delta
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: MockKimServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # keep load runs quiet
+        pass
+
+    # -----------------------------
+    # helpers
+    # -----------------------------
+    def _send(self, status: int, body) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.server.config.max_body_bytes:
+            self.rfile.read(length)
+            return None
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw or b"{}")
+
+    def _preamble(self) -> bool:
+        """Latency, auth and error injection. False => a response was already sent."""
+        cfg = self.server.config
+        self.server.count(requests=1)
+        delay = cfg.latency_ms + random.uniform(0, cfg.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if self.path.startswith("/_mock/"):
+            return True
+        if cfg.token and self.headers.get("Authorization") != f"Bearer {cfg.token}":
+            self.close_connection = True  # the request body is not read
+            self._send(401, {"error": "invalid token"})
+            return False
+        if cfg.error_rate > 0 and random.random() < cfg.error_rate:
+            self.server.count(injected_errors=1)
+            self.close_connection = True
+            self._send(cfg.error_status, {"error": "injected failure"})
+            return False
+        return True
+
+    # -----------------------------
+    # routes
+    # -----------------------------
+    def do_GET(self):
+        if not self._preamble():
+            return
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif url.path == "/v1/mappings":
+            project_id = (parse_qs(url.query).get("project_id") or [""])[0]
+            self._send(200, {"rows": self.server.store.rows(project_id)})
+        elif url.path == "/_mock/stats":
+            with self.server.stats_lock:
+                stats = dict(self.server.stats)
+            self._send(200, {**stats, "projects": self.server.store.sizes(), "config": asdict(self.server.config)})
+        else:
+            self._send(404, {"error": f"unknown path {url.path}"})
+
+    def do_POST(self):
+        if not self._preamble():
+            return
+        path = urlparse(self.path).path
+        try:
+            body = self._read_body()
+        except ValueError:
+            self._send(400, {"error": "body is not valid JSON"})
+            return
+        if body is None:
+            self.server.count(rejected=1)
+            self._send(413, {"error": f"body larger than {self.server.config.max_body_bytes} bytes"})
+            return
+
+        if path == "/_mock/config":
+            for name, value in body.items():
+                if hasattr(self.server.config, name):
+                    setattr(self.server.config, name, type(getattr(self.server.config, name))(value))
+            self._send(200, asdict(self.server.config))
+            return
+
+        project_id = str(body.get("project_id") or "")
+        if path == "/v1/mappings:upsert":
+            rows = body.get("rows") or []
+            if len(rows) > self.server.config.max_rows:
+                self.server.count(rejected=1)
+                self._send(413, {"error": f"at most {self.server.config.max_rows} rows per request"})
+                return
+            if body.get("dry_run"):
+                self._send(200, {"dry_run": True, "rows": len(rows)})
+                return
+            inserted, updated = self.server.store.upsert(project_id, rows)
+            self.server.count(rows_written=inserted + updated)
+            self._send(200, {"inserted": inserted, "updated": updated})
+        elif path == "/v1/mappings:delete":
+            row_keys = body.get("row_keys") or []
+            if len(row_keys) > self.server.config.max_rows:
+                self.server.count(rejected=1)
+                self._send(413, {"error": f"at most {self.server.config.max_rows} row_keys per request"})
+                return
+            deleted = self.server.store.delete(project_id, row_keys)
+            self.server.count(rows_deleted=deleted)
+            self._send(200, {"deleted": deleted})
+        else:
+            self._send(404, {"error": f"unknown path {path}"})
+
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, **config) -> MockKimServer:
+    """Start the mock in a daemon thread (port=0 => any free port, see server.url)."""
+    server = MockKimServer((host, port), MockConfig(**config))
+    threading.Thread(target=server.serve_forever, name="mock-kim-api", daemon=True).start()
+    return server
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the KIM mapping API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--max-rows", type=int, default=5000)
+    parser.add_argument("--token", default="", help="require this bearer token")
+    args = parser.parse_args(argv)
+
+    config = MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        max_rows=args.max_rows,
+        token=args.token,
+    )
+    server = MockKimServer((args.host, args.port), config)
+    print(f"mock KIM API on {server.url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# overlay_journal.py
+"""
+Append-only journal of overlay changes.
+
+Every change (upload upsert, "Add a variable", deletes, reset) is stored as a
+compact delta: the rows it wrote, the keys it removed, and the previous rows
+for the keys it touched. That gives us:
+- replay: overlay = snapshot + applied deltas
+- undo/redo: apply the inverse/forward delta (no replay from the snapshot)
+- delta persistence: changes_since(version) returns only touched rows (the
+  touch log behind it keeps the last TOUCH_LOG_MAX changes; a consumer that
+  falls further behind gets None and saves the whole overlay)
+
+Entries are O(delta) in size. Applying one (record/undo/redo) is a single
+vectorized key filter + concat over the overlay, i.e. O(overlay) but never
+a replay. Undo puts the previous rows back where they were, so the live
+overlay always matches materialize() row for row.
+"""
+import uuid
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+KEY_COL = "__row_key__"
+TOUCH_LOG_MAX = 100  # changes changes_since() can look back over
+
+
+def _keys(df: pd.DataFrame | None) -> pd.Index:
+    if df is None or len(df) == 0 or KEY_COL not in df.columns:
+        return pd.Index([], dtype=object)
+    return pd.Index(df[KEY_COL].astype(str))
+
+
+def _apply(overlay: pd.DataFrame, touched: pd.Index, rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keyed replace: drop all touched keys from overlay, then add rows. A row for
+    a key the overlay had takes the place of its (last) old row; new keys are
+    appended. Updates keep their position, so the order is the same whether a
+    row was updated in memory or in a stored workspace.
+    """
+    if overlay is None or len(overlay) == 0:
+        overlay_keys = pd.Index([], dtype=object)
+        hit = np.zeros(0, dtype=bool)
+        kept = pd.DataFrame()
+    else:
+        overlay_keys = _keys(overlay)
+        hit = overlay_keys.isin(touched)
+        kept = overlay.loc[~hit]
+    if rows is None or len(rows) == 0:
+        return kept.reset_index(drop=True)
+    if not hit.any():
+        return rows.reset_index(drop=True) if len(kept) == 0 else pd.concat([kept, rows], ignore_index=True)
+
+    old_pos = pd.Series(np.flatnonzero(hit), index=overlay_keys[hit])
+    old_pos = old_pos.loc[~old_pos.index.duplicated(keep="last")]
+    slot = np.array(old_pos.reindex(_keys(rows)), dtype=float)
+    new = np.isnan(slot)
+    slot[new] = len(overlay) + np.arange(int(new.sum()))
+    order = np.concatenate([np.flatnonzero(~hit), slot.astype(np.int64)])
+    combined = pd.concat([kept, rows], ignore_index=True) if len(kept) else rows.reset_index(drop=True)
+    return combined.iloc[np.argsort(order, kind="stable")].reset_index(drop=True)
+
+
+def _restore(overlay: pd.DataFrame, touched: pd.Index, rows: pd.DataFrame, positions: np.ndarray) -> pd.DataFrame:
+    """Inverse of the latest _apply: drop touched keys, put `rows` back at their old `positions` (ascending)."""
+    kept = _apply(overlay, touched, None)
+    if rows is None or len(rows) == 0:
+        return kept
+    n = len(kept) + len(rows)
+    restored = np.zeros(n, dtype=bool)
+    restored[positions] = True
+    take = np.empty(n, dtype=np.int64)
+    take[~restored] = np.arange(len(kept))
+    take[restored] = len(kept) + np.arange(len(rows))
+    combined = pd.concat([kept, rows], ignore_index=True) if len(kept) else rows.reset_index(drop=True)
+    return combined.iloc[take].reset_index(drop=True)
+
+
+@dataclass
+class JournalEntry:
+    seq: int
+    op: str  # "upload" | "add_variable" | "delete" | "reset"
+    at: str  # ISO timestamp
+    upserts: pd.DataFrame  # rows written by this change (after-image)
+    deletes: pd.Index  # keys removed by this change
+    before: pd.DataFrame  # overlay rows for all touched keys before the change
+    before_pos: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))  # their positions then
+
+    @property
+    def touched(self) -> pd.Index:
+        return _keys(self.upserts).append(self.deletes).unique()
+
+    def to_record(self) -> dict:
+        """JSON-friendly delta (what gets shipped/persisted)."""
+        return {
+            "seq": self.seq,
+            "op": self.op,
+            "at": self.at,
+            "upserts": self.upserts.to_dict(orient="records"),
+            "deletes": [str(k) for k in self.deletes],
+        }
+
+
+@dataclass
+class OverlayJournal:
+    max_undo: int = 25
+    snapshot: pd.DataFrame = field(default_factory=pd.DataFrame)
+    entries: list[JournalEntry] = field(default_factory=list)
+    cursor: int = 0  # entries[:cursor] are applied, entries[cursor:] can be redone
+    next_seq: int = 1
+    version: int = 0  # bumped on every record/undo/redo
+    journal_id: str = field(default_factory=lambda: uuid.uuid4().hex)  # (journal_id, version) names an overlay state
+    _touch_log: list[tuple[int, pd.Index]] = field(default_factory=list, repr=False)
+    _touch_floor: int = field(default=0, repr=False)  # versions <= this were dropped from the log
+
+    # -----------------------------
+    # write
+    # -----------------------------
+    def record(
+        self,
+        op: str,
+        overlay: pd.DataFrame,
+        upserts: pd.DataFrame | None = None,
+        deletes=None,
+    ) -> pd.DataFrame:
+        """
+        Record one change against the current overlay and return the new overlay.
+        Duplicate keys within `upserts` collapse to the last row.
+        """
+        upserts = pd.DataFrame() if upserts is None else upserts
+        if len(upserts) > 0:
+            upserts = upserts.drop_duplicates(subset=[KEY_COL], keep="last")
+        deletes = pd.Index([] if deletes is None else list(deletes), dtype=object).astype(str).unique()
+
+        touched = _keys(upserts).append(deletes).unique()
+        overlay_keys = _keys(overlay)
+        hit = overlay_keys.isin(touched) if len(overlay_keys) else np.array([], dtype=bool)
+        before = overlay.loc[hit] if len(overlay_keys) else pd.DataFrame()
+
+        entry = JournalEntry(
+            seq=self.next_seq,
+            op=op,
+            at=pd.Timestamp.now().isoformat(timespec="seconds"),
+            upserts=upserts,
+            deletes=deletes,
+            before=before,
+            before_pos=np.flatnonzero(hit),
+        )
+        self.next_seq += 1
+
+        # new change invalidates the redo tail
+        del self.entries[self.cursor :]
+        self.entries.append(entry)
+        self.cursor += 1
+        self._touch(touched)
+        self._maybe_compact()
+
+        return _apply(overlay, touched, upserts)
+
+    # -----------------------------
+    # undo / redo (apply inverse / forward delta)
+    # -----------------------------
+    def can_undo(self) -> bool:
+        return self.cursor > 0
+
+    def can_redo(self) -> bool:
+        return self.cursor < len(self.entries)
+
+    def undo(self, overlay: pd.DataFrame) -> pd.DataFrame:
+        if not self.can_undo():
+            return overlay
+        self.cursor -= 1
+        entry = self.entries[self.cursor]
+        self._touch(entry.touched)
+        return _restore(overlay, entry.touched, entry.before, entry.before_pos)
+
+    def redo(self, overlay: pd.DataFrame) -> pd.DataFrame:
+        if not self.can_redo():
+            return overlay
+        entry = self.entries[self.cursor]
+        self.cursor += 1
+        self._touch(entry.touched)
+        return _apply(overlay, entry.touched, entry.upserts)
+
+    # -----------------------------
+    # replay / compaction
+    # -----------------------------
+    def materialize(self) -> pd.DataFrame:
+        """Rebuild the overlay from the snapshot by replaying all applied deltas."""
+        overlay = self.snapshot
+        for entry in self.entries[: self.cursor]:
+            overlay = _apply(overlay, entry.touched, entry.upserts)
+        return overlay
+
+    def compact(self, keep: int = 0) -> None:
+        """Fold all but the last `keep` applied entries into the snapshot (they can no longer be undone)."""
+        fold = max(0, self.cursor - keep)
+        if fold == 0:
+            return
+        overlay = self.snapshot
+        for entry in self.entries[:fold]:
+            overlay = _apply(overlay, entry.touched, entry.upserts)
+        self.snapshot = overlay
+        del self.entries[:fold]
+        self.cursor -= fold
+
+    def _maybe_compact(self) -> None:
+        # amortized: fold in batches once twice the undo depth has piled up
+        if self.cursor > 2 * self.max_undo:
+            self.compact(keep=self.max_undo)
+
+    # -----------------------------
+    # O(delta) persistence
+    # -----------------------------
+    def _touch(self, keys: pd.Index) -> None:
+        self.version += 1
+        self._touch_log.append((self.version, keys))
+        # bounded even when nothing consumes it (no workspace open)
+        if len(self._touch_log) > 2 * TOUCH_LOG_MAX:
+            self._touch_floor = self._touch_log[-TOUCH_LOG_MAX - 1][0]
+            del self._touch_log[:-TOUCH_LOG_MAX]
+
+    def touched_keys_since(self, version: int) -> pd.Index | None:
+        """Keys touched after `version`; None if the log no longer reaches back that far."""
+        if version < self._touch_floor:
+            return None
+        parts = [keys for v, keys in self._touch_log if v > version]
+        if not parts:
+            return pd.Index([], dtype=object)
+        return parts[0].append(parts[1:]).unique() if len(parts) > 1 else parts[0].unique()
+
+    def changes_since(self, version: int, overlay: pd.DataFrame) -> tuple[pd.DataFrame, pd.Index] | None:
+        """
+        What changed in `overlay` since journal `version`: (rows to upsert, keys
+        to delete), or None if the touch log no longer reaches back to `version`.
+        The result is O(touched keys); finding the rows is one vectorized isin
+        over the overlay keys, i.e. O(overlay), never a diff of the frames.
+        """
+        touched = self.touched_keys_since(version)
+        if touched is None:
+            return None
+        if len(touched) == 0:
+            return pd.DataFrame(), touched
+        overlay_keys = _keys(overlay)
+        rows = overlay.loc[overlay_keys.isin(touched)] if len(overlay_keys) else pd.DataFrame()
+        deleted = touched[~touched.isin(_keys(rows))]
+        return rows, deleted
+
+    def forget_changes_before(self, version: int) -> None:
+        """Drop touch-log entries a persister has already consumed."""
+        self._touch_log = [(v, keys) for v, keys in self._touch_log if v > version]
+        self._touch_floor = max(self._touch_floor, version)
+
+    def export_entries(self, since_seq: int = 0) -> list[dict]:
+        """Applied deltas after `since_seq`, as JSON-friendly records."""
+        return [e.to_record() for e in self.entries[: self.cursor] if e.seq > since_seq]
@@ -1,5 +1,7 @@
 import streamlit as st
 from ui_stepper import render_stepper
+from workspace_store import flush_workspace, list_projects, open_workspace
+from startup import prewarm_in_background
 
 st.set_page_config(
     page_title="KIM VarMap – Overview",
@@ -41,6 +43,23 @@ with right:
 if project_name_input.strip():
     st.session_state["project_name"] = project_name_input.strip()
 
+# resume / create the durable workspace for this project
+project_name = st.session_state.get("project_name", "")
+if project_name and st.session_state.get("workspace_project") != project_name:
+    n_rows, n_sel = open_workspace(project_name)
+    if n_rows or n_sel:
+        st.session_state["workspace_notice"] = (
+            f"Resumed saved workspace: {n_rows} uploaded rows · {n_sel} selected variables"
+        )
+
+workspace_notice = st.session_state.pop("workspace_notice", None)
+if workspace_notice:
+    st.caption(workspace_notice)
+elif not project_name:
+    saved_projects = list_projects()
+    if saved_projects:
+        st.caption("Saved projects: " + ", ".join(saved_projects[:10]))
+
 st.markdown("### How it works")
 st.markdown(
     """
@@ -57,5 +76,9 @@ st.markdown(
 )
 
 st.markdown("---")
- 
+
+flush_workspace()
 st.page_link("pages/2_data_source.py", label="Start →", use_container_width=True)
+
+# the next pages need pandas & co.; import them while the user reads this one
+prewarm_in_background()
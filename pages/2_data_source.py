@@ -1,20 +1,40 @@
-# Test 
-from api_client import api_is_configured, healthcheck
-import streamlit as st
-
-st.write("API configured:", api_is_configured())
-ok, msg = healthcheck()
-st.write("Health:", ok, msg)
-
-
-
+# pages/2_data_source.py
+import re
 
 import streamlit as st
 import pandas as pd
 
+from api_client import (
+    DELETE_CHUNK_SIZE,
+    api_available,
+    api_is_configured,
+    breaker_states,
+    delete_mappings,
+    healthcheck,
+)
 from ui_stepper import render_stepper, render_bottom_nav
-from data_store import get_master_df, upsert_overlay_from_upload
-from tree_utils import build_nodes_and_lookup, compute_row_key_from_df_row
+from tree_utils import reset_tree_widget
+from base_reload import render_base_notice
+from workspace_store import flush_workspace
+from data_store import (
+    clear_overlay,
+    delete_overlay_rows,
+    get_key_index,
+    get_master_df,
+    get_overlay_df,
+    get_overlay_journal,
+    redo_overlay_change,
+    undo_overlay_change,
+)
+from jobs import get_job_runner, job_key, render_job_progress
+from master_query import get_master_query
+from preview_grid import render_preview_grid
+from export_utils import build_export_view
+from conflicts import analyze_conflicts
+from selection_rules import SelectionRule, rule_mask
+from upload_ingest import SUPPORTED_TYPES, combine_validation_reports, merge_parsed_uploads, parse_uploads_job
+from upload_validation import known_units
+from sync_queue import render_dead_letters, render_sync_status, sync_project
 
 
 st.set_page_config(
@@ -25,70 +45,328 @@ st.set_page_config(
 )
 
 render_stepper(current_step=1)
+render_base_notice()
 
 
 # ---------- helpers ----------
+def render_api_status():
+    """KIM API health (probed in the background), open breakers and the optional background sync."""
+    if not api_is_configured():
+        return
+
+    if not api_available():
+        open_groups = {g: s for g, s in breaker_states().items() if s["state"] == "open"}
+        retry_in = max(s["retry_in"] for s in open_groups.values())
+        st.warning(
+            f"KIM API unreachable ({', '.join(open_groups)}) — working in local-only mode. "
+            f"Next retry in {retry_in:.0f}s."
+        )
+    # probe in the background so a slow API never blocks the rerun
+    health_job = get_job_runner().submit("api_healthcheck", lambda job: healthcheck(), label="API health", max_age=30)
+    if health_job.status == "done":
+        ok, msg = health_job.result()
+        st.caption(f"KIM API: {'reachable' if ok else 'not reachable'} ({msg})")
+    else:
+        st.caption("KIM API: checking…")
+
+    # optional write-behind sync: overlay changes are queued and pushed in coalesced batches (sync_queue.py)
+    sync_candidate = st.session_state.get("project_name", "").strip()
+    if sync_candidate:
+        sync_on = st.toggle(
+            f"Sync my changes to KIM project '{sync_candidate}' in the background",
+            value=bool(sync_project()),
+            key="sync_toggle",
+        )
+        st.session_state["sync_project"] = sync_candidate if sync_on else ""  # read back via sync_project()
+        if sync_on:
+            render_sync_status()
+        # rejected changes stay listed even with sync switched off
+        render_dead_letters(sync_candidate)
+
+
 def reset_overlay():
-    st.session_state["overlay_df"] = pd.DataFrame()
+    clear_overlay()
     st.session_state.pop("last_import_summary", None)
+    st.session_state.pop("last_import_files", None)
     st.session_state.pop("last_upload_df", None)
+    st.session_state.pop("last_validation", None)
     st.rerun()
 
 
+def render_undo_redo():
+    journal = get_overlay_journal()
+    if not (journal.can_undo() or journal.can_redo()):
+        return
+
+    undo_col, redo_col, _ = st.columns([1, 1, 6])
+    with undo_col:
+        if st.button("↶ Undo", disabled=not journal.can_undo(), use_container_width=True):
+            undo_overlay_change()
+            st.rerun()
+    with redo_col:
+        if st.button("↷ Redo", disabled=not journal.can_redo(), use_container_width=True):
+            redo_overlay_change()
+            st.rerun()
+
+
 def overlay_is_active() -> bool:
-    overlay_df = st.session_state.get("overlay_df")
+    overlay_df = get_overlay_df()
     return overlay_df is not None and len(overlay_df) > 0
 
 
 def auto_select_processed_rows(processed_df: pd.DataFrame) -> int:
     """
-    After upload, auto-select all processed rows in the tree:
-    - if row exists already -> select that leaf
-    - if row is new -> it is now in master -> select that leaf
+    After upload, auto-select all processed rows in the tree.
+
+    Leaf values are "ROW:<__row_key__>", so this is a direct key join of the
+    processed rows' __row_key__ against the master key index - no tree rebuild.
     """
+    if processed_df is None or processed_df.empty or "__row_key__" not in processed_df.columns:
+        return 0
 
-    # Build fresh nodes/lookup from current master
-    df_master = get_master_df()
-    df_master_for_tree = df_master.drop(
-        columns=[c for c in df_master.columns if str(c).startswith("__")],
-        errors="ignore",
-    )
-    _, leaf_lookup_master = build_nodes_and_lookup(df_master_for_tree)
-    st.session_state["leaf_lookup_master"] = leaf_lookup_master
-
-    # Fast index: row_key -> leaf_value
-    row_key_to_leaf = {}
-    for leaf_value, row_dict in leaf_lookup_master.items():
-        rk = row_dict.get("__row_key__")
-        if rk:
-            row_key_to_leaf[str(rk)] = leaf_value
-
-    # Compute dedup cols exactly like tree_utils does
-    dedup_cols = [c for c in df_master_for_tree.columns if not str(c).startswith("__")]
-
-    checked_set = set(st.session_state.get("checked", []))
-    checked_all_set = set(st.session_state.get("checked_all_list", []))
-
-    matched = 0
-    for _, up_row in processed_df.iterrows():
-        rk = compute_row_key_from_df_row(up_row.to_dict(), dedup_cols)
-        leaf_value = row_key_to_leaf.get(str(rk))
-        if leaf_value:
-            checked_set.add(leaf_value)
-            checked_all_set.add(leaf_value)
-            matched += 1
-
-    st.session_state["checked"] = sorted(list(checked_set))
-    st.session_state["checked_all_list"] = sorted(list(checked_all_set))
+    incoming_keys = pd.Index(processed_df["__row_key__"].astype(str)).unique()
+    matched_keys = incoming_keys[get_key_index().contains(incoming_keys)]
+    new_leaf_values = set("ROW:" + matched_keys)
+
+    checked_set = set(st.session_state.get("checked", [])) | new_leaf_values
+    checked_all_set = set(st.session_state.get("checked_all_list", [])) | new_leaf_values
+
+    st.session_state["checked"] = sorted(checked_set)
+    st.session_state["checked_all_list"] = sorted(checked_all_set)
+
+    # master changed -> let the next page rebuild its lookup lazily
+    st.session_state.pop("leaf_lookup_master", None)
 
     # keep tree clean when navigating
     st.session_state["expanded"] = []
 
-    return matched
+    return len(matched_keys)
+
+
+def apply_parsed_upload(chunks: list, validations: list) -> None:
+    """Merge background-parsed chunks into the overlay (script thread) and auto-select them."""
+    file_summaries, processed_df = merge_parsed_uploads(chunks, validations)
+
+    added = sum(s["Added"] for s in file_summaries)
+    updated = sum(s["Updated"] for s in file_summaries)
+    skipped = sum(s["Skipped"] for s in file_summaries)
+
+    st.session_state["last_import_summary"] = (added, updated, skipped)
+    st.session_state["last_import_files"] = file_summaries
+    st.session_state["last_upload_df"] = processed_df.copy()
+
+    matched = auto_select_processed_rows(processed_df)
+
+    st.success(f"Upload applied ✅ Added: {added} | Updated: {updated} | Skipped: {skipped}")
+    st.info(f"Auto-selected {matched} uploaded rows in the tree.")
+
+
+def review_parsed_upload(chunks: list, validations: list) -> None:
+    """
+    Store the validation report, then run the conflict analysis on the valid rows;
+    apply right away only if there are no conflicts.
+    """
+    errors_df, counts_df = combine_validation_reports(chunks, validations)
+    st.session_state["last_validation"] = {
+        "errors": errors_df,
+        "counts": counts_df,
+        "truncated": any(r.truncated for r in validations),
+        "missing_columns": {label: r.missing_columns for (label, _), r in zip(chunks, validations) if r.missing_columns},
+    }
+
+    valid_parts = [chunk_df.loc[r.valid_mask] for (_, chunk_df), r in zip(chunks, validations)]
+    upload_df = pd.concat(valid_parts, ignore_index=True) if valid_parts else pd.DataFrame()
+    conflict_report = analyze_conflicts(get_master_df(), upload_df)
+    if conflict_report.empty:
+        apply_parsed_upload(chunks, validations)
+    else:
+        st.session_state["pending_upload"] = {
+            "chunks": chunks,
+            "validations": validations,
+            "conflicts": conflict_report,
+        }
+
+
+def render_validation_report() -> None:
+    report = st.session_state.get("last_validation")
+    if not report:
+        return
+    for label, columns in report.get("missing_columns", {}).items():
+        st.error(f"{label}: required column(s) missing: {', '.join(columns)}. Its rows were skipped.")
+    if len(report["counts"]) == 0:
+        return
+
+    counts_df = report["counts"]
+    n_errors = int(counts_df.loc[counts_df["Severity"] == "error", "Rows"].sum())
+    n_warnings = int(counts_df.loc[counts_df["Severity"] == "warning", "Rows"].sum())
+    with st.expander(f"Validation: {n_errors} error(s) (rows skipped) · {n_warnings} warning(s)"):
+        st.dataframe(counts_df, use_container_width=True, hide_index=True)
+        errors_df = report["errors"]
+        if report["truncated"]:
+            st.caption(f"Showing the first {len(errors_df)} issues; the counts above are complete.")
+        st.dataframe(errors_df.head(200), use_container_width=True, hide_index=True)
+        st.download_button(
+            label="Download validation report (CSV)",
+            data=errors_df.to_csv(index=False).encode("utf-8"),
+            file_name="upload_validation_report.csv",
+            mime="text/csv",
+        )
+
+
+def render_pending_upload() -> None:
+    pending = st.session_state.get("pending_upload")
+    if not pending:
+        return
+
+    conflict_report = pending["conflicts"]
+    st.warning(
+        f"The upload has {len(conflict_report)} ID conflict(s) or duplicate(s). "
+        "Review them before applying (later rows win on the same EPIC/PDMS ID)."
+    )
+    st.dataframe(conflict_report, use_container_width=True, hide_index=True)
+
+    apply_col, discard_col, _ = st.columns([1, 1, 6])
+    with apply_col:
+        if st.button("Apply anyway", type="primary", use_container_width=True):
+            st.session_state.pop("pending_upload", None)
+            apply_parsed_upload(pending["chunks"], pending["validations"])
+    with discard_col:
+        if st.button("Discard upload", use_container_width=True):
+            st.session_state.pop("pending_upload", None)
+            st.rerun()
+
+
+def drop_from_selection(row_keys: pd.Index) -> None:
+    """Anti-join the selection against removed keys (one hash lookup per selected leaf)."""
+    if len(row_keys) == 0:
+        return
+    removed_leaves = pd.Index("ROW:" + row_keys)
+    for state_key in ("checked", "checked_all_list"):
+        current = pd.Index(st.session_state.get(state_key, []), dtype=object)
+        st.session_state[state_key] = current[removed_leaves.get_indexer(current) == -1].tolist()
+    reset_tree_widget(st.session_state)
+
+
+def delete_remote_job(job, project_id: str, row_keys: list[str]) -> dict:
+    n_chunks = max(1, -(-len(row_keys) // DELETE_CHUNK_SIZE))
+    acked = []
+
+    def on_chunk(ack):
+        acked.append(ack)
+        job.report(len(acked) / n_chunks, f"{len(acked)}/{n_chunks} chunks acknowledged")
+
+    return delete_mappings(project_id, row_keys, on_chunk=on_chunk)
+
+
+def render_row_removal() -> None:
+    """Remove uploaded rows by key list or filter, locally and optionally in the KIM project."""
+    overlay_df = get_overlay_df()
+    with st.expander("Remove uploaded rows"):
+        by_keys_tab, by_filter_tab = st.tabs(["By key", "By filter"])
+        with by_keys_tab:
+            keys_text = st.text_area(
+                "Row keys (one per line, e.g. EPIC:E-HR-001 or ROW:EPIC:E-HR-001)",
+                key="remove_keys_text",
+                height=120,
+            )
+            listed = [k.strip() for k in keys_text.splitlines() if k.strip()]
+            key_matches = pd.Index([k[len("ROW:"):] if k.startswith("ROW:") else k for k in listed], dtype=object)
+        with by_filter_tab:
+            c1, c2 = st.columns(2)
+            organ_systems = c1.multiselect(
+                "Organ System", sorted(overlay_df["Organ System"].astype(str).unique()), key="remove_os"
+            )
+            groups = c2.multiselect("Group", sorted(overlay_df["Group"].astype(str).unique()), key="remove_group")
+            variable_regex = st.text_input("Variable matches (regex, case-insensitive)", key="remove_regex")
+            rule = SelectionRule(organ_systems=organ_systems, groups=groups, variable_regex=variable_regex.strip())
+            filter_matches = pd.Index([], dtype=object)
+            if organ_systems or groups or rule.variable_regex:
+                try:
+                    filter_matches = pd.Index(overlay_df.loc[rule_mask(overlay_df, rule), "__row_key__"].astype(str))
+                except re.error as exc:
+                    st.error(f"Invalid regex: {exc}")
+
+        to_remove = key_matches.append(filter_matches).unique()
+        overlay_keys = pd.Index(overlay_df["__row_key__"].astype(str)).unique()
+        n_local = int((overlay_keys.get_indexer(to_remove) != -1).sum())
+        st.caption(f"{len(to_remove)} key(s) given · {n_local} match uploaded rows")
+
+        project_id = st.session_state.get("project_name", "")
+        remote = False
+        if api_is_configured() and project_id:
+            remote = st.checkbox(
+                f"Also delete these keys in KIM project '{project_id}'",
+                disabled=not api_available("write"),
+                key="remove_remote",
+            )
+
+        if st.button(f"Remove {n_local} row(s)", disabled=len(to_remove) == 0, key="remove_rows_btn"):
+            removed, gone = delete_overlay_rows(to_remove)
+            drop_from_selection(gone)
+            notice = f"Removed {removed} uploaded row(s); {len(gone)} left the selection."
+            if remote:
+                keys = to_remove.tolist()
+                remote_key = job_key("delete_remote", project_id, keys)
+                get_job_runner().submit(
+                    remote_key, delete_remote_job, project_id, keys, label=f"Deleting {len(keys)} key(s) in KIM"
+                )
+                st.session_state["remote_delete_key"] = remote_key
+            st.session_state["removal_notice"] = notice
+            st.rerun()
+
+
+def render_removal_status() -> None:
+    notice = st.session_state.pop("removal_notice", None)
+    if notice:
+        st.success(notice)
+
+    remote_key = st.session_state.get("remote_delete_key")
+    if remote_key:
+        runner = get_job_runner()
+        job = runner.get(remote_key)
+        if job is None:
+            st.session_state.pop("remote_delete_key", None)
+        elif render_job_progress(job):
+            st.session_state.pop("remote_delete_key", None)
+            runner.forget(remote_key)
+            if job.status == "done":
+                result = job.result()
+                n_failed = len(result["failed_keys"])
+                if n_failed:
+                    st.warning(
+                        f"KIM: {result['deleted']} deleted, {n_failed} key(s) in failed chunks "
+                        f"({sum(not a['ok'] for a in result['chunks'])} of {len(result['chunks'])})."
+                    )
+                else:
+                    st.success(f"KIM: {result['deleted']} deleted in {len(result['chunks'])} chunk(s).")
+            elif job.status == "cancelled":
+                st.warning("Remote delete cancelled; chunks already sent may have been applied.")
+            else:
+                st.error(f"Remote delete failed: {job.error}")
+
+
+def render_last_import() -> None:
+    file_summaries = st.session_state.get("last_import_files") or []
+    if len(file_summaries) > 1:
+        with st.expander("Per-file summary"):
+            st.dataframe(pd.DataFrame(file_summaries), use_container_width=True, hide_index=True)
+
+    processed_df = st.session_state.get("last_upload_df")
+    if processed_df is not None and not processed_df.empty and "__row_key__" in processed_df.columns:
+        with st.expander("Preview uploaded rows"):
+            # the uploaded rows as they are in the master now, paged/sorted/filtered in SQLite
+            render_preview_grid(
+                get_master_query(),
+                processed_df["__row_key__"].astype(str).tolist(),
+                key="upload_preview",
+                view=build_export_view,
+                default_order_label="(upload order)",
+            )
 
 
 # ---------- header ----------
 st.title("Data source")
+render_api_status()
 
 
 # ---------- setup choice ----------
@@ -112,7 +390,7 @@ choice = st.radio(
     label="Mapping option",
     options=[
         "Use standard mapping (recommended)",
-        "Upload custom mapping CSV (optional)",
+        "Upload custom mapping files (optional)",
     ],
     index=default_index,
     label_visibility="collapsed",
@@ -121,7 +399,7 @@ choice = st.radio(
 # Only show dataset status if something "special" happened
 last_summary = st.session_state.get("last_import_summary")
 if has_overlay or last_summary:
-    total_rows = len(get_master_df())
+    total_rows = get_master_query().count()
     if has_overlay:
         st.markdown(
             f"<div class='kim-small-grey'>Current dataset: <b>Base mapping + uploaded overlay</b> · Total rows: <b>{total_rows}</b></div>",
@@ -140,6 +418,8 @@ if has_overlay or last_summary:
             unsafe_allow_html=True,
         )
 
+render_undo_redo()
+
 st.markdown("")
 
 
@@ -159,7 +439,7 @@ if choice.startswith("Use standard"):
 # ---------- option: upload ----------
 else:
     st.markdown(
-        "<div class='kim-small-grey-inline'>Upload a CSV to add/update mappings for this session.</div>",
+        "<div class='kim-small-grey-inline'>Upload one or more CSV/XLSX files (or a ZIP of them) to add/update mappings for this session.</div>",
         unsafe_allow_html=True,
     )
 
@@ -167,8 +447,9 @@ else:
     st.markdown("**Upload rules**")
     st.markdown(
         """
-- **Required:** `Variable` must be present and non-empty  
-- **Supported:** add new variables  
+- **Required:** `Variable` must be present and non-empty (max. 200 characters; IDs max. 64)  
+- **Checked (warnings):** ID format (`E-…` / `P-…`), `Source` is Both/EPIC/PDMS and matches the IDs, known units  
+- **Supported:** add new variables; several files at once; XLSX with one sheet per organ system; ZIP bundles  
 - **Not supported:** deleting base variables; ambiguous updates
 """
     )
@@ -182,33 +463,55 @@ else:
         language="text",
     )
 
-    uploaded_file = st.file_uploader("Upload CSV", type=["csv"], key="upload_master_csv")
-
-    if uploaded_file is not None:
-        try:
-            raw_upload_df = pd.read_csv(uploaded_file)
-
-            added, updated, skipped, processed_df = upsert_overlay_from_upload(raw_upload_df)
-
-            st.session_state["last_import_summary"] = (added, updated, skipped)
-            st.session_state["last_upload_df"] = processed_df.copy()
-
-            matched = auto_select_processed_rows(processed_df)
-
-            st.success(f"Upload applied ✅ Added: {added} | Updated: {updated} | Skipped: {skipped}")
-            st.info(f"Auto-selected {matched} uploaded rows in the tree.")
+    uploaded_files = st.file_uploader(
+        "Upload mapping files (CSV, XLSX or ZIP)",
+        type=SUPPORTED_TYPES,
+        accept_multiple_files=True,
+        key="upload_master_csv",
+    )
 
-            with st.expander("Preview uploaded rows"):
-                st.dataframe(processed_df.head(20), use_container_width=True)
+    if uploaded_files:
+        # file_id is unique per upload => reruns with the same files never re-import
+        upload_key = job_key(
+            "parse_uploads",
+            [(f.name, f.size, getattr(f, "file_id", "")) for f in uploaded_files],
+        )
 
-        except Exception as e:
-            st.error(f"Import failed: {e}")
+        if st.session_state.get("handled_upload_key") != upload_key:
+            runner = get_job_runner()
+            job = runner.get(upload_key)
+            if job is None:
+                files = [(f.name, f.getvalue()) for f in uploaded_files]
+                # units already in this session's mapping (base + overlay) are accepted
+                master_query = get_master_query()
+                units = known_units(master_query.count_by("Unit")["Unit"] if "Unit" in master_query.columns else None)
+                job = runner.submit(upload_key, parse_uploads_job, files, units, label="Parsing uploaded files")
+
+            if render_job_progress(job):
+                runner.forget(upload_key)
+                st.session_state["handled_upload_key"] = upload_key
+                if job.status == "done":
+                    try:
+                        review_parsed_upload(*job.result())
+                    except Exception as e:
+                        st.error(f"Import failed: {e}")
+                elif job.status == "cancelled":
+                    st.warning("Import cancelled.")
+                else:
+                    st.error(f"Import failed: {job.error}")
+
+        render_validation_report()
+        render_pending_upload()
+        render_last_import()
 
     if overlay_is_active():
+        render_row_removal()
         st.markdown("")
         if st.button("Reset upload", use_container_width=False):
             reset_overlay()
+    render_removal_status()
 
 
 st.markdown("---")
+flush_workspace()
 render_bottom_nav(current_step=1)
@@ -1,10 +1,30 @@
 # pages/3_choose_variable.py
+import re
+
+import pandas as pd
 import streamlit as st
 from streamlit_tree_select import tree_select
 
-from tree_utils import build_nodes_and_lookup
-from data_store import get_master_df
+from tree_utils import (
+    build_branch_index,
+    build_nodes_and_lookup,
+    is_bucket,
+    label_nodes_with_counts,
+    materialize_buckets,
+    reconcile_tree_checked,
+    reset_tree_widget,
+    split_large_groups,
+    tree_checked_values,
+    tree_widget_key,
+    update_selected_counts,
+)
+from data_store import get_key_index, get_master_df, master_index_fingerprint
+from jobs import get_job_runner, job_key, render_job_progress
 from ui_stepper import render_stepper, render_bottom_nav
+from base_reload import render_base_notice
+from workspace_store import delete_rule, flush_workspace, save_rule
+from selection_rules import ID_PRESENCE_OPTIONS, SelectionRule, evaluate_rule
+from selection_token import TokenError, decode_selection, encode_selection
 
 
 st.set_page_config(
@@ -14,6 +34,7 @@ st.set_page_config(
 )
 
 render_stepper(current_step=2)
+render_base_notice()
 
 st.title("Choose variables")
 st.markdown("Expand the categories and select the variables you need.")
@@ -31,9 +52,145 @@ if project_name:
 # helpers
 # -----------------------------
 def reset_tree_widget_state():
-    # tree_select stores its internal state under the widget key
-    if "var_tree" in st.session_state:
-        del st.session_state["var_tree"]
+    # tree_select keeps its own state once clicked => a fresh widget under a new key
+    reset_tree_widget(st.session_state)
+
+
+def build_tree(df):
+    """Tree nodes (large groups split into buckets) + lookups, in one background job."""
+    nodes, leaf_lookup = build_nodes_and_lookup(df)
+    nodes, bucket_leaves = split_large_groups(nodes)
+    return (nodes, leaf_lookup, bucket_leaves, *build_branch_index(df, bucket_leaves))
+
+
+def add_to_selection(leaf_values) -> int:
+    """Union leaf values into the selection (one set operation). Returns how many were new."""
+    current = set(st.session_state["checked_all_list"])
+    new_values = set(leaf_values) - current
+    merged = sorted(current | new_values)
+    st.session_state["checked_all_list"] = merged
+    st.session_state["checked"] = merged
+    reset_tree_widget_state()
+    return len(new_values)
+
+
+def unique_values(df, col: str) -> list[str]:
+    if col not in df.columns:
+        return []
+    values = df[col].fillna("").astype(str).str.strip()
+    return sorted(v for v in values.unique() if v)
+
+
+def render_rule_selection(df_master) -> None:
+    saved_rules = st.session_state.setdefault("saved_selection_rules", {})
+    project = st.session_state.get("workspace_project")
+
+    with st.expander("Select by rule"):
+        with st.form("selection_rule_form"):
+            c1, c2 = st.columns(2)
+            with c1:
+                organ_systems = st.multiselect("Organ System", unique_values(df_master, "Organ System"))
+                groups = st.multiselect("Group", unique_values(df_master, "Group"))
+                sources = st.multiselect("Source", unique_values(df_master, "Source"))
+                units = st.multiselect("Unit", unique_values(df_master, "Unit"))
+            with c2:
+                epic_id = st.radio("EPIC ID", ID_PRESENCE_OPTIONS, horizontal=True)
+                pdms_id = st.radio("PDMS ID", ID_PRESENCE_OPTIONS, horizontal=True)
+                has_unit = st.checkbox("Only variables with a unit")
+                variable_regex = st.text_input("Variable matches (regex, case-insensitive)", placeholder="e.g. creat|urea")
+                rule_name = st.text_input("Save as (optional)", placeholder="e.g. EPIC-only renal labs")
+            submitted = st.form_submit_button("Add matches to selection")
+
+        if submitted:
+            rule = SelectionRule(
+                name=rule_name.strip(),
+                organ_systems=organ_systems,
+                groups=groups,
+                sources=sources,
+                units=units,
+                has_unit=has_unit,
+                epic_id=epic_id,
+                pdms_id=pdms_id,
+                variable_regex=variable_regex.strip(),
+            )
+            try:
+                matches = evaluate_rule(df_master, rule)
+            except re.error as exc:
+                st.error(f"Invalid regex: {exc}")
+            else:
+                if rule.name:
+                    saved_rules[rule.name] = rule.to_dict()
+                    if project:
+                        save_rule(project, rule.name, rule.to_dict())
+                added = add_to_selection(matches)
+                st.session_state["rule_notice"] = f"{len(matches)} variables match · {added} newly selected"
+                st.rerun()
+
+        notice = st.session_state.pop("rule_notice", None)
+        if notice:
+            st.success(notice)
+
+        if saved_rules:
+            st.markdown("**Saved rules** (re-apply after uploads to pick up new rows)")
+        for name, rule_dict in list(saved_rules.items()):
+            rule = SelectionRule.from_dict(rule_dict)
+            text_col, apply_col, delete_col = st.columns([6, 1, 1])
+            text_col.markdown(f"**{name}** — {rule.describe()}")
+            if apply_col.button("Apply", key=f"apply_rule_{name}", use_container_width=True):
+                matches = evaluate_rule(df_master, rule)
+                added = add_to_selection(matches)
+                st.session_state["rule_notice"] = f"{name}: {len(matches)} variables match · {added} newly selected"
+                st.rerun()
+            if delete_col.button("Delete", key=f"delete_rule_{name}", use_container_width=True):
+                saved_rules.pop(name, None)
+                if project:
+                    delete_rule(project, name)
+                st.rerun()
+
+
+def apply_selection_token(token: str, replace: bool) -> str:
+    """Decode a token into the selection; returns a notice (raises TokenError)."""
+    leaves = pd.Index(decode_selection(token))
+    known = leaves[get_key_index().contains(leaves.str.removeprefix("ROW:"))]
+    missing = len(leaves) - len(known)
+    if replace:
+        st.session_state["checked_all_list"] = []
+    added = add_to_selection(known)
+    notice = f"Selection restored: {len(known)} variables ({added} new)"
+    if missing:
+        notice += f" · {missing} not in the current data (e.g. rows from someone else's upload)"
+    return notice
+
+
+def render_selection_sharing() -> None:
+    with st.expander("Share / restore selection"):
+        checked = st.session_state["checked_all_list"]
+        if st.button(f"Create token for {len(checked)} selected variables", disabled=not checked):
+            st.session_state["selection_token"] = encode_selection(checked)
+        token = st.session_state.get("selection_token")
+        if token:
+            st.code(token, language="text", wrap_lines=True)
+            page_url = st.context.url.split("?")[0] if st.context.url else ""
+            if page_url:
+                st.caption(f"Link: {page_url}?sel={token}" if len(token) < 1800 else "Token too long for a link; share the file instead.")
+            st.download_button(
+                "Download token file",
+                data=token,
+                file_name=f"selection_{(project_name or 'kimvarmap').replace(' ', '_').lower()}.kimsel",
+                mime="text/plain",
+            )
+
+        st.markdown("**Restore**")
+        pasted = st.text_input("Paste a token", key="restore_token_text")
+        token_file = st.file_uploader("…or upload a token file", type=["kimsel", "txt"], key="restore_token_file")
+        replace = st.radio("Mode", ["Add to current selection", "Replace current selection"], horizontal=True) != "Add to current selection"
+        incoming = token_file.getvalue().decode("utf-8", errors="replace") if token_file else pasted
+        if st.button("Restore selection", disabled=not incoming.strip()):
+            try:
+                st.session_state["token_notice"] = apply_selection_token(incoming, replace)
+                st.rerun()
+            except TokenError as exc:
+                st.error(f"Could not restore: {exc}")
 
 
 def compute_all_expand_values(tree_nodes):
@@ -41,7 +198,8 @@ def compute_all_expand_values(tree_nodes):
 
     def walk(node_list):
         for node in node_list:
-            if isinstance(node, dict) and node.get("children"):
+            # buckets stay closed: opening one materializes its leaves
+            if isinstance(node, dict) and node.get("children") and not is_bucket(node.get("value")):
                 expanded_values.add(node.get("value"))
                 walk(node.get("children", []))
 
@@ -107,13 +265,32 @@ if "expanded" not in st.session_state:
 st.session_state["checked_all_list"] = normalize_checked_values_to_row_format(st.session_state["checked_all_list"])
 st.session_state["checked"] = normalize_checked_values_to_row_format(st.session_state["checked"])
 
+# a shared link (?sel=<token>) restores that selection once
+shared_token = st.query_params.get("sel")
+if shared_token:
+    del st.query_params["sel"]
+    try:
+        st.session_state["token_notice"] = apply_selection_token(shared_token, replace=True)
+    except TokenError as exc:
+        st.error(f"Could not restore the shared selection: {exc}")
+
 
 # -----------------------------
 # load + build tree
 # IMPORTANT: do NOT drop __row_key__ anymore
 # -----------------------------
 df_master = get_master_df()
-nodes, leaf_lookup_master = build_nodes_and_lookup(df_master)
+
+# build in the background; identical masters (any session) share one build
+tree_key = job_key("build_tree_with_buckets", master_index_fingerprint())
+tree_job = get_job_runner().submit(
+    tree_key,
+    lambda job: build_tree(df_master),
+    label="Building variable tree",
+)
+if not render_job_progress(tree_job):
+    st.stop()
+nodes, leaf_lookup_master, bucket_leaves, branch_totals, leaf_branches = tree_job.result()
 
 # store lookup for other pages if they still rely on it
 st.session_state["leaf_lookup_master"] = leaf_lookup_master
@@ -139,26 +316,86 @@ with ctrl_cols[1]:
         st.rerun()
 
 
+# -----------------------------
+# branch counts (totals per master version, selected counts from the delta)
+# -----------------------------
+# the tree widget's latest value is already in session state at the start of the rerun;
+# it only covers what that widget rendered (see tree_render below)
+tree_render = st.session_state.get("tree_render") or {}
+widget_value = st.session_state.get(tree_widget_key(st.session_state))
+if isinstance(widget_value, dict) and tree_render.get("tree") == tree_key:
+    if widget_value.get("checked") is not None:
+        reconciled = reconcile_tree_checked(
+            st.session_state["checked_all_list"],
+            widget_value["checked"],
+            bucket_leaves,
+            leaf_branches,
+            tree_render["open"],
+            tree_render["placeholders"],
+        )
+        st.session_state["checked_all_list"] = normalize_checked_values_to_row_format(reconciled)
+    if widget_value.get("expanded") is not None:
+        st.session_state["expanded"] = widget_value["expanded"]
+
+current_checked = set(st.session_state["checked_all_list"])
+if st.session_state.get("branch_counts_tree") != tree_key:
+    # new master/tree => count the whole selection once
+    st.session_state["branch_counts_tree"] = tree_key
+    st.session_state["branch_counts_basis"] = set()
+    st.session_state["branch_selected_counts"] = {}
+
+counted = st.session_state["branch_counts_basis"]
+branch_selected_counts = update_selected_counts(
+    st.session_state["branch_selected_counts"],
+    leaf_branches,
+    added=current_checked - counted,
+    removed=counted - current_checked,
+)
+st.session_state["branch_counts_basis"] = current_checked
+
+labeled_nodes = label_nodes_with_counts(nodes, branch_totals, branch_selected_counts)
+
+
+# -----------------------------
+# selection by rule / shared token
+# -----------------------------
+render_rule_selection(df_master)
+render_selection_sharing()
+
+token_notice = st.session_state.pop("token_notice", None)
+if token_notice:
+    st.success(token_notice)
+
+
 # -----------------------------
 # tree
 # -----------------------------
+# only open buckets get their leaves; a different set (or tree) needs a fresh widget
+open_buckets = {v for v in st.session_state["expanded"] if v in bucket_leaves}
+if tree_render.get("tree") != tree_key or tree_render.get("open") != open_buckets:
+    reset_tree_widget_state()
+
+tree_checked = tree_checked_values(
+    st.session_state["checked_all_list"], leaf_branches, branch_totals, branch_selected_counts, open_buckets
+)
+st.session_state["tree_render"] = {
+    "tree": tree_key,
+    "open": open_buckets,
+    "placeholders": {v for v in tree_checked if is_bucket(v)},
+}
+
 selected = tree_select(
-    nodes,
-    checked=st.session_state["checked_all_list"],
+    materialize_buckets(labeled_nodes, bucket_leaves, open_buckets),
+    checked=tree_checked,
     expanded=st.session_state["expanded"],
-    key="var_tree",
+    key=tree_widget_key(st.session_state),
 )
 
-checked_now = selected.get("checked", [])
-expanded_now = selected.get("expanded", [])
-
-# normalize checked output too (defensive)
-checked_now_normalized = normalize_checked_values_to_row_format(checked_now)
-
-st.session_state["checked_all_list"] = checked_now_normalized
-st.session_state["checked"] = checked_now_normalized  # used by export
-st.session_state["expanded"] = expanded_now
+# the selection itself was reconciled from the widget value at the top of the rerun
+st.session_state["checked"] = st.session_state["checked_all_list"]  # used by export
+st.session_state["expanded"] = selected.get("expanded", [])
 
 
 st.markdown("---")
+flush_workspace()
 render_bottom_nav(current_step=2)
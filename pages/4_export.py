@@ -1,11 +1,14 @@
 # pages/4_export.py
 import pandas as pd
 import streamlit as st
-from datetime import datetime
 
 from ui_stepper import render_stepper, render_bottom_nav
-from data_store import get_master_df, upsert_overlay_from_upload
-from tree_utils import build_nodes_and_lookup
+from base_reload import render_base_notice
+from workspace_store import flush_workspace
+from data_store import get_key_index, upsert_overlay_from_upload
+from export_utils import EXPORT_FORMATS, build_export_view, export_bytes, export_file_name
+from master_query import get_master_query
+from preview_grid import render_preview_grid
 
 
 st.set_page_config(
@@ -16,9 +19,10 @@ st.set_page_config(
 )
 
 render_stepper(current_step=3)
+render_base_notice()
 
 st.title("Export")
-st.markdown("Review your selected variables and download them as a CSV.")
+st.markdown("Review your selected variables and download them as CSV (optionally compressed).")
 
 project_name = st.session_state.get("project_name", "").strip()
 if project_name:
@@ -28,20 +32,6 @@ if project_name:
 # -----------------------------
 # helpers
 # -----------------------------
-def refresh_master_lookup():
-    """
-    Rebuild a lookup from the current master df.
-
-    IMPORTANT:
-    - With the updated tree_utils.py, build_nodes_and_lookup requires __row_key__.
-    - Do NOT drop __ columns here anymore.
-    """
-    df_master = get_master_df()
-    _, leaf_lookup_master = build_nodes_and_lookup(df_master)
-    st.session_state["leaf_lookup_master"] = leaf_lookup_master
-    return leaf_lookup_master
-
-
 def normalize_checked_values_to_row_format(checked_values: list) -> list[str]:
     """
     Convert any legacy leaf values to the new stable format.
@@ -79,34 +69,6 @@ def normalize_checked_values_to_row_format(checked_values: list) -> list[str]:
     return out
 
 
-def build_export_view(df_selected: pd.DataFrame) -> pd.DataFrame:
-    df_out = df_selected.copy()
-
-    # Hide internal columns
-    df_out = df_out.drop(columns=[c for c in df_out.columns if str(c).startswith("__")], errors="ignore")
-
-    # Ensure provenance columns exist
-    if "user_created" not in df_out.columns:
-        df_out["user_created"] = False
-    if "user_uploaded_at" not in df_out.columns:
-        df_out["user_uploaded_at"] = pd.NA
-
-    # Friendly origin column
-    df_out["Origin"] = "Base"
-    df_out.loc[df_out["user_uploaded_at"].notna(), "Origin"] = "User upload"
-    df_out.loc[df_out["user_created"] == True, "Origin"] = "User created"
-
-    # Visible columns
-    preferred = ["Variable", "Organ System", "Group", "Source", "EPIC ID", "PDMS ID", "Unit", "Origin"]
-    cols = [c for c in preferred if c in df_out.columns]
-
-    # Append other non-provenance columns (optional)
-    hide_these = {"user_created", "user_uploaded_at"}
-    extras = [c for c in df_out.columns if c not in cols and c not in hide_these]
-
-    return df_out[cols + extras]
-
-
 # -----------------------------
 # ensure state keys exist
 # -----------------------------
@@ -120,41 +82,46 @@ st.session_state["checked"] = normalize_checked_values_to_row_format(st.session_
 st.session_state["checked_all_list"] = normalize_checked_values_to_row_format(st.session_state["checked_all_list"])
 
 
-# -----------------------------
-# Ensure lookup exists even if user jumps directly to Export
-# -----------------------------
-leaf_lookup_master = st.session_state.get("leaf_lookup_master")
-if not leaf_lookup_master:
-    leaf_lookup_master = refresh_master_lookup()
-
-
 # -----------------------------
 # Selected variables
+# (indexed gather by __row_key__; no tree/lookup build needed here)
 # -----------------------------
 checked = st.session_state.get("checked", [])
-selected_rows = [leaf_lookup_master[v] for v in checked if v in leaf_lookup_master]
+selected_keys = pd.Index([v[len("ROW:"):] for v in checked], dtype=object)
+# keys no longer in the master (deleted overlay rows, older releases) drop out here
+selected_keys = selected_keys[get_key_index().contains(selected_keys)].tolist()
+master_query = get_master_query()
 
 st.subheader("Selected variables")
 
-if not selected_rows:
+if not selected_keys:
     st.info("No variables selected yet. Go to **Choose variables** and select some items.")
 else:
-    selected_df_raw = pd.DataFrame(selected_rows)
-    export_view = build_export_view(selected_df_raw)
-
-    st.dataframe(export_view, use_container_width=True, hide_index=True)
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_project = (project_name or "kim_varmap").replace(" ", "_").replace("/", "_").lower()
-    file_name = f"variablemapping_{safe_project}_{timestamp}.csv"
+    # paged in SQLite: only the visible page is fetched; the file is built separately on download
+    render_preview_grid(
+        master_query, selected_keys, key="export_preview", view=build_export_view, default_order_label="(selection order)"
+    )
 
-    csv_bytes = export_view.to_csv(index=False).encode("utf-8")
+    compression = st.radio(
+        "Format",
+        options=[None, "gzip", "zip"],
+        format_func={None: "CSV", "gzip": "CSV (gzip)", "zip": "ZIP"}.get,
+        horizontal=True,
+    )
+    extension, mime = EXPORT_FORMATS[compression]
+    file_name = export_file_name(project_name, extension)
 
+    # built on click, off the script thread, chunk by chunk into a spooled temp file
     st.download_button(
-        label="Download CSV",
-        data=csv_bytes,
+        label="Download",
+        data=lambda: export_bytes(
+            selected_keys,
+            master_query.rows_with_row_keys,
+            compression=compression,
+            inner_name=export_file_name(project_name),
+        ),
         file_name=file_name,
-        mime="text/csv",
+        mime=mime,
     )
 
 st.markdown("---")
@@ -204,7 +171,7 @@ if submitted:
         }
 
         upload_df = pd.DataFrame([new_row])
-        added, updated, skipped, processed_df = upsert_overlay_from_upload(upload_df)
+        added, updated, skipped, processed_df = upsert_overlay_from_upload(upload_df, op="add_variable")
 
         if processed_df is None or processed_df.empty or "__row_key__" not in processed_df.columns:
             st.warning("Variable added, but could not determine row key for auto-selection.")
@@ -221,11 +188,12 @@ if submitted:
             st.session_state["checked"] = sorted(checked_set)
             st.session_state["checked_all_list"] = sorted(checked_all_set)
 
-            # refresh lookup so it appears immediately
-            refresh_master_lookup()
+            # master changed -> lookup is rebuilt on the rerun
+            st.session_state.pop("leaf_lookup_master", None)
 
             st.success("Variable added and selected.")
             st.rerun()
 
 st.markdown("---")
+flush_workspace()
 render_bottom_nav(current_step=3)
@@ -0,0 +1,80 @@
+# preview_grid.py
+"""
+Paged preview of master rows, with sorting and column filters evaluated in
+SQLite (MasterQuery.page). Each rerun sends one page to the browser, so a
+100k-row selection previews like a 100-row one. The grid is a fragment:
+paging, sorting and filtering rerun only the grid, not the page.
+"""
+import math
+from typing import Callable
+
+import pandas as pd
+import streamlit as st
+
+from master_query import MasterQuery
+
+FILTER_COLS = ["Variable", "Organ System", "Group", "Source", "EPIC ID", "PDMS ID", "Unit"]
+PAGE_SIZES = [25, 50, 100, 250]
+DEFAULT_ORDER = "(default order)"
+
+
+def render_preview_grid(
+    query: MasterQuery,
+    row_keys: list[str] | None,
+    key: str,
+    view: Callable[[pd.DataFrame], pd.DataFrame] | None = None,
+    default_order_label: str = DEFAULT_ORDER,
+) -> None:
+    """
+    row_keys: the rows to page through, in this order (None => the whole master).
+    view: applied to each page before display (e.g. export_utils.build_export_view).
+    Widget state lives under `key`-prefixed session keys.
+    """
+    filter_cols = [c for c in FILTER_COLS if c in query.columns]
+
+    @st.fragment
+    def _grid():
+        with st.expander("Filter columns"):
+            cols = st.columns(min(4, len(filter_cols)) or 1)
+            filters = {
+                col: cols[i % len(cols)].text_input(col, key=f"{key}_filter_{col}", placeholder="contains…")
+                for i, col in enumerate(filter_cols)
+            }
+
+        c_sort, c_desc, c_size, c_page = st.columns([3, 1, 1, 1])
+        sort_by = c_sort.selectbox("Sort by", [default_order_label] + filter_cols, key=f"{key}_sort")
+        descending = c_desc.toggle("Descending", key=f"{key}_desc", disabled=sort_by == default_order_label)
+        page_size = c_size.selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_size")
+
+        # a different filter/sort/size starts again at page 1
+        signature = (tuple(filters.items()), sort_by, descending, page_size)
+        if st.session_state.get(f"{key}_signature") != signature:
+            st.session_state[f"{key}_signature"] = signature
+            st.session_state[f"{key}_page"] = 1
+        page_no = c_page.number_input("Page", min_value=1, step=1, key=f"{key}_page")
+
+        def fetch(page: int) -> tuple[pd.DataFrame, int]:
+            return query.page(
+                row_keys,
+                filters=filters,
+                sort_by=None if sort_by == default_order_label else sort_by,
+                descending=descending,
+                offset=(page - 1) * page_size,
+                limit=page_size,
+            )
+
+        rows, total = fetch(int(page_no))
+        n_pages = max(1, math.ceil(total / page_size))
+        if page_no > n_pages:
+            page_no = n_pages
+            rows, total = fetch(page_no)
+
+        st.dataframe(view(rows) if view else rows, use_container_width=True, hide_index=True)
+        first = (page_no - 1) * page_size + 1 if total else 0
+        last = min(total, page_no * page_size)
+        filtered = any(str(v).strip() for v in filters.values())
+        st.caption(
+            f"Rows {first:,}–{last:,} of {total:,}{' matching the filters' if filtered else ''} · page {page_no:,} of {n_pages:,}"
+        )
+
+    _grid()
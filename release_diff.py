@@ -0,0 +1,292 @@
+# release_diff.py
+"""
+Diff between two base mapping releases (clinical_variable_mapping_*.csv).
+
+Rows are paired in passes, each a vectorized join on the rows still unpaired:
+1. same stable key (EPIC:/PDMS:)
+2. ID-less rows: same Variable / Organ System / Group / Source (n-th occurrence)
+3. re-keyed rows: same PDMS ID, then same EPIC ID (e.g. an EPIC ID was added)
+4. ID-less rows that moved: same Variable / Source (n-th occurrence)
+
+Paired rows are compared by a per-row content hash; only rows whose hash
+differs get a per-column comparison. Every row ends up as exactly one of
+added / removed / modified / moved / unchanged, and the (old key -> new key)
+pairs remap saved "ROW:" selections onto the new release.
+
+    python release_diff.py old.csv new.csv --out diff.csv
+    python release_diff.py old.csv new.csv --remap-keys selection.txt --remapped new_selection.txt
+    python release_diff.py old.csv new.csv --remap-token ks1....   # prints the token for the new release
+"""
+import argparse
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from data_store import load_base_df
+
+KEY_COL = "__row_key__"
+INTERNAL_COLS = [KEY_COL, "__origin__"]
+GROUP_COLS = ["Organ System", "Group"]
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+MOVED = "moved"
+UNCHANGED = "unchanged"
+
+DIFF_COLS = [
+    "Change", "Old key", "New key", "Variable",
+    "Old Organ System", "Old Group", "New Organ System", "New Group", "Changed columns",
+]
+
+
+@dataclass
+class ReleaseDiff:
+    changes: pd.DataFrame  # one row per old/new row, DIFF_COLS (unchanged rows included)
+    key_map: pd.Series  # old __row_key__ -> new __row_key__ for every paired row
+
+    def summary(self) -> dict[str, int]:
+        counts = self.changes["Change"].value_counts()
+        return {c: int(counts.get(c, 0)) for c in [ADDED, REMOVED, MODIFIED, MOVED, UNCHANGED]}
+
+    def changed(self) -> pd.DataFrame:
+        return self.changes.loc[self.changes["Change"] != UNCHANGED].reset_index(drop=True)
+
+
+def _text(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_string_dtype(values) and not values.hasnans:
+        return values
+    return values.fillna("").astype(str)
+
+
+def _occurrence_key(df: pd.DataFrame, cols: list[str], rows: pd.Series) -> pd.Series:
+    """
+    For `rows` (a mask): cols joined + "#n" (n-th row with these values), so
+    repeated rows pair up in order. Other rows get "" (never matched).
+    """
+    sub = df.loc[rows, cols]
+    out = pd.Series("", index=df.index, dtype=object)
+    if len(sub) == 0:
+        return out
+    key = _text(sub[cols[0]])
+    for col in cols[1:]:
+        key = key + "\x1f" + _text(sub[col])
+    out.loc[rows] = (key + "#" + key.groupby(key, sort=False).cumcount().astype(str)).to_numpy()
+    return out
+
+
+def content_hash(df: pd.DataFrame, cols: list[str]) -> np.ndarray:
+    """uint64 hash per row over `cols` (missing values hash like "")."""
+    # hash_array on plain object arrays is several times faster than
+    # hash_pandas_object on arrow strings (which factorizes every column)
+    row_hash = np.zeros(len(df), dtype=np.uint64)
+    for col in cols:
+        values = _text(df[col]) if col in df.columns else pd.Series("", index=df.index)
+        col_hash = pd.util.hash_array(values.to_numpy(dtype=object), categorize=False)
+        row_hash = (row_hash * np.uint64(1_000_003)) ^ col_hash
+    return row_hash
+
+
+def _pair(old: pd.DataFrame, new: pd.DataFrame, old_key: pd.Series, new_key: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """Positions (old, new) of rows whose match keys are equal (first occurrence on either side, "" never matches)."""
+    old_key = old_key.loc[old_key != ""].drop_duplicates()
+    new_key = new_key.loc[new_key != ""].drop_duplicates()
+    hit = pd.Index(new_key.to_numpy()).get_indexer(old_key.to_numpy())
+    found = hit != -1
+    return old_key.index.to_numpy()[found], new_key.index.to_numpy()[hit[found]]
+
+
+def diff_releases(old_df: pd.DataFrame, new_df: pd.DataFrame) -> ReleaseDiff:
+    """Both frames as produced by load_base_df() (normalized, with __row_key__)."""
+    old = old_df.reset_index(drop=True)
+    new = new_df.reset_index(drop=True)
+    compare_cols = [c for c in dict.fromkeys(list(old.columns) + list(new.columns)) if c not in INTERNAL_COLS]
+    for frame in (old, new):
+        for col in compare_cols:
+            if col not in frame.columns:
+                frame[col] = ""
+    old_keys = old[KEY_COL].astype(str)
+    new_keys = new[KEY_COL].astype(str)
+    old_idless = old_keys.str.startswith("BASE:")
+    new_idless = new_keys.str.startswith("BASE:")
+
+    passes = [
+        (old_keys.where(~old_idless, ""), new_keys.where(~new_idless, "")),
+        (
+            _occurrence_key(old, ["Variable", "Organ System", "Group", "Source"], old_idless),
+            _occurrence_key(new, ["Variable", "Organ System", "Group", "Source"], new_idless),
+        ),
+        (old["PDMS ID"].astype(str), new["PDMS ID"].astype(str)),
+        (old["EPIC ID"].astype(str), new["EPIC ID"].astype(str)),
+        (
+            _occurrence_key(old, ["Variable", "Source"], old_idless),
+            _occurrence_key(new, ["Variable", "Source"], new_idless),
+        ),
+    ]
+
+    old_free = pd.Series(True, index=old.index)
+    new_free = pd.Series(True, index=new.index)
+    old_pos, new_pos = [], []
+    for old_match, new_match in passes:
+        o, n = _pair(old, new, old_match.loc[old_free], new_match.loc[new_free])
+        old_pos.append(o)
+        new_pos.append(n)
+        old_free.iloc[o] = False
+        new_free.iloc[n] = False
+    old_pos = np.concatenate(old_pos)
+    new_pos = np.concatenate(new_pos)
+
+    # -------- paired rows: hash first, columns only where the hash differs --------
+    old_keys_np = old_keys.to_numpy()
+    new_keys_np = new_keys.to_numpy()
+    # an ID-less key only changing its IDX part (rows shifted in the file) is not a change
+    rekeyed = (old_keys_np[old_pos] != new_keys_np[new_pos]) & ~(
+        old_idless.to_numpy()[old_pos] & new_idless.to_numpy()[new_pos]
+    )
+    differs = (content_hash(old, compare_cols)[old_pos] != content_hash(new, compare_cols)[new_pos]) | rekeyed
+
+    changed_cols = np.full(len(old_pos), "", dtype=object)
+    moved = np.zeros(len(old_pos), dtype=bool)
+    idx = np.flatnonzero(differs)
+    if len(idx):
+        changed = pd.Series("", index=range(len(idx)), dtype=object)
+        for col in compare_cols:
+            neq = (
+                _text(old[col].iloc[old_pos[idx]]).to_numpy() != _text(new[col].iloc[new_pos[idx]]).to_numpy()
+            )
+            if neq.any():
+                changed.loc[neq] = changed.loc[neq] + col + ", "
+                if col in GROUP_COLS:
+                    moved[idx[neq]] = True
+        changed = changed.str.rstrip(", ")
+        changed.loc[changed == ""] = KEY_COL  # only the key changed (re-keyed row)
+        changed_cols[idx] = changed.to_numpy()
+
+    change = np.where(moved, MOVED, np.where(differs, MODIFIED, UNCHANGED))
+    paired = pd.DataFrame(
+        {
+            "Change": change,
+            "Old key": old_keys_np[old_pos],
+            "New key": new_keys_np[new_pos],
+            "Variable": new["Variable"].to_numpy()[new_pos],
+            "Old Organ System": old["Organ System"].to_numpy()[old_pos],
+            "Old Group": old["Group"].to_numpy()[old_pos],
+            "New Organ System": new["Organ System"].to_numpy()[new_pos],
+            "New Group": new["Group"].to_numpy()[new_pos],
+            "Changed columns": changed_cols,
+        }
+    )
+
+    removed_rows = old.loc[old_free]
+    removed = pd.DataFrame(
+        {
+            "Change": REMOVED,
+            "Old key": removed_rows[KEY_COL].astype(str).to_numpy(),
+            "New key": "",
+            "Variable": removed_rows["Variable"].to_numpy(),
+            "Old Organ System": removed_rows["Organ System"].to_numpy(),
+            "Old Group": removed_rows["Group"].to_numpy(),
+            "New Organ System": "",
+            "New Group": "",
+            "Changed columns": "",
+        }
+    )
+    added_rows = new.loc[new_free]
+    added = pd.DataFrame(
+        {
+            "Change": ADDED,
+            "Old key": "",
+            "New key": added_rows[KEY_COL].astype(str).to_numpy(),
+            "Variable": added_rows["Variable"].to_numpy(),
+            "Old Organ System": "",
+            "Old Group": "",
+            "New Organ System": added_rows["Organ System"].to_numpy(),
+            "New Group": added_rows["Group"].to_numpy(),
+            "Changed columns": "",
+        }
+    )
+
+    changes = pd.concat([paired, removed, added], ignore_index=True)[DIFF_COLS]
+    key_map = pd.Series(paired["New key"].to_numpy(), index=pd.Index(paired["Old key"].to_numpy()), name="New key")
+    # a key on several old rows (read_base_df allows that) maps like its first pairing (passes run in order)
+    key_map = key_map.loc[~key_map.index.duplicated(keep="first")]
+    return ReleaseDiff(changes=changes, key_map=key_map)
+
+
+def diff_release_files(old_path, new_path) -> ReleaseDiff:
+    return diff_releases(load_base_df(old_path), load_base_df(new_path))
+
+
+def remap_leaves(leaves, diff: ReleaseDiff) -> tuple[list[str], list[str]]:
+    """
+    Carry "ROW:<key>" leaves over to the new release.
+    Returns (new leaves, dropped leaves). Keys the old release did not have
+    (e.g. overlay rows) are kept as they are; keys whose rows were all removed
+    are dropped (a key on several old rows survives if any of them was paired).
+    """
+    leaves = pd.Index(pd.Series(list(leaves), dtype=object).astype(str)).unique()
+    keys = leaves.str.removeprefix("ROW:")
+
+    mapped_pos = diff.key_map.index.get_indexer(keys)
+    removed_keys = pd.Index(diff.changes.loc[diff.changes["Change"] == REMOVED, "Old key"]).unique()
+    is_removed = keys.isin(removed_keys) & (mapped_pos == -1)
+
+    new_keys = np.where(mapped_pos != -1, diff.key_map.to_numpy()[mapped_pos], keys.to_numpy())
+    keep = ~is_removed
+    remapped = pd.Index("ROW:" + pd.Series(new_keys[keep], dtype=object)).unique().tolist()
+    dropped = leaves[is_removed].tolist()
+    return remapped, dropped
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Diff two base mapping releases")
+    parser.add_argument("old", help="previous release CSV")
+    parser.add_argument("new", help="new release CSV")
+    parser.add_argument("--out", help="write the changed rows to this CSV")
+    parser.add_argument("--all", action="store_true", help="include unchanged rows in --out")
+    parser.add_argument("--remap-keys", help="selection file (one ROW:<key> or key per line) to carry over")
+    parser.add_argument("--remap-token", help="selection token made against the old release")
+    parser.add_argument("--remapped", help="where to write the remapped selection (default: stdout)")
+    args = parser.parse_args(argv)
+
+    old_df = load_base_df(args.old)
+    new_df = load_base_df(args.new)
+    diff = diff_releases(old_df, new_df)
+    summary = {"summary": diff.summary()}
+
+    if args.out:
+        (diff.changes if args.all else diff.changed()).to_csv(args.out, index=False)
+        summary["out"] = args.out
+
+    leaves = None
+    if args.remap_keys:
+        lines = [l.strip() for l in Path(args.remap_keys).read_text(encoding="utf-8").splitlines() if l.strip()]
+        leaves = [l if l.startswith("ROW:") else "ROW:" + l for l in lines]
+    elif args.remap_token:
+        from selection_token import decode_selection, key_order_of
+
+        leaves = decode_selection(args.remap_token, key_order=key_order_of(old_df))
+
+    if leaves is not None:
+        remapped, dropped = remap_leaves(leaves, diff)
+        summary["remap"] = {"in": len(leaves), "out": len(remapped), "dropped": dropped[:50]}
+        if args.remap_token:
+            from selection_token import encode_selection, key_order_of
+
+            text = encode_selection(remapped, key_order=key_order_of(new_df)) + "\n"
+            summary["remap"]["token"] = text.strip()
+        else:
+            text = "\n".join(remapped) + "\n"
+        if args.remapped:
+            Path(args.remapped).write_text(text, encoding="utf-8")
+        elif not args.remap_token:
+            print(text, end="")
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
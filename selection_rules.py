@@ -0,0 +1,112 @@
+# selection_rules.py
+"""
+Selection by rule: filters over the master evaluated as vectorized column masks.
+
+A rule ANDs its filters; empty filters match everything. The result is the set
+of "ROW:<__row_key__>" leaf values, which is what checked_all_list stores.
+"""
+import re
+from dataclasses import asdict, dataclass, field
+
+import pandas as pd
+
+ID_PRESENCE_OPTIONS = ["any", "present", "absent"]
+
+
+@dataclass
+class SelectionRule:
+    name: str = ""
+    organ_systems: list[str] = field(default_factory=list)
+    groups: list[str] = field(default_factory=list)
+    sources: list[str] = field(default_factory=list)
+    units: list[str] = field(default_factory=list)
+    has_unit: bool = False
+    epic_id: str = "any"  # any | present | absent
+    pdms_id: str = "any"  # any | present | absent
+    variable_regex: str = ""
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SelectionRule":
+        known = {k: v for k, v in (data or {}).items() if k in cls.__dataclass_fields__}
+        return cls(**known)
+
+    def describe(self) -> str:
+        parts = []
+        if self.organ_systems:
+            parts.append("Organ System in " + ", ".join(self.organ_systems))
+        if self.groups:
+            parts.append("Group in " + ", ".join(self.groups))
+        if self.sources:
+            parts.append("Source in " + ", ".join(self.sources))
+        if self.units:
+            parts.append("Unit in " + ", ".join(self.units))
+        if self.has_unit:
+            parts.append("has a unit")
+        if self.epic_id != "any":
+            parts.append(f"EPIC ID {self.epic_id}")
+        if self.pdms_id != "any":
+            parts.append(f"PDMS ID {self.pdms_id}")
+        if self.variable_regex:
+            parts.append(f"Variable matches /{self.variable_regex}/")
+        return " · ".join(parts) or "all variables"
+
+
+def _text(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[col].fillna("").astype(str).str.strip()
+
+
+def _presence(values: pd.Series, mode: str) -> pd.Series:
+    if mode == "present":
+        return values != ""
+    if mode == "absent":
+        return values == ""
+    return pd.Series(True, index=values.index)
+
+
+def rule_mask(master_df: pd.DataFrame, rule: SelectionRule) -> pd.Series:
+    """Boolean mask over master_df rows matching `rule` (raises re.error on a bad regex)."""
+    mask = pd.Series(True, index=master_df.index)
+
+    if rule.organ_systems:
+        mask &= _text(master_df, "Organ System").isin(rule.organ_systems)
+    if rule.groups:
+        mask &= _text(master_df, "Group").isin(rule.groups)
+    if rule.sources:
+        mask &= _text(master_df, "Source").isin(rule.sources)
+
+    unit = _text(master_df, "Unit")
+    if rule.units:
+        mask &= unit.isin(rule.units)
+    if rule.has_unit:
+        mask &= unit != ""
+
+    mask &= _presence(_text(master_df, "EPIC ID"), rule.epic_id)
+    mask &= _presence(_text(master_df, "PDMS ID"), rule.pdms_id)
+
+    if rule.variable_regex:
+        re.compile(rule.variable_regex)  # surface syntax errors before the vectorized pass
+        mask &= _text(master_df, "Variable").str.contains(rule.variable_regex, case=False, regex=True)
+
+    return mask
+
+
+def evaluate_rule(master_df: pd.DataFrame, rule: SelectionRule) -> pd.Index:
+    """Leaf values ("ROW:<__row_key__>") of all master rows matching `rule`."""
+    keys = master_df.loc[rule_mask(master_df, rule), "__row_key__"].astype(str)
+    return pd.Index("ROW:" + keys).unique()
+
+
+def evaluate_rules(master_df: pd.DataFrame, rules: list[SelectionRule]) -> pd.Index:
+    """Union of several rules (one mask per rule, OR-ed, one gather)."""
+    if not rules:
+        return pd.Index([], dtype=object)
+    mask = pd.Series(False, index=master_df.index)
+    for rule in rules:
+        mask |= rule_mask(master_df, rule)
+    keys = master_df.loc[mask, "__row_key__"].astype(str)
+    return pd.Index("ROW:" + keys).unique()
@@ -0,0 +1,139 @@
+# selection_token.py
+"""
+Compact, shareable selection tokens.
+
+A selection is a set of "ROW:<__row_key__>" leaves. Most of them are base rows,
+and every session sees the base in the same order, so a token stores:
+- the positions of the selected base keys, as a sorted delta list (narrowest
+  unsigned int that fits) or as a bitmap, whichever is smaller
+- the remaining (overlay) keys verbatim
+- a fingerprint of the base key order the positions refer to
+zlib-compressed and base64url-encoded: "ks1.<payload>".
+
+Decoding is a vectorized gather (positions -> base keys), O(selected) for the
+delta form. A token made against a different base release is rejected
+(TokenBaseMismatch) instead of silently selecting the wrong rows.
+"""
+import base64
+import hashlib
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from data_store import get_base_release
+
+PREFIX = "ks1."
+_MODE_DELTA = 0
+_MODE_BITMAP = 1
+_DTYPES = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+_HEADER = struct.Struct("<8sBBII")  # fingerprint, mode, item size, count / bitmap bits, extra bytes
+
+
+class TokenError(ValueError):
+    pass
+
+
+class TokenBaseMismatch(TokenError):
+    pass
+
+
+def key_order_of(base_df: pd.DataFrame) -> tuple[pd.Index, bytes]:
+    """Unique keys of a base release in file order + an 8-byte fingerprint of that order."""
+    keys = pd.Index(base_df["__row_key__"].astype(str)).unique()
+    fingerprint = hashlib.sha1("\n".join(keys).encode("utf-8")).digest()[:8]
+    return keys, fingerprint
+
+
+@st.cache_resource(max_entries=2)
+def _base_key_order_for(signature: str, _base_df: pd.DataFrame) -> tuple[pd.Index, bytes]:
+    return key_order_of(_base_df)
+
+
+def base_key_order() -> tuple[pd.Index, bytes]:
+    """key_order_of() the session's base release (cached per release)."""
+    release = get_base_release()
+    return _base_key_order_for(release.signature, release.df)
+
+
+def _leaf_keys(leaves) -> pd.Index:
+    values = pd.Index(pd.Series(list(leaves), dtype=object).astype(str)).unique()
+    return pd.Index(values.str.removeprefix("ROW:"))
+
+
+def _narrowest(max_value: int) -> int:
+    return next(size for size in (1, 2, 4) if max_value < 256**size)
+
+
+def encode_selection(leaves, key_order: tuple[pd.Index, bytes] | None = None) -> str:
+    """Token for a selection given as "ROW:<key>" leaves (or plain keys), against the current base by default."""
+    base_keys, fingerprint = key_order or base_key_order()
+    keys = _leaf_keys(leaves)
+
+    positions = base_keys.get_indexer(keys)
+    in_base = positions != -1
+    positions = np.sort(positions[in_base])
+    extra = "\n".join(keys[~in_base]).encode("utf-8")
+
+    # delta list: first position, then gaps
+    deltas = np.diff(positions, prepend=0) if len(positions) else np.array([], dtype=np.int64)
+    size = _narrowest(int(deltas.max()) if len(deltas) else 0)
+    delta_body = deltas.astype(_DTYPES[size]).tobytes()
+
+    bitmap = np.zeros(len(base_keys), dtype=bool)
+    bitmap[positions] = True
+    bitmap_body = np.packbits(bitmap).tobytes()
+
+    if len(bitmap_body) < len(delta_body):
+        header = _HEADER.pack(fingerprint, _MODE_BITMAP, 1, len(base_keys), len(extra))
+        body = bitmap_body
+    else:
+        header = _HEADER.pack(fingerprint, _MODE_DELTA, size, len(positions), len(extra))
+        body = delta_body
+
+    packed = zlib.compress(header + body + extra, 9)
+    return PREFIX + base64.urlsafe_b64encode(packed).decode("ascii").rstrip("=")
+
+
+def decode_selection(
+    token: str, require_same_base: bool = True, key_order: tuple[pd.Index, bytes] | None = None
+) -> list[str]:
+    """
+    Leaves ("ROW:<key>") selected by `token`.
+    Raises TokenError for malformed tokens, TokenBaseMismatch if the base changed.
+    """
+    token = (token or "").strip()
+    if not token.startswith(PREFIX):
+        raise TokenError("not a selection token")
+    text = token[len(PREFIX):]
+    try:
+        raw = zlib.decompress(base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+        fingerprint, mode, size, count, extra_len = _HEADER.unpack_from(raw)
+    except (ValueError, zlib.error, struct.error) as exc:
+        raise TokenError(f"token is damaged: {exc}") from exc
+
+    base_keys, current_fingerprint = key_order or base_key_order()
+    if require_same_base and fingerprint != current_fingerprint:
+        raise TokenBaseMismatch("token was made for a different base mapping release")
+
+    body = raw[_HEADER.size : len(raw) - extra_len]
+    extra = raw[len(raw) - extra_len :].decode("utf-8") if extra_len else ""
+
+    if mode == _MODE_DELTA:
+        if size not in _DTYPES or len(body) != count * size:
+            raise TokenError("token is damaged: bad delta list")
+        positions = np.cumsum(np.frombuffer(body, dtype=_DTYPES[size]).astype(np.int64))
+    elif mode == _MODE_BITMAP:
+        positions = np.flatnonzero(np.unpackbits(np.frombuffer(body, dtype=np.uint8), count=count))
+    else:
+        raise TokenError(f"token is damaged: unknown mode {mode}")
+
+    if len(positions) and positions[-1] >= len(base_keys):
+        raise TokenBaseMismatch("token refers to rows the current base mapping does not have")
+
+    keys = base_keys.take(positions).tolist()
+    if extra:
+        keys += extra.split("\n")
+    return ["ROW:" + k for k in keys]
@@ -0,0 +1,174 @@
+# startup.py
+"""
+Cold-start helpers.
+
+- prewarm_in_background(): the Overview page needs neither pandas nor the tree
+  component, so it renders first and the heavy modules are imported in a daemon
+  thread while the user fills in the project (once per process).
+- profiler: every page in a fresh interpreter (= a cold container), reporting
+  the import time of each module-level import and the first / warm render time.
+
+    python startup.py                      # all pages, table
+    python startup.py --json profile.json  # also write the raw numbers
+    python startup.py pages/3_choose_variable.py --repeat 3
+
+Set KIM_PREWARM=0 to switch the background prewarm off (e.g. while profiling).
+"""
+import argparse
+import ast
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent
+PAGES = sorted(str(p.relative_to(APP_DIR)) for p in (APP_DIR / "pages").glob("*.py"))
+
+# third-party packages worth naming in the report (what a cold import actually pays for)
+HEAVY_PACKAGES = ["pandas", "numpy", "pyarrow", "requests", "streamlit_tree_select", "openpyxl"]
+PREWARM_MODULES = ["pandas", "data_store", "base_reload", "master_query", "jobs", "api_client", "upload_ingest", "streamlit_tree_select"]
+
+_prewarm_lock = threading.Lock()
+_prewarm_started = False
+
+
+# -----------------------------
+# prewarm
+# -----------------------------
+def prewarm_in_background(modules: list[str] | None = None) -> bool:
+    """Import `modules` on a daemon thread, once per process. Returns True if this call started it."""
+    global _prewarm_started
+    if os.getenv("KIM_PREWARM", "1") == "0":
+        return False
+    with _prewarm_lock:
+        if _prewarm_started:
+            return False
+        _prewarm_started = True
+
+    def run():
+        for name in modules or PREWARM_MODULES:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass  # the page importing it for real will surface the error
+
+    threading.Thread(target=run, name="kim-prewarm", daemon=True).start()
+    return True
+
+
+# -----------------------------
+# profiler (child: one page in this interpreter)
+# -----------------------------
+def _module_imports(page: Path) -> list[str]:
+    """Module-level imports of a page, in source order (imports inside functions are lazy by design)."""
+    names = []
+    for node in ast.parse(page.read_text(encoding="utf-8")).body:
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.append(node.module)
+    return list(dict.fromkeys(names))
+
+
+def _profile_page_here(page: str, repeat: int) -> dict:
+    os.chdir(APP_DIR)
+    sys.path.insert(0, str(APP_DIR))
+
+    started = time.perf_counter()
+    import streamlit  # noqa: F401  (baseline every page pays)
+
+    result = {"page": page, "streamlit_ms": round((time.perf_counter() - started) * 1000, 1), "imports": []}
+
+    for name in _module_imports(APP_DIR / page):
+        before = set(sys.modules)
+        started = time.perf_counter()
+        importlib.import_module(name)
+        loaded = set(sys.modules) - before
+        result["imports"].append(
+            {
+                "module": name,
+                "ms": round((time.perf_counter() - started) * 1000, 1),
+                "pulls": [p for p in HEAVY_PACKAGES if p in loaded],
+            }
+        )
+    result["import_ms"] = round(sum(i["ms"] for i in result["imports"]), 1)
+
+    # imported after the page's own imports so it can't hide their cost
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(APP_DIR / page), default_timeout=120)
+    renders = []
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        at.run()
+        renders.append(round((time.perf_counter() - started) * 1000, 1))
+    result["first_render_ms"] = renders[0]
+    result["warm_render_ms"] = renders[1:]
+    # page_link to sibling pages can't resolve in the bare test runner; not a page error
+    result["errors"] = [e.value[:200] for e in at.exception if "Could not find page" not in e.value]
+    return result
+
+
+# -----------------------------
+# profiler (parent: one fresh interpreter per page)
+# -----------------------------
+def profile_pages(pages: list[str], repeat: int = 2) -> list[dict]:
+    env = {**os.environ, "KIM_PREWARM": "0"}
+    results = []
+    for page in pages:
+        proc = subprocess.run(
+            [sys.executable, str(APP_DIR / "startup.py"), "--child", page, "--repeat", str(repeat)],
+            capture_output=True,
+            text=True,
+            cwd=APP_DIR,
+            env=env,
+        )
+        try:
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+            results.append({"page": page, "errors": [proc.stderr.strip()[-500:] or f"exit code {proc.returncode}"]})
+    return results
+
+
+def _print_report(results: list[dict]) -> None:
+    for r in results:
+        print(f"\n{r['page']}")
+        if "import_ms" not in r:
+            print("  failed:", *r.get("errors", []))
+            continue
+        print(f"  streamlit       {r['streamlit_ms']:8.1f} ms")
+        for imp in r["imports"]:
+            pulls = f"  (loads {', '.join(imp['pulls'])})" if imp["pulls"] else ""
+            print(f"  {imp['module']:<24}{imp['ms']:8.1f} ms{pulls}")
+        print(f"  page imports    {r['import_ms']:8.1f} ms")
+        print(f"  first render    {r['first_render_ms']:8.1f} ms")
+        if r["warm_render_ms"]:
+            print(f"  warm render     {min(r['warm_render_ms']):8.1f} ms (best of {len(r['warm_render_ms'])})")
+        for error in r["errors"]:
+            print("  error:", error)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Cold-start profile of the KIM VarMap pages")
+    parser.add_argument("pages", nargs="*", help=f"page files (default: {', '.join(PAGES)})")
+    parser.add_argument("--repeat", type=int, default=2, help="renders per page (first = cold, rest = warm)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_profile_page_here(args.child, args.repeat)))
+        return
+
+    results = profile_pages(args.pages or PAGES, repeat=args.repeat)
+    _print_report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+# sync_queue.py
+"""
+Write-behind sync of overlay changes to the KIM API.
+
+Sessions that turned sync on hand every overlay change (upload, "Add a
+variable", deletes, undo/redo, reset) to one process-wide queue and move on; nothing waits on the
+network. A background worker:
+- coalesces pending changes by (project, row_key): the newest change wins
+- flushes once FLUSH_ROWS keys are pending or the oldest change is
+  FLUSH_SECONDS old, in requests of at most BATCH_ROWS rows
+- on failure puts the batch back (unless a newer change for the key arrived)
+  and backs off exponentially
+- changes the API rejects outright (a 4xx other than 408/429, see
+  KimApiError.permanent) are not retried: they move to a dead-letter file and
+  are listed on the Data source page (retry or discard). A rejected upsert
+  request is split in halves until the rejected rows are isolated, so one bad
+  row doesn't hold back the rest of its batch.
+
+Every enqueued change is appended to a local spool file (JSON lines) before
+enqueue() returns, and the spool is rewritten to just the pending changes
+after each flush, so pending changes survive a restart (delivery
+is at-least-once; upserts and deletes are idempotent on the backend).
+
+    KIM_SYNC_SPOOL=.kim_varmap/sync_spool.jsonl
+    KIM_SYNC_DEAD_LETTERS=.kim_varmap/sync_dead_letters.jsonl
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+import streamlit as st
+
+SPOOL_PATH = Path(os.getenv("KIM_SYNC_SPOOL", ".kim_varmap/sync_spool.jsonl"))
+DEAD_LETTER_PATH = Path(os.getenv("KIM_SYNC_DEAD_LETTERS", ".kim_varmap/sync_dead_letters.jsonl"))
+FLUSH_ROWS = 500  # flush as soon as this many keys are pending ...
+FLUSH_SECONDS = 2.0  # ... or the oldest pending change is this old
+BATCH_ROWS = 1000  # rows per upsert request
+RETRY_MIN_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+SPLIT_STATUSES = (400, 422)  # row-level rejections: worth splitting the request to find the rows
+
+
+@dataclass
+class _Change:
+    op: str  # "upsert" | "delete"
+    row: dict | None  # API row (row_key + fields) for upserts
+    queued_at: float
+
+
+def api_rows(df: pd.DataFrame) -> list[dict]:
+    """Overlay rows -> API rows: row_key + the data columns (to_json handles NaN/NA/timestamps)."""
+    records = json.loads(df.to_json(orient="records", date_format="iso", force_ascii=False))
+    return [
+        {"row_key": str(r["__row_key__"]), **{c: v for c, v in r.items() if not str(c).startswith("__")}}
+        for r in records
+    ]
+
+
+def _send_upserts(project_id: str, rows: list[dict]) -> None:
+    from api_client import upsert_rows
+
+    upsert_rows(project_id, rows)
+
+
+def _send_deletes(project_id: str, row_keys: list[str]) -> tuple[list[str], dict[str, str]]:
+    """(keys that failed, {key: error} for those the API rejected for good)."""
+    from api_client import delete_mappings
+
+    result = delete_mappings(project_id, row_keys)
+    return result["failed_keys"], result["rejected"]
+
+
+def _permanent(exc: Exception) -> bool:
+    return bool(getattr(exc, "permanent", False))
+
+
+class SyncQueue:
+    def __init__(
+        self,
+        spool_path: Path | str | None = SPOOL_PATH,
+        dead_letter_path: Path | str | None = DEAD_LETTER_PATH,
+        flush_rows: int = FLUSH_ROWS,
+        flush_seconds: float = FLUSH_SECONDS,
+        batch_rows: int = BATCH_ROWS,
+        send_upserts: Callable[[str, list[dict]], None] = _send_upserts,
+        send_deletes: Callable[[str, list[str]], tuple[list[str], dict[str, str]]] = _send_deletes,
+    ):
+        self.spool_path = Path(spool_path) if spool_path else None
+        self.dead_letter_path = Path(dead_letter_path) if dead_letter_path else None
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.batch_rows = batch_rows
+        self._send_upserts = send_upserts
+        self._send_deletes = send_deletes
+
+        self._cond = threading.Condition()
+        self._pending: dict[str, dict[str, _Change]] = {}  # project -> row_key -> newest change
+        self._dead: dict[tuple[str, str], dict] = {}  # (project, row_key) -> rejected change + error
+        self._inflight = 0
+        self._flush_requested = False
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        self._stop = threading.Event()
+        self._stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushed_rows": 0,
+            "requests": 0,
+            "failures": 0,
+            "rejected": 0,
+            "consecutive_failures": 0,
+            "last_error": "",
+            "last_flush_ms": 0.0,
+            "last_flush_at": 0.0,
+        }
+
+        self._load_spool()
+        self._load_dead_letters()
+        self._worker = threading.Thread(target=self._run, name="kim-sync", daemon=True)
+        self._worker.start()
+
+    # -----------------------------
+    # producer side (script thread)
+    # -----------------------------
+    def enqueue(self, project_id: str, upserts: pd.DataFrame | None = None, deletes=None) -> int:
+        """Queue a delta (rows to upsert, keys to delete). Returns how many changes were queued."""
+        changes = []
+        if upserts is not None and len(upserts) > 0:
+            changes += [("upsert", row["row_key"], row) for row in api_rows(upserts)]
+        changes += [("delete", str(k), None) for k in (deletes if deletes is not None else [])]
+        if not changes:
+            return 0
+
+        with self._cond:
+            self._spool_append(project_id, changes)
+            self._apply(project_id, changes, time.time())
+            self._stats["enqueued"] += len(changes)
+            # a newer change for a rejected key supersedes the dead letter
+            if self._dead:
+                superseded = [self._dead.pop((project_id, key), None) for _, key, _ in changes]
+                if any(superseded):
+                    self._dead_rewrite()
+            self._cond.notify()
+        return len(changes)
+
+    def dead_letters(self, project_id: str | None = None) -> list[dict]:
+        """Changes the API rejected for good: {"project", "op", "key", "row", "error", "at"}."""
+        with self._cond:
+            return [dict(r) for (p, _), r in self._dead.items() if project_id is None or p == project_id]
+
+    def retry_dead_letters(self, project_id: str) -> int:
+        """Queue a project's rejected changes again (e.g. once the project exists). Returns how many."""
+        with self._cond:
+            records = [r for (p, _), r in self._dead.items() if p == project_id]
+            for r in records:
+                del self._dead[(project_id, r["key"])]
+            pending = self._pending.get(project_id, {})
+            changes = [(r["op"], r["key"], r["row"]) for r in records if r["key"] not in pending]
+            if records:
+                self._dead_rewrite()
+            if changes:
+                self._spool_append(project_id, changes)
+                self._apply(project_id, changes, time.time())
+                self._cond.notify()
+        return len(changes)
+
+    def discard_dead_letters(self, project_id: str) -> int:
+        with self._cond:
+            keys = [k for k in self._dead if k[0] == project_id]
+            for k in keys:
+                del self._dead[k]
+            if keys:
+                self._dead_rewrite()
+        return len(keys)
+
+    def flush_now(self) -> None:
+        """Flush on the next worker pass, regardless of the size/time trigger and backoff."""
+        with self._cond:
+            self._flush_requested = True
+            self._retry_at = 0.0
+            self._cond.notify()
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.time()
+            oldest = self._oldest()
+            return {
+                **self._stats,
+                "pending": self._depth(),
+                "dead_letters": len(self._dead),
+                "inflight": self._inflight,
+                "projects": {p: len(changes) for p, changes in self._pending.items() if changes},
+                "oldest_pending_s": round(now - oldest, 1) if oldest else 0.0,
+                "retry_in_s": round(max(0.0, self._retry_at - now), 1),
+            }
+
+    # -----------------------------
+    # bookkeeping (caller holds the lock)
+    # -----------------------------
+    def _apply(self, project_id: str, changes, queued_at: float) -> None:
+        pending = self._pending.setdefault(project_id, {})
+        for op, key, row in changes:
+            if key in pending:
+                self._stats["coalesced"] += 1
+                del pending[key]  # re-insert => dict order = order of the newest change
+            pending[key] = _Change(op, row, queued_at)
+
+    def _depth(self) -> int:
+        return sum(len(p) for p in self._pending.values())
+
+    def _oldest(self) -> float | None:
+        # per project, dict order is oldest change first (see _apply / _flush)
+        return min((next(iter(p.values())).queued_at for p in self._pending.values() if p), default=None)
+
+    def _due(self, now: float) -> bool:
+        depth = self._depth()
+        if depth == 0:
+            return False
+        if self._flush_requested:
+            return True
+        if now < self._retry_at:
+            return False
+        if depth >= self.flush_rows:
+            return True
+        return now - self._oldest() >= self.flush_seconds
+
+    # -----------------------------
+    # spool file
+    # -----------------------------
+    def _spool_append(self, project_id: str, changes) -> None:
+        if self.spool_path is None:
+            return
+        self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for op, key, row in changes:
+                f.write(json.dumps({"project": project_id, "op": op, "key": key, "row": row}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spool_rewrite(self) -> None:
+        """Spool = exactly the pending changes (after a flush, sent or put back)."""
+        if self.spool_path is None or not self.spool_path.exists():
+            return
+        tmp = self.spool_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for project_id, changes in self._pending.items():
+                for key, change in changes.items():
+                    f.write(json.dumps({"project": project_id, "op": change.op, "key": key, "row": change.row}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.spool_path)
+
+    def _load_spool(self) -> None:
+        if self.spool_path is None or not self.spool_path.exists():
+            return
+        loaded_at = time.time()
+        with open(self.spool_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash mid-write
+                self._apply(rec["project"], [(rec["op"], rec["key"], rec.get("row"))], loaded_at)
+        self._stats["coalesced"] = 0
+
+    # -----------------------------
+    # dead letters (caller holds the lock)
+    # -----------------------------
+    def _dead_rewrite(self) -> None:
+        if self.dead_letter_path is None:
+            return
+        if not self._dead:
+            self.dead_letter_path.unlink(missing_ok=True)
+            return
+        self.dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.dead_letter_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in self._dead.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.dead_letter_path)
+
+    def _load_dead_letters(self) -> None:
+        if self.dead_letter_path is None or not self.dead_letter_path.exists():
+            return
+        with open(self.dead_letter_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                self._dead[(rec["project"], rec["key"])] = rec
+
+    # -----------------------------
+    # worker
+    # -----------------------------
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            with self._cond:
+                now = time.time()
+                while not self._due(now):
+                    self._cond.wait(timeout=0.25)
+                    if self._stop.is_set():
+                        return
+                    now = time.time()
+                batch, self._pending = self._pending, {}
+                self._inflight = sum(len(p) for p in batch.values())
+                self._flush_requested = False
+            self._flush(batch)
+
+    def _send_upsert_chunk(self, project_id: str, chunk: list, rejected: list) -> int:
+        """
+        Send one upsert request; returns the rows sent. If the API rejects a
+        row-level problem (SPLIT_STATUSES), the halves are sent on their own
+        until the rejected rows are isolated; rejected rows are appended to
+        `rejected` as (key, change, error). Transient errors propagate.
+        """
+        with self._cond:
+            self._stats["requests"] += 1
+        try:
+            self._send_upserts(project_id, [c.row for _, c in chunk])
+            return len(chunk)
+        except Exception as exc:
+            if not _permanent(exc):
+                raise
+            if len(chunk) == 1 or getattr(exc, "status_code", None) not in SPLIT_STATUSES:
+                rejected.extend((k, c, f"{type(exc).__name__}: {exc}") for k, c in chunk)
+                return 0
+            mid = len(chunk) // 2
+            return self._send_upsert_chunk(project_id, chunk[:mid], rejected) + self._send_upsert_chunk(
+                project_id, chunk[mid:], rejected
+            )
+
+    def _flush(self, batch: dict[str, dict[str, _Change]]) -> None:
+        started = time.perf_counter()
+        failed: dict[str, dict[str, _Change]] = {}
+        rejected: dict[str, list] = {}  # project -> [(key, change, error)], not retried
+        error = ""
+        sent = 0
+
+        for project_id, changes in batch.items():
+            upserts = [(k, c) for k, c in changes.items() if c.op == "upsert"]
+            deletes = [(k, c) for k, c in changes.items() if c.op == "delete"]
+            project_rejected = rejected.setdefault(project_id, [])
+
+            for start in range(0, len(upserts), self.batch_rows):
+                chunk = upserts[start : start + self.batch_rows]
+                try:
+                    sent += self._send_upsert_chunk(project_id, chunk, project_rejected)
+                except Exception as exc:
+                    error = f"{type(exc).__name__}: {exc}"
+                    failed.setdefault(project_id, {}).update(upserts[start:])
+                    break
+
+            if deletes:
+                with self._cond:
+                    self._stats["requests"] += 1
+                try:
+                    failed_keys, rejected_keys = self._send_deletes(project_id, [k for k, _ in deletes])
+                    failed_keys = set(failed_keys)
+                except Exception as exc:
+                    error = f"{type(exc).__name__}: {exc}"
+                    failed_keys = {k for k, _ in deletes}
+                    rejected_keys = dict.fromkeys(failed_keys, error) if _permanent(exc) else {}
+                project_rejected.extend((k, c, rejected_keys[k]) for k, c in deletes if k in rejected_keys)
+                retry_keys = failed_keys - rejected_keys.keys()
+                if retry_keys:
+                    error = error or f"{len(retry_keys)} delete(s) failed"
+                    failed.setdefault(project_id, {}).update((k, c) for k, c in deletes if k in retry_keys)
+                sent += len(deletes) - len(failed_keys)
+
+        with self._cond:
+            # failed changes go back (in front, they are older) unless a newer change for the key arrived meanwhile
+            for project_id, changes in failed.items():
+                newer = self._pending.get(project_id, {})
+                merged = {k: c for k, c in changes.items() if k not in newer}
+                merged.update(newer)
+                self._pending[project_id] = merged
+            for project_id, records in rejected.items():
+                for key, change, why in records:
+                    self._dead[(project_id, key)] = {
+                        "project": project_id, "op": change.op, "key": key, "row": change.row,
+                        "error": why, "at": time.time(),
+                    }
+                    self._stats["rejected"] += 1
+            if any(rejected.values()):
+                self._dead_rewrite()
+            self._inflight = 0
+            self._stats["flushed_rows"] += sent
+            self._stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self._stats["last_flush_at"] = time.time()
+            if failed:
+                self._stats["failures"] += 1
+                self._stats["consecutive_failures"] += 1
+                self._stats["last_error"] = error
+                self._retry_delay = min(RETRY_MAX_SECONDS, max(RETRY_MIN_SECONDS, self._retry_delay * 2))
+                self._retry_at = time.time() + self._retry_delay
+            else:
+                self._stats["consecutive_failures"] = 0
+                self._retry_delay = 0.0
+                self._retry_at = 0.0
+            self._spool_rewrite()
+
+
+@st.cache_resource
+def get_sync_queue() -> SyncQueue:
+    """One queue per server process (pending changes from the spool are picked up here)."""
+    return SyncQueue()
+
+
+def sync_project(state=None) -> str:
+    """Project the session syncs to ("" when write-behind sync is off)."""
+    state = st.session_state if state is None else state
+    return state.get("sync_project") or ""
+
+
+def render_sync_status(poll_seconds: float = 5.0) -> None:
+    """Queue depth, flush latency and failures; refreshes itself while the page is open."""
+
+    @st.fragment(run_every=poll_seconds)
+    def _poll():
+        stats = get_sync_queue().stats()
+        line = (
+            f"Background sync: **{stats['pending'] + stats['inflight']:,}** pending"
+            f" · {stats['flushed_rows']:,} sent in {stats['requests']:,} request(s)"
+            f" · last flush {stats['last_flush_ms']:.0f} ms"
+        )
+        if stats["pending"]:
+            line += f" · oldest {stats['oldest_pending_s']:.0f}s"
+        st.caption(line)
+        if stats["consecutive_failures"]:
+            st.warning(
+                f"Sync is failing ({stats['consecutive_failures']}x, retry in {stats['retry_in_s']:.0f}s): "
+                f"{stats['last_error']}. Changes stay queued locally."
+            )
+        if stats["pending"] and st.button("Sync now", key="sync_flush_now"):
+            get_sync_queue().flush_now()
+
+    _poll()
+
+
+def render_dead_letters(project_id: str) -> None:
+    """Changes of `project_id` the API rejected for good, with retry / discard."""
+    queue = get_sync_queue()
+    records = queue.dead_letters(project_id)
+    if not records:
+        return
+    st.warning(
+        f"The KIM API rejected {len(records):,} change(s) for project '{project_id}'. "
+        "They are kept locally and not retried automatically."
+    )
+    with st.expander("Rejected changes"):
+        st.dataframe(
+            pd.DataFrame(
+                {
+                    "Change": [r["op"] for r in records],
+                    "Row key": [r["key"] for r in records],
+                    "Variable": [(r["row"] or {}).get("Variable", "") for r in records],
+                    "Error": [r["error"] for r in records],
+                }
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
+        col_retry, col_discard = st.columns(2)
+        if col_retry.button("Retry rejected changes", key="sync_dead_retry"):
+            queue.retry_dead_letters(project_id)
+            queue.flush_now()
+            st.rerun()
+        if col_discard.button("Discard rejected changes", key="sync_dead_discard"):
+            queue.discard_dead_letters(project_id)
+            st.rerun()
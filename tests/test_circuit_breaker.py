@@ -0,0 +1,145 @@
+# tests/test_circuit_breaker.py
+import types
+
+import pytest
+import requests
+
+import api_client
+from api_client import ApiConfig, CircuitBreaker, CircuitOpenError, KimApiError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeApi:
+    """Stands in for requests.request: answers after `latency` seconds of fake time, or times out."""
+
+    def __init__(self, clock, latency):
+        self.clock = clock
+        self.latency = latency
+        self.timeouts = []
+
+    def __call__(self, method, url, timeout, **kwargs):
+        read_timeout = timeout[1]
+        self.timeouts.append(read_timeout)
+        if self.latency > read_timeout:
+            self.clock.now += read_timeout
+            raise requests.ReadTimeout(f"read timed out after {read_timeout}s")
+        self.clock.now += self.latency
+        return types.SimpleNamespace(status_code=200, text='{"ok": true}', json=lambda: {"ok": True})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(api_client, "time", clock)
+    monkeypatch.setattr(api_client, "_breakers", {g: CircuitBreaker(g) for g in ("health", "read", "write")})
+    return clock
+
+
+def _get(cfg):
+    return api_client._request_json(cfg, "GET", "/v1/things")
+
+
+def test_opens_after_threshold_and_fails_fast(clock):
+    breaker = CircuitBreaker("read")
+    for _ in range(api_client.FAILURE_THRESHOLD - 1):
+        breaker.before_request()
+        breaker.record_failure("boom")
+    assert breaker.state == "closed"
+    breaker.before_request()
+    breaker.record_failure("boom")
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_half_open_allows_one_trial(clock):
+    breaker = CircuitBreaker("read")
+    for _ in range(api_client.FAILURE_THRESHOLD):
+        breaker.record_failure("boom")
+    clock.now += api_client.OPEN_SECONDS
+    breaker.before_request()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError, match="trial"):
+        breaker.before_request()
+
+    breaker.record_failure("still down")
+    assert breaker.state == "open"
+
+    clock.now += api_client.OPEN_SECONDS
+    breaker.before_request()
+    breaker.record_success(0.1)
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_release_frees_the_trial(clock):
+    breaker = CircuitBreaker("write")
+    for _ in range(api_client.FAILURE_THRESHOLD):
+        breaker.record_failure("boom")
+    clock.now += api_client.OPEN_SECONDS
+    breaker.before_request()
+    breaker.release()
+    assert breaker.state == "closed"
+    breaker.before_request()
+
+
+def test_non_request_error_releases_the_trial(clock, monkeypatch):
+    cfg = ApiConfig("http://api", "t")
+    breaker = api_client._breakers["read"]
+    for _ in range(api_client.FAILURE_THRESHOLD):
+        breaker.record_failure("boom")
+    clock.now += api_client.OPEN_SECONDS
+
+    def broken(**kwargs):
+        raise ValueError("decode failed")
+
+    monkeypatch.setattr(requests, "request", broken)
+    with pytest.raises(ValueError):
+        _get(cfg)
+    assert not breaker._trial_running
+
+
+def test_recovers_after_latency_step_up(clock, monkeypatch):
+    cfg = ApiConfig("http://api", "t", timeout_seconds=20)
+    api = FakeApi(clock, latency=0.05)
+    monkeypatch.setattr(requests, "request", api)
+    breaker = api_client._breakers["read"]
+
+    # learn a fast API: the read timeout drops to the floor
+    for _ in range(api_client.MIN_LATENCY_SAMPLES):
+        _get(cfg)
+    assert breaker.read_timeout(cfg.timeout_seconds) == api_client.READ_TIMEOUT_FLOOR_SECONDS
+
+    # the API slows down past the learned timeout but stays well under the ceiling
+    api.latency = 2.5
+    recovered = False
+    for _ in range(50):
+        try:
+            _get(cfg)
+            recovered = True
+            break
+        except CircuitOpenError:
+            clock.now += api_client.OPEN_SECONDS
+        except KimApiError:
+            pass
+    assert recovered
+    assert breaker.state == "closed"
+    assert api.timeouts[-1] >= 2.5
+
+
+def test_half_open_trial_uses_the_ceiling(clock):
+    breaker = CircuitBreaker("read")
+    for _ in range(api_client.MIN_LATENCY_SAMPLES):
+        breaker.record_success(0.01)
+    assert breaker.read_timeout(20) == api_client.READ_TIMEOUT_FLOOR_SECONDS
+    for _ in range(api_client.FAILURE_THRESHOLD):
+        breaker.record_failure("timeout")
+    clock.now += api_client.OPEN_SECONDS
+    breaker.before_request()
+    assert breaker.read_timeout(20) == 20
@@ -0,0 +1,79 @@
+# tests/test_key_index.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from key_index import BASE, USER, KeyIndex
+from overlay_journal import OverlayJournal
+
+KEY = "__row_key__"
+
+
+def _frame(keys, tag):
+    return pd.DataFrame({KEY: list(keys), "Variable": [f"{k}-{tag}" for k in keys], "Unit": tag})
+
+
+def _naive_master(base, overlay):
+    return pd.concat([base, overlay], ignore_index=True).drop_duplicates(subset=[KEY], keep="last").reset_index(drop=True)
+
+
+def _index_master(index, base, overlay):
+    return pd.concat(
+        [base.iloc[index.master_rows(BASE)], overlay.iloc[index.master_rows(USER)]], ignore_index=True
+    )
+
+
+@pytest.fixture
+def base():
+    # b3 twice: the last row wins, like the master merge
+    return _frame(["b0", "b1", "b2", "b3", "b4", "b3"], "base")
+
+
+def test_base_index(base):
+    index = KeyIndex.for_base(base, "sig")
+    assert len(index) == 5
+    pd.testing.assert_frame_equal(_index_master(index, base, base.iloc[:0]), _naive_master(base, base.iloc[:0]))
+    assert index.contains(["b1", "nope"]).tolist() == [True, False]
+    assert not index.in_overlay(["b1"]).any()
+
+
+def test_with_overlay_matches_naive_merge(base):
+    overlay = _frame(["b1", "n1", "n2", "b4"], "user")
+    index = KeyIndex.for_base(base, "sig").with_overlay(overlay)
+    pd.testing.assert_frame_equal(_index_master(index, base, overlay), _naive_master(base, overlay))
+    assert index.in_overlay(["b1", "b2", "n1", "nope"]).tolist() == [True, False, True, False]
+
+    gathered = index.gather(["n2", "b2", "nope", "b1"], base, overlay)
+    assert gathered[KEY].tolist() == ["n2", "b2", "b1"]
+    assert gathered["Unit"].tolist() == ["user", "base", "user"]
+
+
+def test_upserts_match_a_rebuild(base):
+    rng = np.random.default_rng(11)
+    base_index = KeyIndex.for_base(base, "sig")
+    journal = OverlayJournal()
+    overlay = pd.DataFrame({KEY: pd.Series([], dtype=object)})
+    index = base_index.with_overlay(overlay)
+    for step in range(40):
+        keys = rng.choice(["b0", "b1", "b3", "n0", "n1", "n2", "n3", "n4"], size=rng.integers(1, 5)).tolist()
+        upserts = _frame(keys, f"s{step}")  # may repeat a key: the last row counts
+        overlay_keys = pd.Index(overlay[KEY].astype(str))
+        overlay = journal.record("upload", overlay, upserts=upserts)
+        index = index.with_upserts(overlay_keys, upserts)
+
+        rebuilt = base_index.with_overlay(overlay)
+        assert index.fingerprint == rebuilt.fingerprint
+        pd.testing.assert_frame_equal(_index_master(index, base, overlay), _naive_master(base, overlay))
+
+
+def test_with_upserts_rejects_a_stale_overlay(base):
+    index = KeyIndex.for_base(base, "sig").with_overlay(_frame(["n1"], "user"))
+    assert index.with_upserts(pd.Index([]), _frame(["n2"], "user")) is None
+
+
+def test_fingerprint_is_order_and_content_sensitive(base):
+    index = KeyIndex.for_base(base, "sig")
+    assert index.fingerprint == KeyIndex.for_base(base.copy(), "other").fingerprint
+    assert index.fingerprint != KeyIndex.for_base(base.iloc[::-1], "sig").fingerprint
+    changed = base.assign(Unit=["base", "base", "x", "base", "base", "base"])
+    assert index.fingerprint != KeyIndex.for_base(changed, "sig").fingerprint
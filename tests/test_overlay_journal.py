@@ -0,0 +1,91 @@
+# tests/test_overlay_journal.py
+import numpy as np
+import pandas as pd
+import pytest
+
+import overlay_journal
+from overlay_journal import OverlayJournal
+
+
+def _rows(keys, tag="v1"):
+    return pd.DataFrame({"__row_key__": list(keys), "Variable": [f"{k}-{tag}" for k in keys]})
+
+
+def _same(a, b):
+    if len(a) == 0 and len(b) == 0:
+        return True
+    return a.reset_index(drop=True).equals(b.reset_index(drop=True))
+
+
+def _edit(journal, overlay, rng):
+    op = rng.integers(3)
+    keys = [f"k{i}" for i in rng.choice(30, size=rng.integers(1, 6), replace=False)]
+    if op == 0:
+        return journal.record("upload", overlay, upserts=_rows(keys, tag=str(rng.integers(1000))))
+    if op == 1:
+        return journal.record("delete", overlay, deletes=keys)
+    return journal.record("reset", overlay, deletes=overlay["__row_key__"] if len(overlay) else [])
+
+
+def test_undo_redo_match_materialize():
+    rng = np.random.default_rng(7)
+    journal = OverlayJournal(max_undo=50)
+    overlay = pd.DataFrame()
+    for _ in range(200):
+        action = rng.integers(4)
+        if action == 0 and journal.can_undo():
+            overlay = journal.undo(overlay)
+        elif action == 1 and journal.can_redo():
+            overlay = journal.redo(overlay)
+        else:
+            overlay = _edit(journal, overlay, rng)
+        assert _same(overlay, journal.materialize())
+
+
+def test_undo_restores_original_positions():
+    journal = OverlayJournal()
+    overlay = journal.record("upload", pd.DataFrame(), upserts=_rows(["a", "b", "c", "d"]))
+    after = journal.record("delete", overlay, deletes=["b", "d"])
+    assert list(after["__row_key__"]) == ["a", "c"]
+    assert _same(journal.undo(after), overlay)
+
+
+def test_clear_and_undo():
+    journal = OverlayJournal()
+    overlay = journal.record("upload", pd.DataFrame(), upserts=_rows(["a", "b"]))
+    cleared = journal.record("reset", overlay, deletes=overlay["__row_key__"])
+    assert len(cleared) == 0
+    assert _same(journal.undo(cleared), overlay)
+    assert len(journal.redo(overlay)) == 0
+
+
+def test_new_change_drops_redo_tail():
+    journal = OverlayJournal()
+    overlay = journal.record("upload", pd.DataFrame(), upserts=_rows(["a"]))
+    overlay = journal.undo(overlay)
+    assert journal.can_redo()
+    journal.record("upload", overlay, upserts=_rows(["b"]))
+    assert not journal.can_redo()
+
+
+def test_changes_since():
+    journal = OverlayJournal()
+    overlay = journal.record("upload", pd.DataFrame(), upserts=_rows(["a", "b", "c"]))
+    version = journal.version
+    overlay = journal.record("upload", overlay, upserts=_rows(["a"], tag="v2"))
+    overlay = journal.record("delete", overlay, deletes=["b"])
+    rows, deleted = journal.changes_since(version, overlay)
+    assert list(rows["__row_key__"]) == ["a"] and list(rows["Variable"]) == ["a-v2"]
+    assert list(deleted) == ["b"]
+
+
+def test_touch_log_is_bounded(monkeypatch):
+    monkeypatch.setattr(overlay_journal, "TOUCH_LOG_MAX", 5)
+    journal = OverlayJournal()
+    overlay = pd.DataFrame()
+    for i in range(50):
+        overlay = journal.record("upload", overlay, upserts=_rows([f"k{i}"]))
+    assert len(journal._touch_log) <= 10
+    assert journal.changes_since(0, overlay) is None
+    rows, deleted = journal.changes_since(journal.version - 1, overlay)
+    assert list(rows["__row_key__"]) == ["k49"] and len(deleted) == 0
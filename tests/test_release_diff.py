@@ -0,0 +1,89 @@
+# tests/test_release_diff.py
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from data_store import read_base_df
+from release_diff import ADDED, REMOVED, UNCHANGED, diff_releases, remap_leaves
+
+BASE_CSV = Path(__file__).resolve().parents[1] / "data" / "clinical_variable_mapping_50_entries.csv"
+
+
+@pytest.fixture
+def raw():
+    return pd.read_csv(BASE_CSV)
+
+
+def _release(tmp_path, df, name):
+    path = tmp_path / f"{name}.csv"
+    df.to_csv(path, index=False)
+    return read_base_df(path)
+
+
+def _key(release, variable):
+    return release.loc[release["Variable"] == variable, "__row_key__"].iloc[0]
+
+
+def test_same_release_is_unchanged(tmp_path, raw):
+    old = _release(tmp_path, raw, "old")
+    diff = diff_releases(old, _release(tmp_path, raw, "new"))
+    assert diff.summary()[UNCHANGED] == len(old)
+    leaves = ["ROW:" + k for k in old["__row_key__"]]
+    assert remap_leaves(leaves, diff) == (leaves, [])
+
+
+def test_removed_and_added_rows(tmp_path, raw):
+    old = _release(tmp_path, raw, "old")
+    extra = raw.iloc[[0]].assign(Variable="Brand New", **{"EPIC ID": "E-NEW-1", "PDMS ID": "P-NEW-1"})
+    new = _release(tmp_path, pd.concat([raw.iloc[1:], extra]), "new")
+    diff = diff_releases(old, new)
+    assert diff.summary()[REMOVED] == 1 and diff.summary()[ADDED] == 1
+
+    gone = "ROW:" + old["__row_key__"].iloc[0]
+    kept = "ROW:" + old["__row_key__"].iloc[1]
+    remapped, dropped = remap_leaves([gone, kept, "ROW:NEW:overlay-row"], diff)
+    assert remapped == [kept, "ROW:NEW:overlay-row"]
+    assert dropped == [gone]
+
+
+def test_removed_duplicate_base_key(tmp_path, raw):
+    # read_base_df doesn't reject two rows with the same EPIC ID
+    old = _release(tmp_path, pd.concat([raw, raw.iloc[[0]]], ignore_index=True), "old")
+    new = _release(tmp_path, raw.iloc[1:], "new")
+    key = old["__row_key__"].iloc[0]
+    assert (old["__row_key__"] == key).sum() == 2
+
+    diff = diff_releases(old, new)
+    assert diff.key_map.index.is_unique
+    remapped, dropped = remap_leaves(["ROW:" + key, "ROW:" + old["__row_key__"].iloc[1]], diff)
+    assert dropped == ["ROW:" + key]
+    assert remapped == ["ROW:" + old["__row_key__"].iloc[1]]
+
+
+def test_duplicate_base_key_that_survives_is_kept(tmp_path, raw):
+    old = _release(tmp_path, pd.concat([raw, raw.iloc[[0]]], ignore_index=True), "old")
+    new = _release(tmp_path, raw, "new")
+    key = old["__row_key__"].iloc[0]
+
+    diff = diff_releases(old, new)
+    assert diff.key_map.index.is_unique
+    assert remap_leaves(["ROW:" + key], diff) == (["ROW:" + key], [])
+
+
+def test_rekeyed_row_follows_its_new_key(tmp_path, raw):
+    # an EPIC ID added to a PDMS-only row: paired by PDMS ID, remapped to the new key
+    pdms_only = raw.loc[raw["EPIC ID"].isna() & raw["PDMS ID"].notna()].index
+    if len(pdms_only) == 0:
+        raw = raw.copy()
+        raw.loc[0, "EPIC ID"] = None
+        pdms_only = raw.index[:1]
+    old = _release(tmp_path, raw, "old")
+    changed = raw.copy()
+    changed.loc[pdms_only[0], "EPIC ID"] = "E-ADDED-1"
+    new = _release(tmp_path, changed, "new")
+
+    variable = raw.loc[pdms_only[0], "Variable"]
+    diff = diff_releases(old, new)
+    remapped, dropped = remap_leaves(["ROW:" + _key(old, variable)], diff)
+    assert remapped == ["ROW:" + _key(new, variable)] and dropped == []
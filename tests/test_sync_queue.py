@@ -0,0 +1,131 @@
+# tests/test_sync_queue.py
+import time
+
+import pandas as pd
+
+from api_client import KimApiError
+from sync_queue import SyncQueue
+
+
+class FakeApi:
+    def __init__(self):
+        self.upserted = []
+        self.deleted = []
+        self.down = False
+
+    def upserts(self, project_id, rows):
+        if self.down:
+            raise KimApiError("API request failed: connection refused")
+        if project_id == "UNKNOWN":
+            raise KimApiError("API error 404: unknown project", 404)
+        if any(r["Variable"] == "bad" for r in rows):
+            raise KimApiError("API error 422: invalid row", 422)
+        self.upserted += [r["row_key"] for r in rows]
+
+    def deletes(self, project_id, keys):
+        if project_id == "UNKNOWN":
+            return keys, {k: "API error 404: unknown project" for k in keys}
+        self.deleted += keys
+        return [], {}
+
+
+def _rows(n, bad=()):
+    return pd.DataFrame({"__row_key__": [f"k{i}" for i in range(n)], "Variable": ["bad" if i in bad else "ok" for i in range(n)]})
+
+
+def _queue(tmp_path, api, **kwargs):
+    return SyncQueue(
+        spool_path=tmp_path / "spool.jsonl",
+        dead_letter_path=tmp_path / "dead.jsonl",
+        flush_seconds=3600,
+        send_upserts=api.upserts,
+        send_deletes=api.deletes,
+        **kwargs,
+    )
+
+
+def _drain(queue, timeout=5.0):
+    queue.flush_now()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = queue.stats()
+        if stats["pending"] == 0 and stats["inflight"] == 0 and stats["last_flush_at"]:
+            return stats
+        time.sleep(0.01)
+    raise AssertionError(f"queue did not drain: {queue.stats()}")
+
+
+def test_coalesces_and_sends(tmp_path):
+    api = FakeApi()
+    queue = _queue(tmp_path, api)
+    try:
+        queue.enqueue("P", upserts=_rows(3))
+        queue.enqueue("P", upserts=_rows(2), deletes=["k2"])
+        stats = _drain(queue)
+        assert sorted(api.upserted) == ["k0", "k1"]
+        assert api.deleted == ["k2"]
+        assert stats["coalesced"] == 3
+    finally:
+        queue.stop()
+
+
+def test_transient_failure_is_retried(tmp_path):
+    api = FakeApi()
+    api.down = True
+    queue = _queue(tmp_path, api)
+    try:
+        queue.enqueue("P", upserts=_rows(3))
+        queue.flush_now()
+        deadline = time.time() + 5
+        while queue.stats()["consecutive_failures"] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert queue.stats()["pending"] == 3 and not queue.dead_letters()
+
+        api.down = False
+        _drain(queue)
+        assert sorted(api.upserted) == ["k0", "k1", "k2"]
+    finally:
+        queue.stop()
+
+
+def test_rejected_rows_go_to_dead_letters(tmp_path):
+    api = FakeApi()
+    queue = _queue(tmp_path, api, batch_rows=8)
+    try:
+        queue.enqueue("P", upserts=_rows(20, bad={5}))
+        queue.enqueue("UNKNOWN", upserts=_rows(2), deletes=["x"])
+        stats = _drain(queue)
+        assert len(api.upserted) == 19 and "k5" not in api.upserted
+        assert stats["consecutive_failures"] == 0
+        dead = {(r["project"], r["key"]) for r in queue.dead_letters()}
+        assert dead == {("P", "k5"), ("UNKNOWN", "k0"), ("UNKNOWN", "k1"), ("UNKNOWN", "x")}
+    finally:
+        queue.stop()
+
+    # dead letters survive a restart; a newer change for the key supersedes its dead letter
+    queue = _queue(tmp_path, api)
+    try:
+        assert len(queue.dead_letters()) == 4
+        queue.enqueue("P", upserts=_rows(6).iloc[[5]])
+        assert queue.dead_letters("P") == []
+        assert queue.discard_dead_letters("UNKNOWN") == 3
+        assert not (tmp_path / "dead.jsonl").exists()
+    finally:
+        queue.stop()
+
+
+def test_retry_dead_letters(tmp_path):
+    api = FakeApi()
+    queue = _queue(tmp_path, api)
+    try:
+        queue.enqueue("P", upserts=_rows(2, bad={1}))
+        _drain(queue)
+        assert [r["key"] for r in queue.dead_letters("P")] == ["k1"]
+
+        api.upserts = lambda project_id, rows: api.upserted.extend(r["row_key"] for r in rows)
+        queue._send_upserts = api.upserts
+        assert queue.retry_dead_letters("P") == 1
+        _drain(queue)
+        assert api.upserted == ["k0", "k1"] and queue.dead_letters() == []
+    finally:
+        queue.stop()
@@ -0,0 +1,80 @@
+# tests/test_tree_utils.py
+import pandas as pd
+
+from tree_utils import (
+    bucket_placeholder,
+    build_branch_index,
+    build_nodes_and_lookup,
+    reconcile_tree_checked,
+    split_large_groups,
+    tree_checked_values,
+    update_selected_counts,
+)
+
+
+def _tree(n_big=12, n_small=3):
+    df = pd.DataFrame(
+        {
+            "Organ System": ["Heart"] * n_big + ["Lung"] * n_small,
+            "Group": ["Big"] * n_big + ["Small"] * n_small,
+            "Variable": [f"v{i:02d}" for i in range(n_big + n_small)],
+            "Source": "EPIC",
+            "__row_key__": [f"k{i:02d}" for i in range(n_big + n_small)],
+        }
+    )
+    nodes, lookup = build_nodes_and_lookup(df)
+    nodes, bucket_leaves = split_large_groups(nodes, threshold=10, size=5)
+    totals, leaf_branches = build_branch_index(df, bucket_leaves)
+    return df, nodes, lookup, bucket_leaves, totals, leaf_branches
+
+
+def _values(leaves):
+    return [leaf["value"] for leaf in leaves]
+
+
+def test_nodes_and_lookup():
+    df, nodes, lookup, bucket_leaves, totals, _ = _tree()
+    assert [n["value"] for n in nodes] == ["OS:Heart", "OS:Lung"]
+    assert len(lookup) == len(df)
+    assert lookup["ROW:k03"]["Variable"] == "v03"
+    assert sorted(bucket_leaves) == ["BK:Heart/Big#0", "BK:Heart/Big#1", "BK:Heart/Big#2"]
+    assert totals["GR:Heart/Big"] == 12 and totals["BK:Heart/Big#2"] == 2
+
+
+def test_checking_a_closed_bucket_selects_all_its_leaves():
+    _, _, _, bucket_leaves, totals, leaf_branches = _tree()
+    placeholder = bucket_placeholder("BK:Heart/Big#1")
+    selection = reconcile_tree_checked(["ROW:k13"], ["ROW:k13", placeholder], bucket_leaves, leaf_branches, set(), [])
+    assert set(selection) == {"ROW:k13", *_values(bucket_leaves["BK:Heart/Big#1"])}
+
+    counts = update_selected_counts({}, leaf_branches, selection, [])
+    checked = tree_checked_values(selection, leaf_branches, totals, counts, set())
+    assert placeholder in checked
+    # leaves of closed buckets are not rendered, so they are not passed to the widget
+    assert not set(_values(bucket_leaves["BK:Heart/Big#1"])) & set(checked)
+
+
+def test_unchecking_a_closed_bucket_drops_its_leaves():
+    _, _, _, bucket_leaves, _, leaf_branches = _tree()
+    bucket = _values(bucket_leaves["BK:Heart/Big#0"])
+    placeholder = bucket_placeholder("BK:Heart/Big#0")
+    selection = reconcile_tree_checked(bucket + ["ROW:k14"], ["ROW:k14"], bucket_leaves, leaf_branches, set(), [placeholder])
+    assert selection == ["ROW:k14"]
+
+
+def test_leaves_in_closed_buckets_survive_a_widget_round_trip():
+    _, _, _, bucket_leaves, _, leaf_branches = _tree()
+    hidden = _values(bucket_leaves["BK:Heart/Big#2"])[:1]
+    open_buckets = {"BK:Heart/Big#0"}
+    visible = _values(bucket_leaves["BK:Heart/Big#0"])[:2]
+    # the widget only returns what it rendered: the open bucket's leaves
+    selection = reconcile_tree_checked(hidden + visible, visible[:1], bucket_leaves, leaf_branches, open_buckets, [])
+    assert set(selection) == set(hidden + visible[:1])
+
+
+def test_selected_counts_follow_the_delta():
+    _, _, _, _, _, leaf_branches = _tree()
+    counts = update_selected_counts({}, leaf_branches, ["ROW:k00", "ROW:k12"], [])
+    assert counts["OS:Heart"] == 1 and counts["BK:Heart/Big#0"] == 1 and counts["GR:Lung/Small"] == 1
+    update_selected_counts(counts, leaf_branches, [], ["ROW:k00"])
+    assert counts["OS:Heart"] == 0 and counts["BK:Heart/Big#0"] == 0
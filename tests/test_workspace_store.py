@@ -0,0 +1,56 @@
+# tests/test_workspace_store.py
+import numpy as np
+import pandas as pd
+
+from overlay_journal import OverlayJournal
+from workspace_store import load_overlay, write_changes
+
+
+def _rows(keys, tag):
+    return pd.DataFrame({"__row_key__": list(keys), "Variable": [f"{k}-{tag}" for k in keys]})
+
+
+def _flush(journal, overlay, saved_version, db_path):
+    rows, deleted = journal.changes_since(saved_version, overlay)
+    write_changes("P", rows, deleted, None, None, db_path=db_path, overlay_order=overlay["__row_key__"] if len(overlay) else None)
+    return journal.version
+
+
+def _assert_stored(overlay, db_path):
+    stored = load_overlay("P", db_path=db_path)
+    if len(overlay) == 0:
+        assert len(stored) == 0
+        return
+    pd.testing.assert_frame_equal(stored[list(overlay.columns)], overlay.reset_index(drop=True), check_dtype=False)
+
+
+def test_update_keeps_its_position(tmp_path):
+    db = tmp_path / "ws.sqlite3"
+    journal = OverlayJournal()
+    overlay = journal.record("upload", pd.DataFrame(), upserts=_rows(["a", "b", "c"], 1))
+    saved = _flush(journal, overlay, 0, db)
+    overlay = journal.record("upload", overlay, upserts=_rows(["b", "d"], 2))
+    assert list(overlay["__row_key__"]) == ["a", "b", "c", "d"]
+    _flush(journal, overlay, saved, db)
+    _assert_stored(overlay, db)
+
+
+def test_stored_order_matches_the_session(tmp_path):
+    db = tmp_path / "ws.sqlite3"
+    rng = np.random.default_rng(3)
+    journal = OverlayJournal()
+    overlay = pd.DataFrame()
+    saved = 0
+    for step in range(120):
+        action = rng.integers(5)
+        keys = [f"k{i}" for i in rng.choice(20, size=rng.integers(1, 5), replace=False)]
+        if action == 0 and journal.can_undo():
+            overlay = journal.undo(overlay)
+        elif action == 1 and journal.can_redo():
+            overlay = journal.redo(overlay)
+        elif action == 2 and len(overlay):
+            overlay = journal.record("delete", overlay, deletes=keys)
+        else:
+            overlay = journal.record("upload", overlay, upserts=_rows(keys, step))
+        saved = _flush(journal, overlay, saved, db)
+        _assert_stored(overlay, db)
@@ -1,6 +1,13 @@
 # tree_utils.py
 import hashlib
 import json
+import os
+from collections.abc import Mapping
+
+import pandas as pd
+
+BUCKET_THRESHOLD = 1000  # groups with more variables than this are split into buckets
+BUCKET_SIZE = 500
 
 
 def _make_row_key(row: dict, cols: list[str]) -> str:
@@ -17,9 +24,32 @@ def _make_row_key(row: dict, cols: list[str]) -> str:
     return hashlib.md5(raw.encode("utf-8")).hexdigest()[:10]
 
 
+class LeafLookup(Mapping):
+    """
+    leaf_value -> row dict, read from the tree's frame on access. Pages only
+    look up the handful of leaves they act on, so no dict is built per row.
+    """
+
+    def __init__(self, df, leaf_values):
+        self._df = df.reset_index(drop=True)
+        self._values = pd.Index(leaf_values)
+
+    def __getitem__(self, leaf_value):
+        pos = self._values.get_indexer([leaf_value])[0]
+        if pos == -1:
+            raise KeyError(leaf_value)
+        return self._df.iloc[pos].to_dict()
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
 def build_nodes_and_lookup(df):
     """
-    Build the tree nodes and a lookup dict from leaf_value -> row_dict.
+    Build the tree nodes and a lookup from leaf_value -> row_dict (LeafLookup).
 
     KEY POINT:
     - Leaves are identified by a STABLE value: "ROW:<__row_key__>"
@@ -46,63 +76,254 @@ def build_nodes_and_lookup(df):
     # Keep last occurrence for duplicates (overlay updates, etc.)
     df = df.drop_duplicates(subset=["__row_key__"], keep="last")
 
-    nodes = []
-    leaf_lookup = {}
-
     # Sort for stable tree ordering
     df_sorted = df.sort_values(["Organ System", "Group", "Variable"])
 
-    for os_name, os_df in df_sorted.groupby("Organ System", dropna=False):
-        os_name = str(os_name)
-
-        os_node = {
-            "label": os_name,
-            "value": f"OS:{os_name}",
-            "children": [],
-        }
+    # human labels + STABLE leaf values (selection-safe), one column operation each
+    if "Variable" in df_sorted.columns:
+        variables = df_sorted["Variable"].str.strip()
+    else:
+        variables = pd.Series("", index=df_sorted.index)
+    labels = variables.where(variables != "", "(Unnamed variable)")
+    if "Source" in df_sorted.columns:
+        source = df_sorted["Source"].fillna("").astype(str)
+        labels = labels.where(source == "", labels + " (" + source + ")")
+    leaf_values = "ROW:" + df_sorted["__row_key__"].str.strip()
+    leaves = [{"label": label, "value": value} for label, value in zip(labels, leaf_values)]
 
-        for group_name, group_df in os_df.groupby("Group", dropna=False):
-            group_name = str(group_name)
+    nodes = []
+    os_node = None
+    # df_sorted is ordered by (Organ System, Group): every group is a contiguous run of leaves
+    groups = df_sorted.groupby(["Organ System", "Group"], sort=False).indices
+    for (os_name, group_name), rows in groups.items():
+        os_name, group_name = str(os_name), str(group_name)
+        if os_node is None or os_node["value"] != f"OS:{os_name}":
+            os_node = {
+                "label": os_name,
+                "value": f"OS:{os_name}",
+                "children": [],
+            }
+            nodes.append(os_node)
 
-            group_node = {
+        os_node["children"].append(
+            {
                 "label": group_name,
                 "value": f"GR:{os_name}/{group_name}",
-                "children": [],
+                "children": leaves[rows[0] : rows[-1] + 1],
             }
+        )
+
+    return nodes, LeafLookup(df_sorted, leaf_values)
+
+
+def compute_row_key_from_df_row(row: dict, dedup_cols: list[str]) -> str:
+    """
+    Compute a stable __row_key__ for a row, given the exact columns that define identity.
+
+    Use this in:
+    - initial base dataset creation (if needed)
+    - upload/upsert logic (to match existing rows)
+    """
+    return _make_row_key(row, dedup_cols)
 
-            for _, row in group_df.iterrows():
-                var = str(row.get("Variable", "")).strip()
-                row_key = str(row["__row_key__"]).strip()
 
-                # human label
-                label_parts = [var] if var else ["(Unnamed variable)"]
-                source = row.get("Source")
-                if source:
-                    label_parts.append(f"({source})")
-                label = " ".join(label_parts)
+def build_branch_index(df, bucket_leaves: dict | None = None):
+    """
+    Per-branch totals + leaf -> branch mapping, for count labels in the tree.
 
-                # STABLE leaf value (selection-safe)
-                leaf_value = f"ROW:{row_key}"
+    Returns:
+    - totals: {"OS:<os>": n, "GR:<os>/<group>": n, "BK:<os>/<group>#<i>": n}  (one grouped aggregation)
+    - leaf_branches: {"ROW:<__row_key__>": ("OS:<os>", "GR:<os>/<group>"[, "BK:..."])}
 
-                leaf = {"label": label, "value": leaf_value}
-                group_node["children"].append(leaf)
+    Uses the same grouping/dedup rules as build_nodes_and_lookup(), so the
+    values match the tree's node values. Buckets come from split_large_groups().
+    """
+    df = df[["Organ System", "Group", "__row_key__"]].copy()
+    for col in ["Organ System", "Group"]:
+        df[col] = df[col].fillna("Unknown").astype(str)
+    df["__row_key__"] = df["__row_key__"].astype(str)
+    df = df.drop_duplicates(subset=["__row_key__"], keep="last")
 
-                # lookup leaf -> full row dict
-                leaf_lookup[leaf_value] = row.to_dict()
+    os_values = "OS:" + df["Organ System"]
+    gr_values = "GR:" + df["Organ System"] + "/" + df["Group"]
 
-            os_node["children"].append(group_node)
+    totals = {}
+    totals.update(os_values.value_counts().to_dict())
+    totals.update(gr_values.value_counts().to_dict())
 
-        nodes.append(os_node)
+    leaf_branches = dict(zip("ROW:" + df["__row_key__"], zip(os_values, gr_values)))
 
-    return nodes, leaf_lookup
+    for bucket, leaves in (bucket_leaves or {}).items():
+        totals[bucket] = len(leaves)
+        for leaf in leaves:
+            leaf_branches[leaf["value"]] += (bucket,)
+    return totals, leaf_branches
 
 
-def compute_row_key_from_df_row(row: dict, dedup_cols: list[str]) -> str:
+def update_selected_counts(counts: dict, leaf_branches: dict, added, removed) -> dict:
+    """Apply a selection delta to per-branch selected counts (in place). O(len(delta))."""
+    for leaf_value, step in [(v, 1) for v in added] + [(v, -1) for v in removed]:
+        branches = leaf_branches.get(leaf_value)
+        if branches is None:
+            continue
+        for branch in branches:
+            counts[branch] = counts.get(branch, 0) + step
+    return counts
+
+
+def label_nodes_with_counts(nodes, totals: dict, selected_counts: dict):
     """
-    Compute a stable __row_key__ for a row, given the exact columns that define identity.
+    Copy of the organ-system/group/bucket nodes with "(selected/total)" in their labels.
+    Leaf lists are shared, not copied, so this is O(branches).
+    """
+    def relabel(node):
+        value = node.get("value")
+        total = totals.get(value, 0)
+        selected = selected_counts.get(value, 0)
+        # labels in build_nodes_and_lookup are the plain names
+        suffix = f" ({selected}/{total} selected)" if selected else f" ({total})"
+        out = dict(node)
+        out["label"] = f"{node['label']}{suffix}"
+        if value.startswith("OS:") or is_bucketed_group(node):
+            out["children"] = [relabel(child) for child in node.get("children", [])]
+        return out
 
-    Use this in:
-    - initial base dataset creation (if needed)
-    - upload/upsert logic (to match existing rows)
+    return [relabel(node) for node in nodes]
+
+
+# -----------------------------
+# buckets for large groups
+# -----------------------------
+def is_bucket(value) -> bool:
+    return str(value).startswith("BK:")
+
+
+def is_bucketed_group(node: dict) -> bool:
+    children = node.get("children") or []
+    return str(node.get("value", "")).startswith("GR:") and bool(children) and is_bucket(children[0].get("value"))
+
+
+def bucket_placeholder(bucket: str) -> str:
+    """Value of the single stand-in leaf of a closed bucket."""
+    return f"{bucket}#all"
+
+
+def _range_label(first: dict, last: dict, width: int = 3) -> str:
+    """"Alb – Bil": shortest label prefixes (at least `width` chars) that tell the two ends apart."""
+    a, b = first["label"], last["label"]
+    n = max(width, len(os.path.commonprefix([a, b])) + 1)
+    return f"{a[:n].strip() or '…'} – {b[:n].strip() or '…'}"
+
+
+def split_large_groups(nodes, threshold: int = BUCKET_THRESHOLD, size: int = BUCKET_SIZE):
     """
-    return _make_row_key(row, dedup_cols)
+    Replace the leaves of groups with more than `threshold` variables by
+    buckets of `size` leaves, labeled like "Alb – Bil (1–500 of 30,000)".
+
+    A closed bucket holds one placeholder leaf instead of its variables, so the
+    tree widget only receives the leaves of open buckets (see
+    materialize_buckets); checking a closed bucket checks the placeholder,
+    i.e. the whole block (see reconcile_tree_checked).
+
+    Returns (nodes, bucket_leaves) with bucket_leaves = {"BK:<os>/<group>#<i>": [leaf nodes]}.
+    """
+    bucket_leaves = {}
+    out = []
+    for os_node in nodes:
+        os_children = []
+        for group_node in os_node.get("children", []):
+            leaves = group_node.get("children", [])
+            if len(leaves) <= threshold:
+                os_children.append(group_node)
+                continue
+
+            buckets = []
+            for i, start in enumerate(range(0, len(leaves), size)):
+                chunk = leaves[start : start + size]
+                value = f"BK:{group_node['value'][len('GR:'):]}#{i}"
+                bucket_leaves[value] = chunk
+                buckets.append(
+                    {
+                        "label": f"{_range_label(chunk[0], chunk[-1])} ({start + 1:,}–{start + len(chunk):,} of {len(leaves):,})",
+                        "value": value,
+                        "children": [{"label": f"All {len(chunk):,} variables", "value": bucket_placeholder(value)}],
+                    }
+                )
+            os_children.append({**group_node, "children": buckets})
+        out.append({**os_node, "children": os_children})
+    return out, bucket_leaves
+
+
+def materialize_buckets(nodes, bucket_leaves: dict, open_buckets):
+    """Copy of `nodes` with the real leaves in every open bucket (only the path to them is copied)."""
+    open_buckets = set(open_buckets) & bucket_leaves.keys()
+    if not open_buckets:
+        return nodes
+
+    def fill(node):
+        value = node.get("value", "")
+        if value in open_buckets:
+            return {**node, "children": bucket_leaves[value]}
+        if value.startswith("OS:") or is_bucketed_group(node):
+            return {**node, "children": [fill(child) for child in node.get("children", [])]}
+        return node
+
+    return [fill(node) for node in nodes]
+
+
+def _leaf_visible(leaf_value: str, leaf_branches: dict, open_buckets) -> bool:
+    branches = leaf_branches.get(leaf_value)
+    return branches is None or len(branches) < 3 or branches[2] in open_buckets
+
+
+def tree_checked_values(selection, leaf_branches: dict, totals: dict, selected_counts: dict, open_buckets) -> list[str]:
+    """
+    `checked` for tree_select: the selected leaves the tree actually renders,
+    plus the placeholder of every closed bucket that is fully selected.
+    """
+    checked = [v for v in selection if _leaf_visible(v, leaf_branches, open_buckets)]
+    checked += [
+        bucket_placeholder(value)
+        for value, total in totals.items()
+        if is_bucket(value) and value not in open_buckets and total and selected_counts.get(value, 0) >= total
+    ]
+    return checked
+
+
+def reconcile_tree_checked(previous, returned, bucket_leaves: dict, leaf_branches: dict, open_buckets, placeholders) -> list[str]:
+    """
+    Selection after a tree_select interaction, in checked_all_list terms.
+
+    The widget only knows the leaves it rendered, so leaves in closed buckets
+    are carried over from `previous`. A closed bucket whose placeholder got
+    checked (was not in the `placeholders` passed at render time) adds the
+    whole bucket; one whose placeholder got unchecked removes it.
+    """
+    returned_set = set(returned)
+    selection = dict.fromkeys(v for v in previous if not _leaf_visible(v, leaf_branches, open_buckets))
+    selection.update(dict.fromkeys(v for v in returned if not is_bucket(v)))
+
+    for bucket, leaves in bucket_leaves.items():
+        if bucket in open_buckets:
+            continue
+        placeholder = bucket_placeholder(bucket)
+        if placeholder in returned_set and placeholder not in placeholders:
+            selection.update(dict.fromkeys(leaf["value"] for leaf in leaves))
+        elif placeholder in placeholders and placeholder not in returned_set:
+            for leaf in leaves:
+                selection.pop(leaf["value"], None)
+    return list(selection)
+
+
+def tree_widget_key(state) -> str:
+    """
+    Key of the tree_select widget. The component keeps its own checked state
+    once the user clicked, so a programmatic change (or opening a bucket) needs
+    a fresh widget: reset_tree_widget() moves to a new key.
+    """
+    return f"var_tree_{state.get('tree_generation', 0)}"
+
+
+def reset_tree_widget(state) -> None:
+    state.pop(tree_widget_key(state), None)
+    state["tree_generation"] = state.get("tree_generation", 0) + 1
@@ -0,0 +1,221 @@
+# upload_ingest.py
+import io
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import PurePosixPath
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from data_store import upsert_overlay_from_upload
+from upload_validation import MAX_ERRORS, ValidationResult, known_units, validate_upload
+
+SUPPORTED_TYPES = ["csv", "xlsx", "zip"]
+
+
+# -----------------------------
+# expand uploads into parseable parts
+# -----------------------------
+def _suffix(name: str) -> str:
+    return PurePosixPath(name).suffix.lower().lstrip(".")
+
+
+def expand_uploads(files: list[tuple[str, bytes]]) -> list[tuple[str, str, bytes]]:
+    """
+    Turn uploaded (file_name, bytes) pairs into (label, kind, bytes) parts.
+
+    - CSV / XLSX are passed through
+    - ZIP bundles are unpacked (one level, CSV/XLSX members only)
+
+    Order is deterministic: files sorted by name, zip members sorted by name.
+    """
+    parts = []
+    for name, data in sorted(files, key=lambda f: f[0]):
+        kind = _suffix(name)
+        if kind in ("csv", "xlsx"):
+            parts.append((name, kind, data))
+        elif kind == "zip":
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                for member in sorted(zf.namelist()):
+                    if member.endswith("/") or member.startswith("__MACOSX/"):
+                        continue
+                    member_kind = _suffix(member)
+                    if member_kind in ("csv", "xlsx"):
+                        parts.append((f"{name}/{member}", member_kind, zf.read(member)))
+        else:
+            raise ValueError(f"Unsupported file type: {name}")
+    return parts
+
+
+# -----------------------------
+# parsing (runs in worker processes)
+# -----------------------------
+def _parse_part(label: str, kind: str, data: bytes) -> list[tuple[str, pd.DataFrame]]:
+    """
+    Parse one part into (label, df) chunks.
+    XLSX workbooks yield one chunk per sheet, in workbook order.
+    """
+    if kind == "csv":
+        return [(label, pd.read_csv(io.BytesIO(data)))]
+
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=None)
+    chunks = []
+    for sheet_name, sheet_df in sheets.items():
+        sheet_df = sheet_df.copy()
+        # one sheet per organ system: use the sheet name if the column is missing
+        if "Organ System" not in [str(c).strip() for c in sheet_df.columns]:
+            sheet_df["Organ System"] = str(sheet_name)
+        chunks.append((f"{label} [{sheet_name}]", sheet_df))
+    return chunks
+
+
+def parse_uploads(
+    files: list[tuple[str, bytes]],
+    max_workers: int | None = None,
+    progress: Callable[[float, str], None] | None = None,
+) -> list[tuple[str, pd.DataFrame]]:
+    """
+    Parse all uploaded files (CSV, XLSX, ZIP of those) into (label, df) chunks.
+
+    Parts are parsed in a process pool; results keep the deterministic order of
+    expand_uploads() regardless of which worker finishes first.
+    `progress(fraction, message)` is called after each part (may raise to cancel).
+    """
+    parts = expand_uploads(files)
+    if not parts:
+        return []
+
+    labels, kinds, payloads = zip(*parts)
+    results = []
+
+    if len(parts) == 1 or max_workers == 1:
+        # not worth spawning a pool for a single file (or already inside a worker)
+        for label, kind, data in parts:
+            results.append(_parse_part(label, kind, data))
+            if progress:
+                progress(len(results) / len(parts), f"Parsed {label}")
+    else:
+        workers = max_workers or min(len(parts), os.cpu_count() or 1)
+        # spawn, not fork: this runs on a job thread of a multithreaded server,
+        # and a forked child can inherit locks held by other threads
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            for i, part_chunks in enumerate(pool.map(_parse_part, labels, kinds, payloads), start=1):
+                results.append(part_chunks)
+                if progress:
+                    progress(i / len(parts), f"Parsed {labels[i - 1]} ({i}/{len(parts)})")
+        finally:
+            # on cancel/failure, drop parts that have not started yet
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    return [chunk for part_chunks in results for chunk in part_chunks]
+
+
+# -----------------------------
+# validation
+# -----------------------------
+def validate_chunks(
+    chunks: list[tuple[str, pd.DataFrame]], max_errors: int = MAX_ERRORS, units: frozenset[str] | None = None
+) -> list[ValidationResult]:
+    """Validate every chunk; the error-table cap is shared across all chunks. `units` as in validate_upload."""
+    units = known_units() if units is None else units
+    results = []
+    budget = max_errors
+    for _, chunk_df in chunks:
+        result = validate_upload(chunk_df, max_errors=budget, units=units)
+        budget = max(0, budget - len(result.errors))
+        results.append(result)
+    return results
+
+
+def combine_validation_reports(
+    chunks: list[tuple[str, pd.DataFrame]], results: list[ValidationResult]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """(capped error table, exact per-rule counts), both with a leading File column."""
+    errors = [r.errors.assign(File=label) for (label, _), r in zip(chunks, results) if len(r.errors)]
+    counts = [r.counts.assign(File=label) for (label, _), r in zip(chunks, results) if len(r.counts)]
+    errors_df = pd.concat(errors, ignore_index=True) if errors else pd.DataFrame()
+    counts_df = pd.concat(counts, ignore_index=True) if counts else pd.DataFrame()
+    for df in (errors_df, counts_df):
+        if len(df):
+            df.insert(0, "File", df.pop("File"))
+    return errors_df, counts_df
+
+
+# -----------------------------
+# merge
+# -----------------------------
+def merge_parsed_uploads(
+    chunks: list[tuple[str, pd.DataFrame]],
+    validations: list[ValidationResult] | None = None,
+    state=None,
+) -> tuple[list[dict], pd.DataFrame]:
+    """
+    Merge parsed chunks into the overlay with upsert semantics, as ONE overlay
+    change (one journal entry, so one undo step per upload). Chunks are
+    concatenated in deterministic order, so later chunks win on the same key.
+    Rows failing an "error" validation rule are skipped.
+
+    Per-file Added/Updated are counted per row (user_created or not).
+
+    Must run on the script thread (writes the overlay); `state` as in data_store.
+    Returns: (per_file_summaries, processed_df_for_auto_checking)
+    """
+    if not chunks:
+        return [], pd.DataFrame()
+
+    parts = []
+    rejected = []
+    for i, (_, chunk_df) in enumerate(chunks):
+        if validations is not None:
+            chunk_df = chunk_df.loc[validations[i].valid_mask]
+        rejected.append(validations[i].skipped if validations is not None else 0)
+        parts.append(chunk_df.rename(columns=lambda c: str(c).strip()))
+
+    # the upload keeps the concatenated row labels, which map rows back to their chunk
+    upload_df = pd.concat(parts, ignore_index=True)
+    ends = np.cumsum([len(p) for p in parts])
+    _, _, _, processed_df = upsert_overlay_from_upload(upload_df, state=state)
+
+    chunk_of = np.searchsorted(ends, processed_df.index.to_numpy(), side="right")
+    new_flags = processed_df["user_created"].to_numpy(dtype=bool) if len(processed_df) else np.array([], dtype=bool)
+    summaries = []
+    for i, (label, chunk_df) in enumerate(chunks):
+        in_chunk = chunk_of == i
+        added = int(new_flags[in_chunk].sum())
+        merged = int(in_chunk.sum())
+        summaries.append(
+            {
+                "File": label,
+                "Rows": int(len(chunk_df)),
+                "Added": added,
+                "Updated": merged - added,
+                "Skipped": rejected[i] + len(parts[i]) - merged,
+            }
+        )
+
+    return summaries, processed_df.reset_index(drop=True)
+
+
+def ingest_uploads(
+    files: list[tuple[str, bytes]], state=None, max_workers: int | None = None
+) -> tuple[list[dict], pd.DataFrame]:
+    """Parse + validate + merge in one go (no background job)."""
+    chunks = parse_uploads(files, max_workers=max_workers)
+    return merge_parsed_uploads(chunks, validate_chunks(chunks), state=state)
+
+
+def parse_uploads_job(
+    job, files: list[tuple[str, bytes]], units: frozenset[str] | None = None
+) -> tuple[list, list[ValidationResult]]:
+    """
+    jobs.JobRunner entry point: parse + validate in the background,
+    merge later on the script thread. Returns (chunks, validations).
+    `units`: accepted units, collected on the script thread (the session's master).
+    """
+    chunks = parse_uploads(files, progress=lambda p, msg: job.report(0.8 * p, msg))
+    job.report(0.8, "Validating rows…")
+    return chunks, validate_chunks(chunks, units=units)
@@ -0,0 +1,140 @@
+# upload_validation.py
+"""
+Rule-based validation of uploaded mapping rows.
+
+Every rule is a column operation that yields a boolean mask over all rows, so
+one pass over the upload evaluates everything. Errors are collected as integer
+row positions per rule (no Python object per error) and only the first
+`max_errors` are materialized into the downloadable error table; per-rule
+counts are always exact.
+
+Severity:
+- "error"   => row is skipped on import
+- "warning" => row is imported, but reported
+"""
+from dataclasses import dataclass
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+EPIC_ID_PATTERN = r"^E-[A-Za-z0-9][A-Za-z0-9_-]*$"
+PDMS_ID_PATTERN = r"^P-[A-Za-z0-9][A-Za-z0-9_-]*$"
+ALLOWED_SOURCES = ["Both", "EPIC", "PDMS"]
+# common units; known_units() adds every unit the mapping already uses
+KNOWN_UNITS = [
+    "mmHg", "bpm", "%", "°C", "kg", "g", "g/L", "g/dL", "mg/L", "mg/dL", "mmol/L", "µmol/L", "umol/L",
+    "mL", "L", "L/min", "mL/h", "mL/min", "U/L", "breaths/min", "score", "cmH2O", "kPa", "s", "min", "h",
+]
+MAX_VARIABLE_LENGTH = 200
+MAX_ID_LENGTH = 64
+MAX_ERRORS = 10_000
+
+ERROR_COLS = ["Row", "Rule", "Severity", "Column", "Value"]
+
+
+@dataclass
+class ValidationResult:
+    valid_mask: np.ndarray  # True => row can be imported (no "error" severity hit)
+    errors: pd.DataFrame  # capped per-row table (ERROR_COLS)
+    counts: pd.DataFrame  # exact per-rule counts: Rule, Severity, Column, Rows
+    missing_columns: list[str]
+
+    @property
+    def total_errors(self) -> int:
+        return int(self.counts["Rows"].sum()) if len(self.counts) else 0
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_errors > len(self.errors)
+
+    @property
+    def skipped(self) -> int:
+        return int((~self.valid_mask).sum())
+
+
+def known_units(mapping_units: Iterable[str] | None = None) -> frozenset[str]:
+    """KNOWN_UNITS plus the units used in the mapping (the current base release if not given)."""
+    if mapping_units is None:
+        from data_store import current_base_release
+
+        base_df = current_base_release().df
+        mapping_units = base_df["Unit"] if "Unit" in base_df.columns else []
+    units = pd.Series(list(mapping_units), dtype=object).dropna().astype(str).str.strip()
+    return frozenset(KNOWN_UNITS) | frozenset(units[units != ""])
+
+
+def _text(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[col].fillna("").astype(str).str.strip()
+
+
+def _rules(df: pd.DataFrame, units: frozenset[str]) -> list[tuple[str, str, str, pd.Series]]:
+    """(rule, severity, column, failing-row mask) for every row-level rule."""
+    variable = _text(df, "Variable")
+    epic = _text(df, "EPIC ID")
+    pdms = _text(df, "PDMS ID")
+    source = _text(df, "Source")
+    unit = _text(df, "Unit")
+
+    rules = [
+        ("Variable is empty", "error", "Variable", variable == ""),
+        (f"Variable longer than {MAX_VARIABLE_LENGTH} characters", "error", "Variable", variable.str.len() > MAX_VARIABLE_LENGTH),
+        (f"EPIC ID longer than {MAX_ID_LENGTH} characters", "error", "EPIC ID", epic.str.len() > MAX_ID_LENGTH),
+        (f"PDMS ID longer than {MAX_ID_LENGTH} characters", "error", "PDMS ID", pdms.str.len() > MAX_ID_LENGTH),
+        ("EPIC ID format", "warning", "EPIC ID", (epic != "") & ~epic.str.match(EPIC_ID_PATTERN)),
+        ("PDMS ID format", "warning", "PDMS ID", (pdms != "") & ~pdms.str.match(PDMS_ID_PATTERN)),
+        ("Source not one of " + "/".join(ALLOWED_SOURCES), "warning", "Source", (source != "") & ~source.isin(ALLOWED_SOURCES)),
+        ("Source EPIC/Both without EPIC ID", "warning", "EPIC ID", source.isin(["EPIC", "Both"]) & (epic == "")),
+        ("Source PDMS/Both without PDMS ID", "warning", "PDMS ID", source.isin(["PDMS", "Both"]) & (pdms == "")),
+        ("Unknown unit", "warning", "Unit", (unit != "") & ~unit.isin(units)),
+    ]
+    return [(name, severity, col, mask.to_numpy(dtype=bool)) for name, severity, col, mask in rules]
+
+
+def validate_upload(
+    upload_df: pd.DataFrame, max_errors: int = MAX_ERRORS, units: frozenset[str] | None = None
+) -> ValidationResult:
+    """`units`: accepted units (default known_units())."""
+    units = known_units() if units is None else units
+    df = upload_df.copy()
+    df.columns = [str(c).strip() for c in df.columns]
+    n_rows = len(df)
+
+    missing_columns = [c for c in ["Variable"] if c not in df.columns]
+
+    valid_mask = np.ones(n_rows, dtype=bool)
+    count_rows = []
+    error_parts = []
+    budget = max_errors
+
+    for name, severity, col, mask in _rules(df, units):
+        n_failed = int(mask.sum())
+        if n_failed == 0:
+            continue
+        count_rows.append({"Rule": name, "Severity": severity, "Column": col, "Rows": n_failed})
+        if severity == "error":
+            valid_mask &= ~mask
+
+        if budget > 0:
+            positions = np.flatnonzero(mask)[:budget]
+            budget -= len(positions)
+            values = df[col].to_numpy()[positions] if col in df.columns else np.full(len(positions), "")
+            error_parts.append(
+                pd.DataFrame(
+                    {
+                        "Row": positions + 1,
+                        "Rule": name,
+                        "Severity": severity,
+                        "Column": col,
+                        "Value": values,
+                    }
+                )
+            )
+
+    errors = pd.concat(error_parts, ignore_index=True) if error_parts else pd.DataFrame(columns=ERROR_COLS)
+    errors = errors.sort_values(["Row", "Rule"], kind="stable").reset_index(drop=True)
+    counts = pd.DataFrame(count_rows, columns=["Rule", "Severity", "Column", "Rows"])
+
+    return ValidationResult(valid_mask=valid_mask, errors=errors, counts=counts, missing_columns=missing_columns)
@@ -0,0 +1,291 @@
+# workspace_store.py
+"""
+Durable per-project workspaces (overlay + selection) in a local SQLite file.
+
+- rows are indexed by (project, __row_key__) / (project, leaf)
+- resuming a project loads the selection right away and the overlay lazily
+  (data_store.get_overlay_df() pulls it on first access)
+- writes are batched: flush_workspace() runs once at the end of a rerun and
+  writes only what changed since the last flush (journal delta + selection diff)
+"""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import streamlit as st
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# pandas is imported where it is needed, so the Overview page (list/open/flush)
+# renders without paying for it on a cold start
+
+WORKSPACE_DB_PATH = Path(os.getenv("KIM_WORKSPACE_DB", ".kim_varmap/workspaces.sqlite3"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    project TEXT PRIMARY KEY,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS overlay_rows (
+    project TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (project, row_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS overlay_rows_by_position ON overlay_rows (project, position);
+CREATE TABLE IF NOT EXISTS selection (
+    project TEXT NOT NULL,
+    leaf TEXT NOT NULL,
+    PRIMARY KEY (project, leaf)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS selection_rules (
+    project TEXT NOT NULL,
+    name TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    PRIMARY KEY (project, name)
+) WITHOUT ROWID;
+"""
+
+
+# -----------------------------
+# low-level db
+# -----------------------------
+def _connect(db_path: Path | None = None) -> sqlite3.Connection:
+    db_path = Path(db_path or WORKSPACE_DB_PATH)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def list_projects(db_path: Path | None = None) -> list[str]:
+    with closing(_connect(db_path)) as conn:
+        return [r[0] for r in conn.execute("SELECT project FROM projects ORDER BY updated_at DESC")]
+
+
+def project_stats(project: str, db_path: Path | None = None) -> tuple[int, int]:
+    """(overlay rows, selected leaves) stored for a project."""
+    with closing(_connect(db_path)) as conn:
+        n_rows = conn.execute("SELECT COUNT(*) FROM overlay_rows WHERE project = ?", (project,)).fetchone()[0]
+        n_sel = conn.execute("SELECT COUNT(*) FROM selection WHERE project = ?", (project,)).fetchone()[0]
+    return int(n_rows), int(n_sel)
+
+
+def load_overlay(project: str, db_path: Path | None = None) -> pd.DataFrame:
+    import pandas as pd
+
+    with closing(_connect(db_path)) as conn:
+        payloads = [
+            r[0]
+            for r in conn.execute(
+                "SELECT payload FROM overlay_rows WHERE project = ? ORDER BY position", (project,)
+            )
+        ]
+    if not payloads:
+        return pd.DataFrame()
+    # one json parse for all rows instead of one per row
+    return pd.DataFrame(json.loads("[" + ",".join(payloads) + "]"))
+
+
+def load_selection(project: str, db_path: Path | None = None) -> list[str]:
+    with closing(_connect(db_path)) as conn:
+        return [r[0] for r in conn.execute("SELECT leaf FROM selection WHERE project = ? ORDER BY leaf", (project,))]
+
+
+def load_rules(project: str, db_path: Path | None = None) -> dict[str, dict]:
+    with closing(_connect(db_path)) as conn:
+        rows = conn.execute("SELECT name, rule FROM selection_rules WHERE project = ? ORDER BY name", (project,))
+        return {name: json.loads(rule) for name, rule in rows}
+
+
+def save_rule(project: str, name: str, rule: dict, db_path: Path | None = None) -> None:
+    with closing(_connect(db_path)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO selection_rules (project, name, rule) VALUES (?, ?, ?)",
+            (project, name, json.dumps(rule)),
+        )
+
+
+def delete_rule(project: str, name: str, db_path: Path | None = None) -> None:
+    with closing(_connect(db_path)) as conn, conn:
+        conn.execute("DELETE FROM selection_rules WHERE project = ? AND name = ?", (project, name))
+
+
+def _stored_keys(conn: sqlite3.Connection, project: str, keys: list[str], chunk: int = 500) -> set[str]:
+    """Which of `keys` the project already has."""
+    found = set()
+    for start in range(0, len(keys), chunk):
+        part = keys[start : start + chunk]
+        found.update(
+            r[0]
+            for r in conn.execute(
+                f"SELECT row_key FROM overlay_rows WHERE project = ? AND row_key IN ({','.join('?' * len(part))})",
+                (project, *part),
+            )
+        )
+    return found
+
+
+def write_changes(
+    project: str,
+    upsert_rows: pd.DataFrame,
+    deleted_keys,
+    selected_added,
+    selected_removed,
+    db_path: Path | None = None,
+    replace_overlay: bool = False,
+    overlay_order=None,
+) -> None:
+    """
+    Apply one batch of changes for a project in a single transaction.
+
+    Updated rows keep their stored position and new rows go to the end, like
+    in the session's overlay (OverlayJournal). overlay_order (the session's
+    overlay keys, in order) covers the one case that doesn't hold: rows put
+    back mid-overlay by an undo; then positions are renumbered to match.
+    replace_overlay: upsert_rows is the whole overlay (stored rows not in it are dropped).
+    """
+    now_iso = datetime.now().isoformat(timespec="seconds")
+    with closing(_connect(db_path)) as conn, conn:
+        conn.execute(
+            "INSERT INTO projects (project, updated_at) VALUES (?, ?) "
+            "ON CONFLICT(project) DO UPDATE SET updated_at = excluded.updated_at",
+            (project, now_iso),
+        )
+
+        if replace_overlay:
+            conn.execute("DELETE FROM overlay_rows WHERE project = ?", (project,))
+        if deleted_keys is not None and len(deleted_keys) > 0:
+            conn.executemany(
+                "DELETE FROM overlay_rows WHERE project = ? AND row_key = ?",
+                [(project, str(k)) for k in deleted_keys],
+            )
+
+        if upsert_rows is not None and len(upsert_rows) > 0:
+            start = conn.execute(
+                "SELECT COALESCE(MAX(position), 0) FROM overlay_rows WHERE project = ?", (project,)
+            ).fetchone()[0]
+            # to_json handles NaN/NA/timestamps consistently; one payload per row
+            payloads = upsert_rows.to_json(orient="records", lines=True, force_ascii=False).splitlines()
+            keys = upsert_rows["__row_key__"].astype(str).tolist()
+            stored = set() if replace_overlay else _stored_keys(conn, project, keys)
+            new_keys = [k for k in keys if k not in stored]
+            conn.executemany(
+                "INSERT INTO overlay_rows (project, row_key, position, payload) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(project, row_key) DO UPDATE SET payload = excluded.payload",
+                [(project, k, start + i, p) for i, (k, p) in enumerate(zip(keys, payloads), start=1)],
+            )
+            if overlay_order is not None and new_keys:
+                order = [str(k) for k in overlay_order]
+                if order[len(order) - len(new_keys) :] != new_keys:
+                    conn.executemany(
+                        "UPDATE overlay_rows SET position = ? WHERE project = ? AND row_key = ?",
+                        [(i, project, k) for i, k in enumerate(order, start=1)],
+                    )
+
+        if selected_removed:
+            conn.executemany(
+                "DELETE FROM selection WHERE project = ? AND leaf = ?",
+                [(project, leaf) for leaf in selected_removed],
+            )
+        if selected_added:
+            conn.executemany(
+                "INSERT OR IGNORE INTO selection (project, leaf) VALUES (?, ?)",
+                [(project, leaf) for leaf in selected_added],
+            )
+
+
+# -----------------------------
+# session glue
+# -----------------------------
+def open_workspace(project: str) -> tuple[int, int]:
+    """
+    Switch the session to `project`.
+
+    - saved project => selection restored now, overlay loaded lazily on first access
+    - new project => whatever the session already has is saved under it
+
+    Returns the (overlay rows, selected leaves) counts of the workspace.
+    """
+    from data_store import get_overlay_df, get_overlay_journal
+
+    n_rows, n_sel = project_stats(project)
+    st.session_state["workspace_project"] = project
+
+    if n_rows == 0 and n_sel == 0:
+        # new workspace: adopt the current session state as its first batch
+        overlay_df = get_overlay_df()
+        selection = set(st.session_state.get("checked_all_list", []))
+        write_changes(project, overlay_df, None, selection, None)
+        for name, rule in st.session_state.get("saved_selection_rules", {}).items():
+            save_rule(project, name, rule)
+        st.session_state["workspace_saved_selection"] = selection
+        st.session_state["workspace_saved_version"] = get_overlay_journal().version
+        return project_stats(project)
+
+    selection = load_selection(project)
+    st.session_state["saved_selection_rules"] = load_rules(project)
+    st.session_state["checked_all_list"] = selection
+    st.session_state["checked"] = selection
+    st.session_state["expanded"] = []
+    st.session_state["workspace_saved_selection"] = set(selection)
+
+    import pandas as pd
+
+    # overlay is pulled from disk by data_store.get_overlay_df() when first needed
+    st.session_state["overlay_df"] = pd.DataFrame()
+    st.session_state["workspace_pending_overlay"] = project if n_rows else None
+    for key in ("overlay_journal", "key_index", "leaf_lookup_master", "last_import_summary", "last_import_files", "last_upload_df"):
+        st.session_state.pop(key, None)
+    st.session_state["workspace_saved_version"] = 0
+
+    return n_rows, n_sel
+
+
+def flush_workspace() -> None:
+    """Write this rerun's changes (overlay delta + selection diff) in one batch."""
+    project = st.session_state.get("workspace_project")
+    if not project:
+        return
+
+    journal = st.session_state.get("overlay_journal")
+    saved_version = st.session_state.get("workspace_saved_version", 0)
+    replace = False
+    overlay_df = st.session_state.get("overlay_df")
+    if journal is not None and journal.version > saved_version:
+        changes = journal.changes_since(saved_version, overlay_df)
+        if changes is None:
+            # the journal no longer knows what changed since the last flush: save the whole overlay
+            rows, deleted, replace = overlay_df, None, True
+        else:
+            rows, deleted = changes
+    else:
+        rows, deleted = None, None
+
+    selection = set(st.session_state.get("checked_all_list", []))
+    saved_selection = st.session_state.get("workspace_saved_selection", set())
+    added = selection - saved_selection
+    removed = saved_selection - selection
+
+    if rows is None and not added and not removed:
+        return
+
+    overlay_order = None
+    if rows is not None and overlay_df is not None and "__row_key__" in overlay_df.columns:
+        overlay_order = overlay_df["__row_key__"]
+    write_changes(project, rows, deleted, added, removed, replace_overlay=replace, overlay_order=overlay_order)
+
+    st.session_state["workspace_saved_selection"] = selection
+    if journal is not None:
+        st.session_state["workspace_saved_version"] = journal.version
+        journal.forget_changes_before(journal.version)